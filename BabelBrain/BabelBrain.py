@@ -371,6 +371,7 @@ class BabelBrain(QWidget):
         self.Config['bUseRayleighForWater']= True
         self.Config['ComputingBackend']=ComputingBackend
         self.Config['ComputingDevice']=ComputingDevice
+        self.Config['ThermalDevices']=widget.GetDevicesForBackend(Backend)
         self.Config['TxSystem']=widget.ui.TransducerTypecomboBox.currentText()
 
         self.Config['simbnibs_path']=simbnibs_path
@@ -42,7 +42,17 @@ try:
 except:
     from . import CTZTEProcessing
     from .CTZTEProcessing import SaveHashInfo, GetBlake2sHash
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import CPUVoxelize
+except:
+    from . import CPUVoxelize
+
+try:
+    import CPUMedianFilter
+except:
+    from . import CPUMedianFilter
 
 try:
     from ConvMatTransform import ReadTrajectoryBrainsight, GetIDTrajectoryBrainsight,read_itk_affine_transform,itk_to_BSight
@@ -68,33 +78,82 @@ def smooth(inputModel, method='Laplace', iterations=30, laplaceRelaxationFactor=
 def MaskToStl(binmask,affine):
     pvvol=pv.wrap(binmask.astype(np.float32))
     surface=pvvol.contour(isosurfaces=np.array([0.9]))
-    
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        surface.save(tmpdirname+os.sep+'__t.vtk')
-
-        reader = vtk.vtkPolyDataReader()
-        reader.SetFileName(tmpdirname+os.sep+'__t.vtk')
-        reader.ReadAllFieldsOn()
-        reader.Update()
-
-        writer = vtk.vtkSTLWriter()
-        writer.SetInputData(smooth(reader.GetOutput()))
-        writer.SetFileName(tmpdirname+os.sep+'__t.stl')
-        writer.SetFileTypeToBinary()
-        writer.Update()
-        writer.Write()
-
-        meshsurface=trimesh.load_mesh(tmpdirname+os.sep+'__t.stl')
-        nP=(affine[:3,:3]@meshsurface.vertices.T).T
-        nP[:,0]+=affine[0,3]
-        nP[:,1]+=affine[1,3]
-        nP[:,2]+=affine[2,3]
-        meshsurface.vertices=nP
-
-        os.remove(tmpdirname+os.sep+'__t.vtk')
-        os.remove(tmpdirname+os.sep+'__t.stl')
+    smoothed=pv.wrap(smooth(surface)).triangulate()
+    #vertices are kept in single precision as when the surface was passed through an STL file
+    vertices=np.asarray(smoothed.points,np.float32).astype(np.float64)
+    faces=np.asarray(smoothed.faces).reshape((-1,4))[:,1:]
+    meshsurface=trimesh.Trimesh(vertices=vertices,faces=faces)
+    nP=(affine[:3,:3]@meshsurface.vertices.T).T
+    nP[:,0]+=affine[0,3]
+    nP[:,1]+=affine[1,3]
+    nP[:,2]+=affine[2,3]
+    meshsurface.vertices=nP
     return meshsurface
 
+_CharmMeshCache={}
+MaxCharmMeshCache=2 #segmentations kept in memory
+def GetCharmSurfaceMeshes(charminput,CacheDir,bForceRecalculation=False):
+    '''
+    Skin, CSF and skull surfaces of a charm segmentation, the three surfaces are built concurrently.
+    Results are cached in memory and in CacheDir keyed by the hash of the charm file, so they are
+    rebuilt only when the segmentation changes. Cache files of other segmentations in CacheDir are
+    removed when a new one is saved
+    '''
+    CharmHash=GetBlake2sHash(charminput)
+    CacheFile=CacheDir+os.sep+'charm_surfaces_'+CharmHash+'.npz'
+    Names=['skin','csf','skull']
+    if not bForceRecalculation:
+        if CharmHash in _CharmMeshCache:
+            print('Reusing charm surfaces from memory')
+            return [m.copy() for m in _CharmMeshCache[CharmHash]]
+        if os.path.isfile(CacheFile):
+            try:
+                with np.load(CacheFile) as Data:
+                    Meshes=[trimesh.Trimesh(vertices=Data[n+'_vertices'],faces=Data[n+'_faces'],process=False) for n in Names]
+                print('Reusing charm surfaces from',CacheFile)
+                AddCharmMeshCache(CharmHash,Meshes)
+                return [m.copy() for m in Meshes]
+            except:
+                print(f"{CacheFile} was corrupted")
+
+    charm= nibabel.load(charminput)
+    charmdata=np.ascontiguousarray(charm.get_fdata())[:,:,:,0]
+    AllTissueRegion=charmdata>0 #this mimics what the old headreco does for skin
+    BoneRegion=(charmdata>0) & (charmdata!=5) #this mimics what the old headreco does for bone
+    CSFRegion=(charmdata==1) | (charmdata==2) | (charmdata==3) | (charmdata==9) #this mimics what the old headreco does for skin
+
+    def BuildSurface(name,mask):
+        mesh=MaskToStl(mask,charm.affine)
+        if mesh.body_count != 1:
+            print(name+'_mesh is invalid... trying to fix')
+            mesh = FixMesh(mesh)
+        return mesh
+
+    #the VTK contour and smoothing filters release the GIL, so the three surfaces are built in threads.
+    #pymeshfix keeps the GIL, meshes that need fixing are repaired one at a time
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        Meshes=list(pool.map(BuildSurface,Names,[AllTissueRegion,CSFRegion,BoneRegion]))
+
+    AddCharmMeshCache(CharmHash,Meshes)
+    try:
+        Data={}
+        for n,m in zip(Names,Meshes):
+            Data[n+'_vertices']=np.asarray(m.vertices)
+            Data[n+'_faces']=np.asarray(m.faces)
+        np.savez_compressed(CacheFile,**Data)
+        #surfaces of a previous segmentation in the same directory are not needed anymore
+        for f in glob.glob(CacheDir+os.sep+'charm_surfaces_*.npz'):
+            if os.path.basename(f)!=os.path.basename(CacheFile):
+                os.remove(f)
+    except OSError:
+        print('Unable to save charm surfaces cache',CacheFile)
+    return [m.copy() for m in Meshes]
+
+def AddCharmMeshCache(CharmHash,Meshes):
+    _CharmMeshCache.pop(CharmHash,None)
+    while len(_CharmMeshCache)>=MaxCharmMeshCache:
+        _CharmMeshCache.pop(next(iter(_CharmMeshCache)))
+    _CharmMeshCache[CharmHash]=Meshes
 
 
 # if sys.platform in ['linux','win32']:
@@ -275,14 +334,66 @@ def DoIntersect(Mesh1,Mesh2,bForceUseBlender=False):
     
     return Mesh1_intersect
 
+def ReturnFOVMask(shape,affine,Location,RMat,RadCone=None,HeightCone=None,DimsBox=None,ChunkSize=16):
+    '''
+    Boolean mask of the voxels (grid of given shape and affine voxel to world) inside the transducer FOV, evaluated analytically
+    instead of intersecting meshes. The cone has its apex at Location and opens along the third column of RMat, with radius RadCone
+    at HeightCone. The box of dimensions DimsBox is centered at Location and aligned with RMat. When both are given, the mask is their intersection.
+    The volume is processed in chunks of ChunkSize planes along the first axis
+    '''
+    assert(RadCone is not None or DimsBox is not None)
+    #coordinates in the frame of the transducer, as a linear function of the voxel indexes
+    M=(RMat.T@affine[:3,:3]).astype(np.float32)
+    o=(RMat.T@(affine[:3,3]-np.array(Location))).astype(np.float32)
+    j=np.arange(shape[1],dtype=np.float32).reshape((1,-1,1))
+    k=np.arange(shape[2],dtype=np.float32).reshape((1,1,-1))
+    FOVMask=np.zeros(shape,bool)
+    for i0 in range(0,shape[0],ChunkSize):
+        i=np.arange(i0,min(i0+ChunkSize,shape[0]),dtype=np.float32).reshape((-1,1,1))
+        Local=[M[c,0]*i+M[c,1]*j+M[c,2]*k+o[c] for c in range(3)]
+        Inside=np.ones(np.broadcast_shapes(i.shape,j.shape,k.shape),bool)
+        if RadCone is not None:
+            Inside&=(Local[2]>=0) & (Local[2]<=HeightCone) & \
+                    (Local[0]**2+Local[1]**2<=(RadCone/HeightCone*Local[2])**2)
+        if DimsBox is not None:
+            for c in range(3):
+                Inside&=np.abs(Local[c])<=DimsBox[c]/2
+        FOVMask[i0:i0+ChunkSize]=Inside
+    return FOVMask
+
+def MapUniqueHU(ndataCT,nfct):
+    '''
+    Unique values of the quantized CT in the bone region nfct, and map (uint32) of the index of each bone voxel value in that list (0 outside the bone region).
+    Same result as comparing the volume against each unique value, in a single pass
+    '''
+    #the inverse indexes of the unique values are the material map of the bone voxels
+    UniqueHU,UniqueHUIndex=np.unique(ndataCT[nfct],return_inverse=True)
+    ndataCTMap=np.zeros(ndataCT.shape,np.uint32)
+    ndataCTMap[nfct]=UniqueHUIndex.reshape(-1)
+    return UniqueHU,ndataCTMap
+
+def VoxelizeToMask(inputMesh,Mask,affine,SpatialStep,Value=1,bClipToGrid=False):
+    '''
+    Set to Value the voxels of Mask (grid with affine voxel to world) nearest to the points of the mesh voxelized at 0.75 of the spatial step,
+    with the GPU callback or on the CPU (same rule in both). With bClipToGrid, the mesh is first cut with closed caps to the box of the grid,
+    so only the region of the simulation domain is voxelized
+    '''
+    GridBounds=inputMesh.bounds
+    if bClipToGrid:
+        inputMesh=CPUVoxelize.ClipMeshToGrid(inputMesh,Mask.shape,affine)
+        if len(inputMesh.faces)==0:
+            return Mask
+    if VoxelizeFilter is None:
+        #the CPU samples the clipped mesh at the same points of the full mesh
+        CPUVoxelize.VoxelizeToGridNearest(inputMesh,Mask,affine,SpatialStep*0.75,Value=Value,GridBounds=GridBounds)
+    else:
+        Points=VoxelizeFilter(inputMesh,targetResolution=SpatialStep*0.75,GPUBackend=VoxelizeCOMPUTING_BACKEND)
+        CPUVoxelize.PointsToGrid(Points,affine,Mask,Value)
+    return Mask
+
 def FixMesh(inmesh):
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        inmesh.export(tmpdirname+os.sep+'__in.stl')
-        pymeshfix.clean_from_file(tmpdirname+os.sep+'__in.stl', tmpdirname+os.sep+'__out.stl')
-        fixmesh=trimesh.load_mesh(tmpdirname+os.sep+'__out.stl')
-        os.remove(tmpdirname+os.sep+'__in.stl')
-        os.remove(tmpdirname+os.sep+'__out.stl')
-    return fixmesh
+    vclean,fclean=pymeshfix.clean_from_arrays(np.asarray(inmesh.vertices,np.float64),np.asarray(inmesh.faces,np.int32))
+    return trimesh.Trimesh(vertices=vclean,faces=fclean)
 
 def GenerateFileNames(SimbNIBSDir,SimbNIBSType,T1Source_nii,T1Conformal_nii,CT_or_ZTE_input,CTType,CoregCT_MRI,prefix):
     inputfiles = {}
@@ -564,26 +675,10 @@ def GetSkullMaskFromSimbNIBSSTL(SimbNIBSDir='4007/4007_keep/m2m_4007_keep/',
         else:
             #while charm is much more powerful to segment skull regions, we need to calculate the meshes ourselves
             charminput = inputfilenames['SimbNIBSinput']
-            charm= nibabel.load(charminput)
-            charmdata=np.ascontiguousarray(charm.get_fdata())[:,:,:,0]
-            AllTissueRegion=charmdata>0 #this mimics what the old headreco does for skin
             TMaskItk=sitk.ReadImage(charminput, sitk.sitkFloat32)>0 #we also kept an SITK Object
 
-            BoneRegion=(charmdata>0) & (charmdata!=5) #this mimics what the old headreco does for bone
-            CSFRegion=(charmdata==1) | (charmdata==2) | (charmdata==3) | (charmdata==9) #this mimics what the old headreco does for skin
             with CodeTimer("charm surface recon",unit='s'):
-                skin_mesh=MaskToStl(AllTissueRegion,charm.affine)
-                csf_mesh=MaskToStl(CSFRegion,charm.affine)
-                skull_mesh=MaskToStl(BoneRegion,charm.affine)
-                if skin_mesh.body_count != 1:
-                    print('skin_mesh is invalid... trying to fix')
-                    skin_mesh = FixMesh(skin_mesh)
-                if csf_mesh.body_count != 1:
-                    print('csf_mesh is invalid... trying to fix')
-                    csf_mesh = FixMesh(csf_mesh)
-                if skull_mesh.body_count != 1:
-                    print('skull_mesh is invalid... trying to fix')
-                    skull_mesh = FixMesh(skull_mesh)   
+                skin_mesh,csf_mesh,skull_mesh=GetCharmSurfaceMeshes(charminput,SavePath,bForceRecalculation=bForceFullRecalculation)
                 skin_mesh.export(skin_stl)
                 csf_mesh.export(csf_stl)
                 skull_mesh.export(skull_stl)
@@ -599,8 +694,6 @@ def GetSkullMaskFromSimbNIBSSTL(SimbNIBSDir='4007/4007_keep/m2m_4007_keep/',
         Foc=Foc[0]
     HeightCone=np.sqrt(Foc**2-RadCone**2)
     print('HeightCone',HeightCone)
-    
-    InVAffine=np.linalg.inv(baseaffine)
 
     if TrajectoryType =='brainsight':
         print('*'*40+'\n Reading orientation and target location directly from Brainsight export\n'+'*'*40)
@@ -651,64 +744,19 @@ def GetSkullMaskFromSimbNIBSSTL(SimbNIBSDir='4007/4007_keep/m2m_4007_keep/',
     print(RMat)
     
     skin_mesh = trimesh.load_mesh(skin_stl)
-    #we intersect the skin region with a cone region oriented in the same direction as the acoustic beam
-    skin_mesh =DoIntersect(skin_mesh,Cone,bForceUseBlender=bForceUseBlender)
-
-    #we obtain the list of Cartesian voxels inside the skin region intersected by the cone    
-    with CodeTimer("voxelization ",unit='s'):
-        if VoxelizeFilter is None:  
-            skin_grid = skin_mesh.voxelized(SpatialStep,max_iter=30).fill().points
-        else:
-            skin_grid = VoxelizeFilter(skin_mesh,targetResolution=SpatialStep*0.75,GPUBackend=VoxelizeCOMPUTING_BACKEND)
-
-    
-    x_vec=np.arange(skin_grid[:,0].min(),skin_grid[:,0].max()+SpatialStep,SpatialStep)
-    y_vec=np.arange(skin_grid[:,1].min(),skin_grid[:,1].max()+SpatialStep,SpatialStep)
-    z_vec=np.arange(skin_grid[:,2].min(),skin_grid[:,2].max()+SpatialStep,SpatialStep)
-    
-    Corner1=np.array([x_vec[0],y_vec[0],z_vec[0],1]).reshape((4,1))
-    Corner2=np.array([x_vec[-1],y_vec[-1],z_vec[-1],1]).reshape((4,1))
-
-    #we will produce one dataset (used only for sanity tests)
-    # with the same orientation as the T1 scan and just enclosing the list of points intersected
-    AffIJKCorners=np.floor(np.dot(InVAffine,np.hstack((Corner1,Corner2)))).astype(np.int64).T
-    AffIJKCornersMin=np.min(AffIJKCorners,axis=0).reshape((4,1))
-    NewOrig=np.dot(baseaffine,AffIJKCornersMin)
-    
-    baseaffine[:,3]=NewOrig.flatten()
-    
-    
-    print('baseaffine',baseaffine)
-    RMat4=np.eye(4)
-    RMat4[:3,:3]=RMat*SpatialStep
-    print('RMat4',RMat4)
-   
-    baseaffineRot=RMat4   
-    
-    
-    print('baseaffineRot',baseaffineRot)
-    
-    InVAffine=np.linalg.inv(baseaffine)
-    InVAffineRot=np.linalg.inv(baseaffineRot)
-
-    XYZ=skin_grid
-    #we make it a Nx4 array
-    XYZ=np.hstack((XYZ,np.ones((XYZ.shape[0],1)))).T
-    
-    #now we prepare the new dataset that is perpendicular to the cone direction
-    #first we calculate the indexes i,j,k
-    AffIJK=np.round(np.dot(InVAffineRot,XYZ)).astype(np.int64).T
-    NewOrig=baseaffineRot @np.array([AffIJK[:,0].min(),AffIJK[:,1].min(),AffIJK[:,2].min(),1]).reshape((4,1))
-    baseaffineRot[:,3]=NewOrig.flatten()
-    InVAffineRot=np.linalg.inv(baseaffineRot)
-    
-    ALoc=np.ones((4,1))
-    ALoc[:3,0]=np.array(Location)
-    XYZ=np.hstack((XYZ,ALoc))
-    AffIJK=np.round(np.dot(InVAffineRot,XYZ)).astype(np.int64).T
-    
-    LocFocalPoint=AffIJK[-1,:3] #we recover the location in pixels of the intended target
-          
+    #we verify the skin region intersected by a cone oriented in the same direction as the acoustic beam is not empty
+    with CodeTimer("cone FOV check",unit='s'):
+        ConeAffine=np.eye(4)
+        ConeAffine[:3,:3]=RMat*SpatialStep
+        SkinIJK=skin_mesh.vertices@np.linalg.inv(ConeAffine[:3,:3]).T
+        ConeAffine[:3,3]=ConeAffine[:3,:3]@np.floor(SkinIJK.min(axis=0))
+        ConeShape=tuple((np.ceil(SkinIJK.max(axis=0))-np.floor(SkinIJK.min(axis=0))).astype(np.int64)+1)
+        del SkinIJK
+        SkinCone=VoxelizeToMask(skin_mesh,np.zeros(ConeShape,np.uint8),ConeAffine,SpatialStep)
+        if not np.any(SkinCone[ReturnFOVMask(ConeShape,ConeAffine,Location,RMat,RadCone=RadCone,HeightCone=HeightCone)]):
+            raise ValueError("Trajectory is outside headspace")
+        del SkinCone
+      
     ## This is the box that covers the minimal volume
     DimsBox=np.zeros((3))
     DimsBox[0:2]=FOVDiameter
@@ -721,143 +769,64 @@ def GetSkullMaskFromSimbNIBSSTL(SimbNIBSDir='4007/4007_keep/m2m_4007_keep/',
     BoxFOV.export(os.path.dirname(T1Conformal_nii)+os.sep+prefix+'_box_FOV.stl')
       
     ##################### And we repeat and complete data extraction
-    baseaffine=T1Conformal.affine.copy()
-    baseaffine[0,0]*=SpatialStep
-    baseaffine[1,1]*=SpatialStep
-    baseaffine[2,2]*=SpatialStep
-
-
     skull_mesh = trimesh.load_mesh(skull_stl)
     csf_mesh = trimesh.load_mesh(csf_stl)
     skin_mesh = trimesh.load_mesh(skin_stl)
 
-    if bApplyBOXFOV:
-        skull_mesh=DoIntersect(skull_mesh,BoxFOV,bForceUseBlender=bForceUseBlender)
-        csf_mesh  =DoIntersect(csf_mesh,  BoxFOV,bForceUseBlender=bForceUseBlender)
-        skin_mesh =DoIntersect(skin_mesh, BoxFOV,bForceUseBlender=bForceUseBlender)
-    
-    #we first subtract to find the pure bone region
-    if VoxelizeFilter is None:
-        while(True):
-            try:
-                with CodeTimer("cpu skull voxelization",unit='s'):
-                    skull_grid = skull_mesh.voxelized(SpatialStep*0.75,max_iter=30).fill().points.astype(np.float32)
-                with CodeTimer("cpu voxelization",unit='s'):
-                    csf_grid = csf_mesh.voxelized(SpatialStep*0.75,max_iter=30).fill().points.astype(np.float32)
-                with CodeTimer("cpu voxelization",unit='s'):
-                    skin_grid = skin_mesh.voxelized(SpatialStep*0.75,max_iter=30).fill().points.astype(np.float32)
-                break
-            except AttributeError as err:
-                print("Repeating CSG boolean since once in while it returns an scene instead of a mesh....")
-                print(err)
-            else:
-                raise err
-    else:
-        with CodeTimer("skull voxelization",unit='s'):
-            skull_grid = VoxelizeFilter(skull_mesh,targetResolution=SpatialStep*0.75,GPUBackend=VoxelizeCOMPUTING_BACKEND)
-        with CodeTimer("brain voxelization",unit='s'):
-            csf_grid = VoxelizeFilter(csf_mesh,targetResolution=SpatialStep*0.75,GPUBackend=VoxelizeCOMPUTING_BACKEND)
-        with CodeTimer("skin voxelization",unit='s'):
-            skin_grid = VoxelizeFilter(skin_mesh,targetResolution=SpatialStep*0.75,GPUBackend=VoxelizeCOMPUTING_BACKEND)
-        
-    
-    #we obtain the list of Cartesian voxels in the whole skin region intersected by the cone    
-        
-    x_vec=np.arange(skin_grid[:,0].min(),skin_grid[:,0].max()+SpatialStep,SpatialStep)
-    y_vec=np.arange(skin_grid[:,1].min(),skin_grid[:,1].max()+SpatialStep,SpatialStep)
-    z_vec=np.arange(skin_grid[:,2].min(),skin_grid[:,2].max()+SpatialStep,SpatialStep)
-    
-    Corner1=np.array([x_vec[0],y_vec[0],z_vec[0],1]).reshape((4,1))
-    Corner2=np.array([x_vec[-1],y_vec[-1],z_vec[-1],1]).reshape((4,1))
-    
-    #we will produce one dataset (used only for sanity tests)
-    # with the same orientation as the T1 scan and just enclosing the list of points intersected
-    AffIJKCorners=np.floor(np.dot(InVAffine,np.hstack((Corner1,Corner2)))).astype(np.int64).T
-    AffIJKCornersMin=np.min(AffIJKCorners,axis=0).reshape((4,1))
-    NewOrig=np.dot(baseaffine,AffIJKCornersMin)
-    
-    baseaffine[:,3]=NewOrig.flatten()
-    
-    
-    print('baseaffine',baseaffine)
-    baseaffineRot=baseaffine.copy()
+    #the beam-aligned grid has the orientation of the trajectory, its extent covers the skin mesh (within BoxFOV if applied) and the target
     RMat4=np.eye(4)
     RMat4[:3,:3]=RMat*SpatialStep
     print('RMat4',RMat4)
-    
-    
     baseaffineRot=RMat4
-    
-    print('baseaffineRot',baseaffineRot)
-    
-    InVAffine=np.linalg.inv(baseaffine)
     InVAffineRot=np.linalg.inv(baseaffineRot)
-    InVAffineRot=InVAffineRot.astype(skin_grid.dtype)    
-
-    with CodeTimer("skin masking",unit='s'):
-        XYZ=skin_grid
-        XYZ=np.hstack((XYZ,np.ones((XYZ.shape[0],1),dtype=skin_grid.dtype))).T
-        #now we prepare the new dataset that is perpendicular to the cone direction
-        AffIJK=np.round(np.dot(InVAffineRot,XYZ)).astype(np.int64).T
-        NewOrig=baseaffineRot @np.array([AffIJK[:,0].min(),AffIJK[:,1].min(),AffIJK[:,2].min(),1]).reshape((4,1))
-        baseaffineRot[:,3]=NewOrig.flatten()
-        InVAffineRot=np.linalg.inv(baseaffineRot)
-        InVAffineRot=InVAffineRot.astype(skin_grid.dtype)
-        del AffIJK
-        ALoc=np.ones((4,1),dtype=skin_grid.dtype)
-        ALoc[:3,0]=np.array(Location,dtype=skin_grid.dtype)
-        XYZ=np.hstack((XYZ,ALoc))
-        AffIJK=np.round(np.dot(InVAffineRot,XYZ)).astype(np.int64).T
-        
-        LocFocalPoint=AffIJK[-1,:3]
-        
-        BinMaskConformalSkinRot=np.zeros(np.max(AffIJK,axis=0)[:3]+1,np.int8)
-        BinMaskConformalSkinRot[AffIJK[:,0],AffIJK[:,1],AffIJK[:,2]]=1
-
-    del XYZ
-    del skin_grid
-    gc.collect()
-
-    t0=time.time()
-    with CodeTimer("skull masking",unit='s'):
-        XYZ=skull_grid
-        XYZ=np.hstack((XYZ,np.ones((XYZ.shape[0],1),dtype=skull_grid.dtype))).T
-        AffIJK=np.round(np.dot(InVAffineRot,XYZ)).astype(np.int64).T
-        BinMaskConformalSkullRot=np.zeros_like(BinMaskConformalSkinRot)
-        inds=(AffIJK[:,0]<BinMaskConformalSkullRot.shape[0])&\
-             (AffIJK[:,1]<BinMaskConformalSkullRot.shape[1])&\
-             (AffIJK[:,2]<BinMaskConformalSkullRot.shape[2])
-        AffIJK=AffIJK[inds,:]
-        BinMaskConformalSkullRot[AffIJK[:,0],AffIJK[:,1],AffIJK[:,2]]=1
-    del AffIJK
-    del XYZ
-    del skull_grid
-    gc.collect()
-
-    with CodeTimer("csf masking",unit='s'):
-        XYZ=csf_grid
-        XYZ=np.hstack((XYZ,np.ones((XYZ.shape[0],1),dtype=csf_grid.dtype))).T
-        AffIJK=np.round(np.dot(InVAffineRot,XYZ)).astype(np.int64).T
-        BinMaskConformalCSFRot=np.zeros(BinMaskConformalSkinRot.shape,np.uint8)
-        inds=(AffIJK[:,0]<BinMaskConformalSkullRot.shape[0])&\
-             (AffIJK[:,1]<BinMaskConformalSkullRot.shape[1])&\
-             (AffIJK[:,2]<BinMaskConformalSkullRot.shape[2])
-        AffIJK=AffIJK[inds,:]
-        BinMaskConformalCSFRot[AffIJK[:,0],AffIJK[:,1],AffIJK[:,2]]=1
-   
-    del AffIJK
-    del XYZ
-    del csf_grid
+    SkinIJK=skin_mesh.vertices@InVAffineRot[:3,:3].T
+    LocIJK=InVAffineRot[:3,:3]@np.array(Location)
+    LowerIJK=np.floor(SkinIJK.min(axis=0))
+    UpperIJK=np.ceil(SkinIJK.max(axis=0))
+    del SkinIJK
+    if bApplyBOXFOV:
+        #BoxFOV is aligned with the grid, so it just bounds the grid
+        LowerIJK=np.maximum(LowerIJK,np.floor(LocIJK-DimsBox/2/SpatialStep))
+        UpperIJK=np.minimum(UpperIJK,np.ceil(LocIJK+DimsBox/2/SpatialStep))
+    NewOrigIJK=LowerIJK
+    baseaffineRot[:3,3]=RMat4[:3,:3]@NewOrigIJK
+    LocFocalPoint=np.round(LocIJK-NewOrigIJK).astype(np.int64) #we recover the location in pixels of the intended target
+    ShapeRot=np.maximum(UpperIJK-NewOrigIJK,LocFocalPoint).astype(np.int64)+1
+
+    #meshes are voxelized in sequence directly in the final mask, skull (2) and brain (4) overwrite skin (1)
+    FinalMask=np.zeros(ShapeRot,np.uint8)
+    with CodeTimer("skin voxelization",unit='s'):
+        VoxelizeToMask(skin_mesh,FinalMask,baseaffineRot,SpatialStep,Value=1)
+    if bApplyBOXFOV:
+        with CodeTimer("box FOV masking",unit='s'):
+            BoxMask=ReturnFOVMask(FinalMask.shape,baseaffineRot,Location,RMat,DimsBox=DimsBox)
+            FinalMask[~BoxMask]=0
+            #the grid is reduced to the skin region inside the box and the target
+            Inside=np.argwhere(FinalMask)
+            if Inside.shape[0]==0:
+                raise ValueError("Trajectory is outside headspace")
+            CropLower=np.minimum(Inside.min(axis=0),LocFocalPoint)
+            CropUpper=np.maximum(Inside.max(axis=0),LocFocalPoint)+1
+            del Inside
+            Crop=tuple(slice(l,u) for l,u in zip(CropLower,CropUpper))
+            FinalMask=np.ascontiguousarray(FinalMask[Crop])
+            BoxMask=np.ascontiguousarray(BoxMask[Crop])
+            NewOrigIJK+=CropLower
+            LocFocalPoint-=CropLower
+            baseaffineRot[:3,3]=RMat4[:3,:3]@NewOrigIJK
+    print('baseaffineRot',baseaffineRot)
+    #skull and brain meshes are cut to the box of the grid, so their voxelization scales with the simulation domain
+    with CodeTimer("skull voxelization",unit='s'):
+        VoxelizeToMask(skull_mesh,FinalMask,baseaffineRot,SpatialStep,Value=2,bClipToGrid=True)
+    with CodeTimer("brain voxelization",unit='s'):
+        VoxelizeToMask(csf_mesh,FinalMask,baseaffineRot,SpatialStep,Value=4,bClipToGrid=True)
+    if bApplyBOXFOV:
+        FinalMask[~BoxMask]=0
+        del BoxMask
     gc.collect()
-    
-    FinalMask=BinMaskConformalSkinRot
 
     #Now we deal if CT or ZTE has beegn given as input
-    if CT_or_ZTE_input is  None:
-        with CodeTimer("Final Mask gen without CT/ZTE", unit="s"):
-            FinalMask[BinMaskConformalSkullRot==1]=2 #cortical
-            FinalMask[BinMaskConformalCSFRot==1]=4#brain
-    else:
+    if CT_or_ZTE_input is not None:
         if bReuseFiles:
             # Grab previously generated mask
             fct = nibabel.load(prevoutputfilenames['ReuseMask'])
@@ -935,7 +904,7 @@ def GetSkullMaskFromSimbNIBSSTL(SimbNIBSDir='4007/4007_keep/m2m_4007_keep/',
                 with CodeTimer("median filter CT",unit='s'):
                     print('Theshold for bone',HUThreshold)
                     if MedianFilter is None:
-                        fct=ndimage.median_filter(ndataCT>HUThreshold,7,mode='constant',cval=0)
+                        fct=CPUMedianFilter.LabelMedianFilter(ndataCT>HUThreshold,7,mode='constant',cval=0)
                     else:
                         fct=MedianFilter(np.ascontiguousarray(ndataCT>HUThreshold).astype(np.uint8),7,GPUBackend=MedianCOMPUTING_BACKEND)
             else:
@@ -957,10 +926,10 @@ def GetSkullMaskFromSimbNIBSSTL(SimbNIBSDir='4007/4007_keep/m2m_4007_keep/',
             ndataCT[nfct==False]=0
 
         with CodeTimer("CT binary_dilation",unit='s'):
-            BinMaskConformalCSFRot= ndimage.binary_dilation(BinMaskConformalCSFRot,iterations=6)
+            BinMaskConformalCSFRot= ndimage.binary_dilation(FinalMask==4,iterations=6)
         with CodeTimer("FinalMask[BinMaskConformalCSFRot]=4",unit='s'):
             FinalMask[BinMaskConformalCSFRot]=4  
-            FinalMask[BinMaskConformalSkullRot==1]=4
+            FinalMask[FinalMask==2]=4
         #brain
         with CodeTimer("FinalMask[nfct]=2",unit='s'):
             FinalMask[nfct]=2  #bone
@@ -997,18 +966,17 @@ def GetSkullMaskFromSimbNIBSSTL(SimbNIBSDir='4007/4007_keep/m2m_4007_keep/',
         ResStep=A/M 
         qx = ResStep *  np.round( (M/A) * (ndataCT[nfct]-minData) )+ minData
         ndataCT[nfct]=qx
-        UniqueHU=np.unique(ndataCT[nfct])
+        if MapFilter is None:
+            with CodeTimer("Mapping unique values",unit='s'):
+                UniqueHU,ndataCTMap=MapUniqueHU(ndataCT,nfct)
+        else:
+            UniqueHU=np.unique(ndataCT[nfct])
         print('Unique CT values',len(UniqueHU))
         CTCalfname = os.path.dirname(T1Conformal_nii)+os.sep+prefix+'CT-cal.npz'
         np.savez_compressed(CTCalfname,UniqueHU=UniqueHU)
 
         with CodeTimer("Mapping unique values",unit='s'):
-            if MapFilter is None:
-                ndataCTMap=np.zeros(ndataCT.shape,np.uint32)
-                for n,d in enumerate(UniqueHU):
-                    ndataCTMap[ndataCT==d]=n
-                ndataCTMap[nfct==False]=0
-            else:
+            if MapFilter is not None:
                 ndataCTMap=MapFilter(ndataCT,nfct.astype(np.uint8),UniqueHU,GPUBackend=MapFilterCOMPUTING_BACKEND)
 
             nCT=nibabel.Nifti1Image(ndataCTMap, nCT.affine, nCT.header)
@@ -1022,7 +990,7 @@ def GetSkullMaskFromSimbNIBSSTL(SimbNIBSDir='4007/4007_keep/m2m_4007_keep/',
         if CT_or_ZTE_input is not None:
             FinalMask[FinalMask==2]=1
         if MedianFilter is None:
-            FinalMask=ndimage.median_filter(FinalMask.astype(np.uint8),7)
+            FinalMask=CPUMedianFilter.LabelMedianFilter(FinalMask.astype(np.uint8),7)
         else:
             FinalMask=MedianFilter(FinalMask.astype(np.uint8),7,GPUBackend=MedianCOMPUTING_BACKEND)
     if CT_or_ZTE_input is not None:
@@ -28,6 +28,7 @@ from datetime import datetime
 import time
 import yaml
 from BabelViscoFDTD.H5pySimple import ReadFromH5py, SaveToH5py
+from TranscranialModeling.DataForSimH5 import ReadDataForSim
 from CalculateFieldProcess import CalculateFieldProcess
 from GUIComponents.ScrollBars import ScrollBars as WidgetScrollBars
 
@@ -136,7 +137,7 @@ class CTX500(BabelBaseTx):
         print('WaterSolName',self._WaterSolName)
         bCalcFields=False
         if os.path.isfile(self._FullSolName) and os.path.isfile(self._WaterSolName):
-            Skull=ReadFromH5py(self._FullSolName)
+            Skull=ReadDataForSim(self._FullSolName)
 
             SelCorrection =self._MainApp.Config[self._KeyCorrection]
             CoeffA = self.Config['Corrections'][SelCorrection][0]
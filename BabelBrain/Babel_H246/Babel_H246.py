@@ -28,6 +28,7 @@ from datetime import datetime
 import time
 import yaml
 from BabelViscoFDTD.H5pySimple import ReadFromH5py, SaveToH5py
+from TranscranialModeling.DataForSimH5 import ReadDataForSim
 from CalculateFieldProcess import CalculateFieldProcess
 from GUIComponents.ScrollBars import ScrollBars as WidgetScrollBars
 
@@ -129,7 +130,7 @@ class H246(BabelBaseTx):
         print('WaterSolName',self._WaterSolName)
         bCalcFields=False
         if os.path.isfile(self._FullSolName) and os.path.isfile(self._WaterSolName):
-            Skull=ReadFromH5py(self._FullSolName)
+            Skull=ReadDataForSim(self._FullSolName)
             TPO=Skull['ZSteering']
             
             DistanceSkin =  -Skull['TxMechanicalAdjustmentZ']*1e3
@@ -29,6 +29,7 @@ from datetime import datetime
 import time
 import yaml
 from BabelViscoFDTD.H5pySimple import ReadFromH5py
+from TranscranialModeling.DataForSimH5 import ReadDataForSim
 from GUIComponents.ScrollBars import ScrollBars as WidgetScrollBars
 
 from CalculateFieldProcess import CalculateFieldProcess
@@ -131,7 +132,7 @@ class REMOPD(BabelBasePhaseArray):
             
         if bPrexistingFiles:
             #we can use the first entry, this is valid for all files in the list
-            Skull=ReadFromH5py(self._FullSolName[0])
+            Skull=ReadDataForSim(self._FullSolName[0])
             XSteering=Skull['XSteering']
             YSteering=Skull['YSteering']
             ZSteering=Skull['ZSteering']
@@ -31,7 +31,8 @@ import time
 import yaml
 from ThermalModeling.CalculateTemperatureEffects import GetThermalOutName
 from BabelViscoFDTD.H5pySimple import ReadFromH5py, SaveToH5py
-from .CalculateThermalProcess import CalculateThermalProcess
+from ThermalModeling.ThermalOutput import ReadThermalResults
+from .CalculateThermalProcess import CalculateThermalProcess,THERMAL_COMBINATION_DONE
 import pandas as pd
 import platform
 import nibabel
@@ -60,6 +61,7 @@ class Babel_Thermal(QWidget):
         super(Babel_Thermal, self).__init__(parent)
         self._MainApp=MainApp
         self._ThermalResults=[]
+        self._StreamedResults={} #combinations already finished during a calculation
         self._bMultiPoint = False
         self.bDisableUpdate=False
         self.static_canvas=None
@@ -217,11 +219,13 @@ class Babel_Thermal(QWidget):
         
         self._bRecalculated=True
         self._ThermalResults=[]
+        self._StreamedResults={}
         if bCalcFields:
             self.thread = QThread()
             self.worker = RunThermalSim(self._MainApp)
             self.worker.moveToThread(self.thread)
             self.thread.started.connect(self.worker.run)
+            self.worker.combinationFinished.connect(self.CombinationFinished)
             self.worker.finished.connect(self.UpdateThermalResults)
             self.worker.finished.connect(self.thread.quit)
             self.worker.finished.connect(self.worker.deleteLater)
@@ -248,6 +252,12 @@ class Babel_Thermal(QWidget):
             self._MainApp.testing_error = True
             self._MainApp.Widget.tabWidget.setEnabled(True)
 
+    @Slot(int,str)
+    def CombinationFinished(self,ncomb,fname):
+        #results are loaded as soon as each combination is saved, while the others are still running
+        print('Thermal combination %i done' % (ncomb+1))
+        self._StreamedResults[ncomb]=ReadThermalResults(fname+'.h5')
+
     @Slot()
     def HideMarkChange(self,val):
         self.UpdateThermalResults()
@@ -294,7 +304,7 @@ class Babel_Thermal(QWidget):
             self._MainApp.hideClockDialog()
             self._NiftiThermalNames=[]
             self._LastTMap=-1
-            for combination in self.Config['AllDC_PRF_Duration']:
+            for ncomb,combination in enumerate(self.Config['AllDC_PRF_Duration']):
                 ThermalName=GetThermalOutName(BaseField,combination['Duration'],
                                                         combination['DurationOff'],
                                                         combination['DC'],
@@ -302,7 +312,10 @@ class Babel_Thermal(QWidget):
                                                         combination['PRF'],
                                                         combination['Repetitions'])+'.h5'
                 self._NiftiThermalNames.append(os.path.splitext(ThermalName)[0])
-                self._ThermalResults.append(ReadFromH5py(ThermalName))
+                if ncomb in self._StreamedResults:
+                    self._ThermalResults.append(self._StreamedResults.pop(ncomb))
+                else:
+                    self._ThermalResults.append(ReadThermalResults(ThermalName))
                 if self._MainApp.Config['bUseCT']:
                     self._ThermalResults[-1]['MaterialMap'][self._ThermalResults[-1]['MaterialMap']>=3]=3
             DataThermal=self._ThermalResults[self.Widget.SelCombinationDropDown.currentIndex()]
@@ -717,11 +730,21 @@ class RunThermalSim(QObject):
 
     finished = Signal()
     endError = Signal()
+    combinationFinished = Signal(int,str)
 
     def __init__(self,mainApp):
          super(RunThermalSim, self).__init__()
          self._mainApp=mainApp
 
+    def ProcessMessage(self,cMsg):
+        #returns False if the message reports an error
+        if cMsg.startswith(THERMAL_COMBINATION_DONE):
+            ncomb,fname=cMsg[len(THERMAL_COMBINATION_DONE):].strip().split(' ',1)
+            self.combinationFinished.emit(int(ncomb),fname)
+            return True
+        print(cMsg,end='')
+        return '--Babel-Brain-Low-Error' not in cMsg
+
     def run(self):
 
         case=self._mainApp.AcSim._FullSolName
@@ -732,6 +755,16 @@ class RunThermalSim(QObject):
         kargs['COMPUTING_BACKEND']=self._mainApp.Config['ComputingBackend']
         kargs['Isppa']=self._mainApp.ThermalSim.Config['BaseIsppa']
         kargs['Frequency']=self._mainApp._Frequency
+        #single focus regimes can be synthesized from one step response when set in the thermal profile, files have no dose maps
+        kargs['bThermalSuperposition']=self._mainApp.ThermalSim.Config.get('bThermalSuperposition',False)
+        #combinations solved directly are spread over all devices of the selected backend
+        kargs['ThermalDevices']=self._mainApp.Config.get('ThermalDevices',[kargs['deviceName']])
+        #number of concurrent thermal workers, None is one per device (several with the CPU backend)
+        kargs['nThermalWorkers']=self._mainApp.ThermalSim.Config.get('nThermalWorkers',None)
+        #None (as computed), 'float32' or 'int16', the GUI needs the full volumes in .h5 so the other output options are not exposed
+        kargs['OutputPrecision']=self._mainApp.ThermalSim.Config.get('OutputPrecision',None)
+        #peak temperature change (degC) between repetitions under which the remaining ones are extrapolated, None simulates all
+        kargs['RepetitionsTolerance']=self._mainApp.ThermalSim.Config.get('RepetitionsTolerance',None)
 
         kargs['TxSystem']=self._mainApp.Config['TxSystem']
         if kargs['TxSystem'] in ['CTX_500','CTX_250','DPX_500','Single','H246','BSonix']:
@@ -755,15 +788,11 @@ class RunThermalSim(QObject):
         while fieldWorkerProcess.is_alive():
             time.sleep(0.1)
             while queue.empty() == False:
-                cMsg=queue.get()
-                print(cMsg,end='')
-                if '--Babel-Brain-Low-Error' in cMsg:
+                if not self.ProcessMessage(queue.get()):
                     bNoError=False  
         fieldWorkerProcess.join()
         while queue.empty() == False:
-            cMsg=queue.get()
-            print(cMsg,end='')
-            if '--Babel-Brain-Low-Error' in cMsg:
+            if not self.ProcessMessage(queue.get()):
                 bNoError=False
         if bNoError:
             TEnd=time.time()
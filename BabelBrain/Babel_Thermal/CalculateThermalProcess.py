@@ -1,3 +1,4 @@
+import os
 import sys
 import platform
 import traceback
@@ -7,7 +8,13 @@ from scipy.io import savemat
 import numpy as np
 
 from ThermalModeling.CalculateTemperatureEffects import CalculateTemperatureEffects
+from ThermalModeling.ThermalSuperposition import ThermalSuperpositionEngine
+from ThermalModeling.ThermalOutput import ReadThermalResults
 from multiprocessing import Process,Queue
+from concurrent.futures import ProcessPoolExecutor,as_completed
+
+#marker sent through the message queue when a combination is saved, followed by its index and output name
+THERMAL_COMBINATION_DONE='--Babel-Thermal-Combination-Done'
 
 
 class InOutputWrapper(object):
@@ -36,53 +43,118 @@ class InOutputWrapper(object):
         except AttributeError:
             pass
 
-#subprocess , useful to deal with large number of cases
-def SubProcess(queueMsg,queueResult,case,deviceName,**kargs):
-    stdout = InOutputWrapper(queueMsg,True)
-    if kargs['Backend']=='CUDA':
+def InitBackend(Backend,deviceName):
+    if Backend=='CUDA':
         InitCuda(deviceName)
-    elif kargs['Backend']=='OpenCL':
+    elif Backend=='OpenCL':
         InitOpenCL(deviceName)
+    elif Backend=='CPU':
+        pass #the CPU BHTE needs no device initialization
     else:
         InitMetal(deviceName)
-    fname=CalculateTemperatureEffects(case,**kargs)
-    queueResult.put(fname)
-    
+
+def NotifyCombinationDone(queueMsg,ncomb,fname):
+    queueMsg.put('%s %i %s\n' % (THERMAL_COMBINATION_DONE,ncomb,fname))
+
+#all the combinations of a single focus case are synthesized from one step response
+def SubProcessSuperposition(queueMsg,queueResult,case,deviceName,AllDC_PRF_Duration,**kargs):
+    stdout = InOutputWrapper(queueMsg,True)
+    InitBackend(kargs['Backend'],deviceName)
+    engine=ThermalSuperpositionEngine(case,**kargs)
+    queueResult.put(engine.CalculateCombinations(AllDC_PRF_Duration,
+                        CombinationCallback=lambda ncomb,fname: NotifyCombinationDone(queueMsg,ncomb,fname)))
+
+def ReturnThermalWorkers(Backend,AllDevices,nCombinations,nThermalWorkers=None):
+    '''
+    Number of workers of the thermal pool and of CPU threads per worker. By default there is one worker per GPU device,
+    and with the CPU backend the cores are split among up to 4 workers, each running a multithreaded BHTE
+    '''
+    nCores=os.cpu_count() or 1
+    if nThermalWorkers is None:
+        if Backend=='CPU':
+            nThermalWorkers=min(4,max(1,nCores//2))
+        else:
+            nThermalWorkers=len(AllDevices)
+    nWorkers=max(1,min(nCombinations,nThermalWorkers))
+    return nWorkers,max(1,nCores//nWorkers)
+
+#long-lived workers of the thermal pool, the backend is initialized once and inputs stay resident between combinations
+_WorkerStdout=None
+def InitThermalWorker(queueMsg,Backend,queueDevices,nThreads=None):
+    global _WorkerStdout
+    _WorkerStdout = InOutputWrapper(queueMsg,True)
+    if Backend=='CPU' and nThreads is not None:
+        #CPU workers share the cores instead of each one using all of them
+        try:
+            import numba
+            numba.set_num_threads(min(nThreads,numba.config.NUMBA_NUM_THREADS))
+        except ImportError:
+            pass
+    InitBackend(Backend,queueDevices.get())
+
+def RunThermalCombination(case,**kargs):
+    return CalculateTemperatureEffects(case,bCacheInputs=True,**kargs)
 
 def CalculateThermalProcess(queueMsg,case,AllDC_PRF_Duration,**kargs):
 
     try:
-        Backend = ['CUDA','OpenCL','Metal'][kargs['COMPUTING_BACKEND']-1]
+        Backend = ['CPU','CUDA','OpenCL','Metal'][kargs['COMPUTING_BACKEND']]
         deviceName=kargs['deviceName']
         AllCases=[]
         #These fields will preseved individually per sonication regime
         lf =['MaxBrainPressure','MaxIsppa', 'MaxIspta','MonitorSlice','TI','TIC','TIS','TempProfileTarget',\
             'TimeProfileTarget','p_map_central','Isppa','Ispta','MI','DurationUS','DurationOff','DutyCycle','PRF']
         Index=[]
-        for combination in AllDC_PRF_Duration:
-            SubData={}
-
+        if type(case) is str and kargs.get('bThermalSuperposition',False):
             queueResult=Queue()
             kargsSub={}
-            kargsSub['DutyCycle']=combination['DC']
-            kargsSub['PRF']=combination['PRF']
-            kargsSub['DurationUS']=combination['Duration']
-            kargsSub['DurationOff']=combination['DurationOff']
-            kargsSub['Repetitions']=combination['Repetitions']
             kargsSub['Isppa']=kargs['Isppa']
             kargsSub['sel_p']=kargs['sel_p']
-            kargsSub['bPlot']=False
-            kargsSub['bForceRecalc']=True
             kargsSub['Backend']=Backend
             kargsSub['Frequency']=kargs['Frequency']
-            fieldWorkerProcess = Process(target=SubProcess, 
-                                    args=(queueMsg,queueResult,case,deviceName),
+            kargsSub['OutputPrecision']=kargs.get('OutputPrecision',None)
+            fieldWorkerProcess = Process(target=SubProcessSuperposition, 
+                                    args=(queueMsg,queueResult,case,deviceName,AllDC_PRF_Duration),
                                     kwargs=kargsSub)
-
             fieldWorkerProcess.start()
             fieldWorkerProcess.join()
-            fname=queueResult.get()
-            Data=ReadFromH5py(fname+'.h5')
+            AllNames=queueResult.get()
+        else:
+            #combinations are solved concurrently by a pool of persistent workers, one per device (or more if requested)
+            AllDevices=kargs.get('ThermalDevices',None) or [deviceName]
+            nWorkers,nThreads=ReturnThermalWorkers(Backend,AllDevices,len(AllDC_PRF_Duration),kargs.get('nThermalWorkers',None))
+            queueDevices=Queue()
+            for n in range(nWorkers):
+                queueDevices.put(AllDevices[n % len(AllDevices)])
+            AllNames=[None]*len(AllDC_PRF_Duration)
+            with ProcessPoolExecutor(max_workers=nWorkers,
+                                     initializer=InitThermalWorker,
+                                     initargs=(queueMsg,Backend,queueDevices,nThreads)) as pool:
+                futures={}
+                for ncomb,combination in enumerate(AllDC_PRF_Duration):
+                    kargsSub={}
+                    kargsSub['DutyCycle']=combination['DC']
+                    kargsSub['PRF']=combination['PRF']
+                    kargsSub['DurationUS']=combination['Duration']
+                    kargsSub['DurationOff']=combination['DurationOff']
+                    kargsSub['Repetitions']=combination['Repetitions']
+                    kargsSub['Isppa']=kargs['Isppa']
+                    kargsSub['sel_p']=kargs['sel_p']
+                    kargsSub['bPlot']=False
+                    kargsSub['bForceRecalc']=True
+                    kargsSub['Backend']=Backend
+                    kargsSub['Frequency']=kargs['Frequency']
+                    kargsSub['OutputPrecision']=kargs.get('OutputPrecision',None)
+                    kargsSub['RepetitionsTolerance']=kargs.get('RepetitionsTolerance',None)
+                    futures[pool.submit(RunThermalCombination,case,**kargsSub)]=ncomb
+                for future in as_completed(futures):
+                    ncomb=futures[future]
+                    AllNames[ncomb]=future.result()
+                    NotifyCombinationDone(queueMsg,ncomb,AllNames[ncomb])
+        for ncomb,combination in enumerate(AllDC_PRF_Duration):
+            SubData={}
+            fname=AllNames[ncomb]
+            Data=ReadThermalResults(fname+'.h5')
             for f in lf:
                 if 'p_map_central'==f:
                     SubData['p_map']=Data[f] #this will make it compatible for other purposes
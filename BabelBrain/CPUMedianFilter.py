@@ -0,0 +1,98 @@
+'''
+CPU median filters for label volumes based on box counts
+
+The median of a window over a volume with few distinct values is the smallest value t for which at least half
+of the window is <= t. Counts of (data<=t) over the window are separable box sums, calculated with running sums
+along each axis (parallelized with Numba), so the cost does not depend on sorting the window.
+
+    BoxCount(mask,size)                 - number of voxels of mask in each window of size^3
+    LabelMedianFilter(data,size)        - same output as scipy.ndimage.median_filter for binary or label volumes
+    HistogramMedianFilter(data,size)    - approximate median of grey-valued volumes (e.g. CT), the error is at most
+                                          half the bin width
+'''
+import numpy as np
+from numba import njit, prange
+
+@njit(cache=True)
+def _ReflectIndex(m,n):
+    #same convention as scipy.ndimage 'reflect' (d c b a | a b c d | d c b a)
+    m=m%(2*n)
+    if m>=n:
+        m=2*n-1-m
+    return m
+
+@njit(parallel=True,cache=True)
+def _BoxSumLastAxis(src,dst,r,bReflect,PadValue):
+    n0,n1,n=src.shape
+    for i in prange(n0):
+        for j in range(n1):
+            s=0
+            for m in range(-r,r+1):
+                if m>=0 and m<n:
+                    s+=src[i,j,m]
+                elif bReflect:
+                    s+=src[i,j,_ReflectIndex(m,n)]
+                else:
+                    s+=PadValue
+            dst[i,j,0]=s
+            for k in range(1,n):
+                mIn=k+r
+                mOut=k-r-1
+                if mIn<n:
+                    s+=src[i,j,mIn]
+                elif bReflect:
+                    s+=src[i,j,_ReflectIndex(mIn,n)]
+                else:
+                    s+=PadValue
+                if mOut>=0:
+                    s-=src[i,j,mOut]
+                elif bReflect:
+                    s-=src[i,j,_ReflectIndex(mOut,n)]
+                else:
+                    s-=PadValue
+                dst[i,j,k]=s
+
+def BoxCount(mask,size=7,mode='reflect',cval=0):
+    '''
+    Number of True voxels of mask in the window of size^3 centered on each voxel (uint16).
+    mode is 'reflect' or 'constant' (voxels outside are cval), as in scipy.ndimage
+    '''
+    assert(mode in ['reflect','constant'])
+    assert(size%2==1 and size**3<2**16 and mask.ndim==3)
+    r=size//2
+    bReflect=mode=='reflect'
+    A=np.ascontiguousarray(mask,dtype=np.uint16)
+    B=np.empty_like(A)
+    PadValue=int(bool(cval))
+    #one pass per axis, each pass moves the box sums from one buffer to the other
+    for axis in [2,1,0]:
+        _BoxSumLastAxis(np.moveaxis(A,axis,2),np.moveaxis(B,axis,2),r,bReflect,PadValue)
+        A,B=B,A
+        PadValue*=size
+    return A
+
+def LabelMedianFilter(data,size=7,mode='reflect',cval=0):
+    '''
+    Median filter of a binary or label volume, identical to scipy.ndimage.median_filter(data,size,mode=mode,cval=cval).
+    The cost grows with the number of distinct values, so it is meant for volumes with a few labels
+    '''
+    Labels=np.unique(data)
+    Half=(size**3+1)//2
+    out=np.full(data.shape,Labels[-1],dtype=data.dtype)
+    #from the largest label down, the smallest label with at least half the window <= label is the median
+    for t in Labels[-2::-1]:
+        out[BoxCount(data<=t,size,mode,cval<=t)>=Half]=t
+    return out
+
+def HistogramMedianFilter(data,size=7,nBins=64,mode='reflect',cval=0):
+    '''
+    Approximate median filter of a grey-valued volume. Values are quantized in nBins uniform bins, the median of
+    the bin indexes is exact and it is returned as the center of its bin, so the error is at most half the bin width.
+    Returns the filtered volume (float32) and the error bound
+    '''
+    vmin=min(float(data.min()),float(cval) if mode=='constant' else np.inf)
+    vmax=max(float(data.max()),float(cval) if mode=='constant' else -np.inf)
+    BinWidth=max(vmax-vmin,1e-12)/nBins
+    Quantize=lambda v: np.clip(np.floor((v-vmin)/BinWidth),0,nBins-1).astype(np.uint16)
+    Bins=LabelMedianFilter(Quantize(data),size,mode,int(Quantize(np.array(cval))))
+    return (vmin+(Bins.astype(np.float32)+0.5)*BinWidth).astype(np.float32),BinWidth/2
@@ -0,0 +1,224 @@
+'''
+CPU solid voxelization of closed triangular meshes
+
+Rays are cast along the third axis of the target grid through the center of each voxel column and a voxel is
+marked when its center is inside the mesh (even-odd rule), the same criterion of the GPU voxelizer.
+Rows along the first axis are processed in parallel with Numba.
+
+    VoxelizeToGrid(mesh,shape,affine)   - uint8 mask written directly in a grid with an arbitrary affine (voxel to world)
+    ClipMeshToGrid(mesh,shape,affine)   - closed mesh cut, with caps, to the box of a grid
+    PointsToGrid(points,affine,mask)    - voxels of a grid nearest to a list of points (e.g. from the GPU voxelizer)
+    Voxelize(mesh,targetResolution)     - list of Cartesian points of the inside voxels, same output as GPU Voxelize
+    VoxelizeToGridNearest(mesh,mask,affine,targetResolution) - same as PointsToGrid(Voxelize(...)), without the whole point cloud
+'''
+import numpy as np
+import trimesh
+from numba import njit, prange
+
+#rays are slightly offset from voxel centers so they never cross triangle edges or vertices exactly
+RAY_OFFSET_I=1.31e-6
+RAY_OFFSET_J=2.73e-6
+
+@njit(cache=True)
+def _TriangleRowRange(tri,N1):
+    imin=min(tri[0,0],min(tri[1,0],tri[2,0]))
+    imax=max(tri[0,0],max(tri[1,0],tri[2,0]))
+    i0=max(int(np.ceil(imin-RAY_OFFSET_I)),0)
+    i1=min(int(np.floor(imax-RAY_OFFSET_I)),N1-1)
+    return i0,i1
+
+@njit(cache=True)
+def _RayHit(tri,ri,rj):
+    #returns the depth along the third axis where the ray (ri,rj) crosses the triangle, or nan
+    ai=tri[0,0]-ri
+    aj=tri[0,1]-rj
+    bi=tri[1,0]-ri
+    bj=tri[1,1]-rj
+    ci=tri[2,0]-ri
+    cj=tri[2,1]-rj
+    w0=bi*cj-bj*ci
+    w1=ci*aj-cj*ai
+    w2=ai*bj-aj*bi
+    if (w0>0 and w1>0 and w2>0) or (w0<0 and w1<0 and w2<0):
+        s=w0+w1+w2
+        return (w0*tri[0,2]+w1*tri[1,2]+w2*tri[2,2])/s
+    return np.nan
+
+@njit(cache=True)
+def _CountRowTriangles(Triangles,N1):
+    Count=np.zeros(N1,np.int64)
+    for n in range(Triangles.shape[0]):
+        i0,i1=_TriangleRowRange(Triangles[n],N1)
+        for i in range(i0,i1+1):
+            Count[i]+=1
+    return Count
+
+@njit(cache=True)
+def _FillRowTriangles(Triangles,N1,Start):
+    Pos=Start[:-1].copy()
+    RowTriangles=np.zeros(Start[-1],np.int64)
+    for n in range(Triangles.shape[0]):
+        i0,i1=_TriangleRowRange(Triangles[n],N1)
+        for i in range(i0,i1+1):
+            RowTriangles[Pos[i]]=n
+            Pos[i]+=1
+    return RowTriangles
+
+@njit(parallel=True,cache=True)
+def _VoxelizeRows(Triangles,Start,RowTriangles,Mask,Value):
+    N1,N2,N3=Mask.shape
+    for i in prange(N1):
+        ri=i+RAY_OFFSET_I
+        nTri=Start[i+1]-Start[i]
+        if nTri==0:
+            continue
+        #first pass to count crossings in this row
+        nHits=0
+        for m in range(Start[i],Start[i+1]):
+            tri=Triangles[RowTriangles[m]]
+            jmin=min(tri[0,1],min(tri[1,1],tri[2,1]))
+            jmax=max(tri[0,1],max(tri[1,1],tri[2,1]))
+            for j in range(max(int(np.ceil(jmin-RAY_OFFSET_J)),0),min(int(np.floor(jmax-RAY_OFFSET_J)),N2-1)+1):
+                if not np.isnan(_RayHit(tri,ri,j+RAY_OFFSET_J)):
+                    nHits+=1
+        if nHits==0:
+            continue
+        HitJ=np.zeros(nHits,np.int64)
+        HitK=np.zeros(nHits,np.float64)
+        nHits=0
+        for m in range(Start[i],Start[i+1]):
+            tri=Triangles[RowTriangles[m]]
+            jmin=min(tri[0,1],min(tri[1,1],tri[2,1]))
+            jmax=max(tri[0,1],max(tri[1,1],tri[2,1]))
+            for j in range(max(int(np.ceil(jmin-RAY_OFFSET_J)),0),min(int(np.floor(jmax-RAY_OFFSET_J)),N2-1)+1):
+                k=_RayHit(tri,ri,j+RAY_OFFSET_J)
+                if not np.isnan(k):
+                    HitJ[nHits]=j
+                    HitK[nHits]=min(max(k,-1.0),N3+1.0)
+                    nHits+=1
+        #sort crossings by column and then depth, and fill between pairs
+        Key=HitJ*(N3+4.0)+HitK+2.0
+        Order=np.argsort(Key)
+        n=0
+        while n<nHits:
+            j=HitJ[Order[n]]
+            nEnd=n
+            while nEnd<nHits and HitJ[Order[nEnd]]==j:
+                nEnd+=1
+            #an odd number of crossings (open mesh) leaves the last one unpaired and ignored
+            for p in range(n,nEnd-1,2):
+                k0=max(int(np.ceil(HitK[Order[p]])),0)
+                k1=min(int(np.floor(HitK[Order[p+1]])),N3-1)
+                for k in range(k0,k1+1):
+                    Mask[i,j,k]=Value
+            n=nEnd
+
+def VoxelizeToGrid(inputMesh,shape,affine,Mask=None,Value=1):
+    '''
+    Voxelize a closed mesh in a grid of given shape and affine (voxel indexes to mesh coordinates).
+    If Mask (uint8) is given, voxels inside the mesh are set to Value in it, otherwise a new mask is returned
+    '''
+    if Mask is None:
+        Mask=np.zeros(shape,np.uint8)
+    assert(Mask.shape==tuple(shape) and Mask.dtype==np.uint8 and Mask.flags.c_contiguous)
+    InvAffine=np.linalg.inv(affine)
+    Vertices=np.asarray(inputMesh.vertices,np.float64)
+    Vertices=Vertices@InvAffine[:3,:3].T+InvAffine[:3,3]
+    Triangles=np.ascontiguousarray(Vertices[np.asarray(inputMesh.faces)])
+    Count=_CountRowTriangles(Triangles,shape[0])
+    Start=np.zeros(shape[0]+1,np.int64)
+    Start[1:]=np.cumsum(Count)
+    RowTriangles=_FillRowTriangles(Triangles,shape[0],Start)
+    _VoxelizeRows(Triangles,Start,RowTriangles,Mask,np.uint8(Value))
+    return Mask
+
+def ClipMeshToGrid(inputMesh,shape,affine,Padding=1):
+    '''
+    Return the part of a closed mesh inside the box of a grid (plus Padding voxels), cut with closed caps by the six planes of the box.
+    Points of the box are inside the clipped mesh if and only if they are inside the original one, so voxelizing the clipped mesh
+    gives the same voxels in the grid while the work scales with the region covered by the grid
+    '''
+    InvAffine=np.linalg.inv(affine)
+    Clipped=inputMesh
+    for axis in range(3):
+        for sign,index in [(1.0,-0.5-Padding),(-1.0,shape[axis]-0.5+Padding)]:
+            #half space index_axis>=index (sign 1) or <=index (sign -1), in world coordinates
+            Normal=sign*InvAffine[axis,:3]
+            Origin=affine[:3,axis]*index+affine[:3,3]
+            Clipped=trimesh.intersections.slice_mesh_plane(Clipped,Normal/np.linalg.norm(Normal),Origin,cap=True)
+            #the triangulation of caps can leave faces with a repeated vertex that break the closed surface
+            Faces=np.asarray(Clipped.faces)
+            Clipped.update_faces((Faces[:,0]!=Faces[:,1])&(Faces[:,1]!=Faces[:,2])&(Faces[:,0]!=Faces[:,2]))
+            if len(Clipped.faces)==0:
+                return Clipped
+    print('Faces kept after clipping to grid',Clipped.faces.shape[0],'of',inputMesh.faces.shape[0])
+    return Clipped
+
+def PointsToGrid(Points,affine,Mask,Value=1):
+    '''
+    Set to Value the voxels of Mask (grid with affine voxel to world) nearest to a list of Cartesian points,
+    points outside the grid are ignored
+    '''
+    InvAffine=np.linalg.inv(affine).astype(Points.dtype)
+    IJK=np.round(Points@InvAffine[:3,:3].T+InvAffine[:3,3]).astype(np.int64)
+    IJK=IJK[np.all((IJK>=0)&(IJK<np.array(Mask.shape)),axis=1)]
+    Mask[IJK[:,0],IJK[:,1],IJK[:,2]]=Value
+    return Mask
+
+def _SamplingGrid(Bounds,targetResolution):
+    #grid of Voxelize, it covers the bounding box of the mesh with steps close to targetResolution
+    dims=np.diff(Bounds,axis=0).flatten()
+    gridsize=np.ceil(dims/targetResolution).astype(int)
+    dxzy=dims/gridsize
+    return gridsize,dxzy
+
+def Voxelize(inputMesh,targetResolution=1333/500e3/6*0.75*1e3):
+    '''
+    Cartesian coordinates (float32) of the voxels inside the mesh, using the same grid of the GPU Voxelize
+    '''
+    r=inputMesh.bounding_box.bounds
+    gridsize,dxzy=_SamplingGrid(r,targetResolution)
+    print('CPU Voxelizing # triangles', inputMesh.faces.shape[0])
+    print('spatial step and  maximal grid dimensions',dxzy,*gridsize)
+    affine=np.eye(4)
+    affine[:3,:3]=np.diag(dxzy)
+    affine[:3,3]=r[0,:]+dxzy/2
+    Mask=VoxelizeToGrid(inputMesh,tuple(gridsize),affine)
+    Points=np.argwhere(Mask).astype(np.float32)
+    print('totalPoints',Points.shape[0])
+    Points+=0.5
+    Points*=dxzy.astype(np.float32)
+    Points+=r[0,:].astype(np.float32)
+    return Points
+
+def VoxelizeToGridNearest(inputMesh,Mask,affine,targetResolution,Value=1,GridBounds=None,ChunkPlanes=64):
+    '''
+    Set to Value the voxels of Mask (grid with affine voxel to world) nearest to the points of Voxelize(inputMesh,targetResolution),
+    with the same result as PointsToGrid but processing the points in chunks of planes. The sampling grid covers GridBounds
+    (by default the bounds of inputMesh), so a clipped mesh is sampled at the same points as the full one
+    '''
+    r=inputMesh.bounding_box.bounds if GridBounds is None else np.asarray(GridBounds)
+    gridsize,dxzy=_SamplingGrid(r,targetResolution)
+    #only the part of the sampling grid covering inputMesh is voxelized
+    MeshBounds=inputMesh.bounds
+    Lower=np.maximum(np.floor((MeshBounds[0]-r[0])/dxzy-0.5).astype(int),0)
+    Upper=np.minimum(np.ceil((MeshBounds[1]-r[0])/dxzy-0.5).astype(int)+1,gridsize)
+    if np.any(Upper<=Lower):
+        return Mask
+    SubAffine=np.eye(4)
+    SubAffine[:3,:3]=np.diag(dxzy)
+    SubAffine[:3,3]=r[0,:]+dxzy*(Lower+0.5)
+    SubMask=VoxelizeToGrid(inputMesh,tuple(Upper-Lower),SubAffine)
+    #points are calculated as in Voxelize, in single precision
+    dxzy32=dxzy.astype(np.float32)
+    r32=r[0,:].astype(np.float32)
+    for i0 in range(0,SubMask.shape[0],ChunkPlanes):
+        IJK=np.argwhere(SubMask[i0:i0+ChunkPlanes])
+        IJK[:,0]+=i0
+        IJK+=Lower
+        Points=IJK.astype(np.float32)
+        Points+=0.5
+        Points*=dxzy32
+        Points+=r32
+        PointsToGrid(Points,affine,Mask,Value)
+    return Mask
@@ -1,4 +1,5 @@
 import sys
+import os
 import platform
 import traceback
 import numpy as np
@@ -59,11 +60,18 @@ def CalculateFieldProcess(queue,Target,TxSystem,**kargs):
             stdout = InOutputWrapper(queue,True)
     else:
         stdout = InOutputWrapper(queue,True)
+    #results are recovered from a cache in the subject directory if masks, CT, parameters and code are unchanged,
+    #bForceRecalc only skips the recovery
+    kargs.setdefault('AcousticCacheDir',os.path.join(kargs['basedir'],kargs['ID'],'AcousticCache'))
+    bForceRecalc=kargs.pop('bForceRecalc',False)
+    if kargs.get('MultiPoint',None) is not None:
+        #mask loading and saving of results of a point overlap with the simulations of the other points
+        kargs.setdefault('nCaseWorkers',1)
     try:
         R=RUN_SIM()
         FilesSkull=R.RunCases(targets=Target, 
                         bTightNarrowBeamDomain=True,
-                        bForceRecalc=True,
+                        bForceRecalc=bForceRecalc,
                         bDisplay=False,
                         **kargs)
         bDryRun = False
@@ -77,7 +85,7 @@ def CalculateFieldProcess(queue,Target,TxSystem,**kargs):
                     kargs['XSteering']=1e-6
             FilesWater=R.RunCases(targets=Target, 
                             bTightNarrowBeamDomain=True,
-                            bForceRecalc=True,
+                            bForceRecalc=bForceRecalc,
                             bWaterOnly=True,
                             bDisplay=False,
                             **kargs)
@@ -87,7 +95,7 @@ def CalculateFieldProcess(queue,Target,TxSystem,**kargs):
                 kargs['bDryRun'] = True
                 FilesWater=R.RunCases(targets=Target, 
                             bTightNarrowBeamDomain=True,
-                            bForceRecalc=True,
+                            bForceRecalc=bForceRecalc,
                             bWaterOnly=True,
                             bDisplay=False,
                             **kargs)
@@ -123,7 +131,7 @@ def CalculateFieldProcess(queue,Target,TxSystem,**kargs):
             kargs['bDryRun'] = True
             FilesWater=R.RunCases(targets=Target, 
                             bTightNarrowBeamDomain=True,
-                            bForceRecalc=True,
+                            bForceRecalc=bForceRecalc,
                             bWaterOnly=True,
                             bDisplay=False,
                             **kargs)
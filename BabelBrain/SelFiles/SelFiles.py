@@ -200,6 +200,14 @@ class SelFiles(QDialog):
     def GetSelectedComputingEngine(self):
         index = self.ui.ComputingEnginecomboBox.currentIndex()
         return self._GPUs[index]
+
+    def GetDevicesForBackend(self,Backend):
+        #all available devices of a backend, the selected one first
+        ComputingDevice=self.GetSelectedComputingEngine()[0]
+        if ComputingDevice=='CPU':
+            return ['CPU']
+        AllDevices=[dev[0] for dev in self._GPUs if dev[1]==Backend]
+        return [ComputingDevice]+[dev for dev in AllDevices if dev!=ComputingDevice]
             
 
     def GetAvailableGPUs(self):
@@ -33,6 +33,7 @@ from datetime import datetime
 import time
 import yaml
 from BabelViscoFDTD.H5pySimple import ReadFromH5py, SaveToH5py
+from TranscranialModeling.DataForSimH5 import ReadDataForSim
 from GUIComponents.ScrollBars import ScrollBars as WidgetScrollBars
 
 from CalculateFieldProcess import CalculateFieldProcess
@@ -137,7 +138,7 @@ class BabelBasePhaseArray(BabelBaseTx):
             
         if bPrexistingFiles:
             #we can use the first entry, this is valid for all files in the list
-            Skull=ReadFromH5py(self._FullSolName[0])
+            Skull=ReadDataForSim(self._FullSolName[0])
             XSteering=Skull['XSteering']
             YSteering=Skull['YSteering']
             ZSteering=Skull['ZSteering']
@@ -243,8 +244,8 @@ class BabelBasePhaseArray(BabelBaseTx):
             self._MainApp.ThermalSim.setEnabled(True)
             
             for fwater,fskull in zip(self._WaterSolName,self._FullSolName):
-                Skull=ReadFromH5py(fskull)
-                Water=ReadFromH5py(fwater)
+                Skull=ReadDataForSim(fskull)
+                Water=ReadDataForSim(fwater)
     
                 if Skull['bDoRefocusing']:
                     SelP='p_amp_refocus'
@@ -254,8 +255,7 @@ class BabelBasePhaseArray(BabelBaseTx):
                 for t in [SelP,'MaterialMap']:
                     Skull[t]=np.ascontiguousarray(np.flip(Skull[t],axis=2))
 
-                for t in ['p_amp','MaterialMap']:
-                    Water[t]=np.ascontiguousarray(np.flip(Water[t],axis=2))
+                Water['p_amp']=np.ascontiguousarray(np.flip(Water['p_amp'],axis=2))
                 Water['p_amp'][:,:,0]=0.0
                 
                 entry={'Skull':Skull,'Water':Water}
@@ -6,6 +6,7 @@ from PySide6.QtWidgets import QWidget, QVBoxLayout,QMessageBox
 from PySide6.QtCore import Slot
 from PySide6.QtGui import QPalette
 from BabelViscoFDTD.H5pySimple import ReadFromH5py
+from TranscranialModeling.DataForSimH5 import ReadDataForSim
 
 import numpy as np
 import os
@@ -136,8 +137,8 @@ class BabelBaseTx(QWidget):
                 self.Widget.HideMarkscheckBox.setEnabled(True)
             self._MainApp.Widget.tabWidget.setEnabled(True)
             self._MainApp.ThermalSim.setEnabled(True)
-            Water=ReadFromH5py(self._WaterSolName)
-            Skull=ReadFromH5py(self._FullSolName)
+            Water=ReadDataForSim(self._WaterSolName)
+            Skull=ReadDataForSim(self._FullSolName)
 
             extrasuffix=self.GetExtraSuffixAcFields()
 
@@ -148,8 +149,9 @@ class BabelBaseTx(QWidget):
             LocTarget=Skull['TargetLocation']
             print(LocTarget)
 
-            for d in [Water,Skull]:
-                for t in ['p_amp','MaterialMap']:
+            #the material map of the water simulation is not used, so it is never read from disk
+            for d,keys in [(Water,['p_amp']),(Skull,['p_amp','MaterialMap'])]:
+                for t in keys:
                     d[t]=np.ascontiguousarray(np.flip(d[t],axis=2))
 
             DistanceToTarget=self.Widget.DistanceSkinLabel.property('UserData')
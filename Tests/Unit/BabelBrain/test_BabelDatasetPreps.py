@@ -2,8 +2,13 @@ import os
 import sys
 sys.path.append('.BabelBrain')
 import logging
+import time
 
+import numpy as np
 import pytest
+from scipy import ndimage
+import trimesh
+from trimesh import creation
 
 import BabelDatasetPreps as bdp
 
@@ -83,4 +88,246 @@ class TestBabelDatasetPreps:
             bdp.DoIntersect(input_data['skin'],input_data['cone'])
 
         logging.info(exc_info)
-        assert str(exc_info.value) == "Trajectory is outside headspace", "Test did not result in error when it should have."
\ No newline at end of file
+        assert str(exc_info.value) == "Trajectory is outside headspace", "Test did not result in error when it should have."
+
+    @pytest.mark.parametrize('bBox',[False,True])
+    def test_fov_mask_matches_intersection(self,bBox):
+        # Synthetic head (sphere) and transducer cone/box built as in GetSkullMaskFromSimbNIBSSTL
+        SpatialStep=1.0
+        head=creation.icosphere(subdivisions=4,radius=40.0)
+        RMat=trimesh.transformations.rotation_matrix(0.4,[1,0.3,0])[:3,:3]
+        Location=np.array([3.0,-2.0,5.0])-RMat[:,2]*45
+        RadCone=25.0
+        HeightCone=np.sqrt(60.0**2-RadCone**2)
+        DimsBox=np.array([50.0,50.0,70.0])
+        Transformation=np.eye(4)
+        Transformation[:3,:3]=RMat
+        Transformation[:3,3]=Location
+        if bBox:
+            FOV=creation.box(DimsBox,transform=Transformation)
+        else:
+            TransformationCone=np.eye(4)
+            TransformationCone[2,2]=-1
+            TransformationCone[2,3]=HeightCone
+            FOV=creation.cone(RadCone,HeightCone,transform=TransformationCone)
+            FOV.apply_transform(Transformation)
+
+        # Beam-aligned grid covering the head
+        affine=np.eye(4)
+        affine[:3,:3]=RMat*SpatialStep
+        HeadIJK=head.vertices@np.linalg.inv(affine[:3,:3]).T
+        affine[:3,3]=affine[:3,:3]@np.floor(HeadIJK.min(axis=0))
+        shape=tuple((np.ceil(HeadIJK.max(axis=0))-np.floor(HeadIJK.min(axis=0))).astype(int)+1)
+
+        # CSG reference and analytic FOV mask applied to the voxelized head
+        Truth=bdp.CPUVoxelize.VoxelizeToGrid(bdp.DoIntersect(head,FOV),shape,affine)>0
+        if bBox:
+            FOVMask=bdp.ReturnFOVMask(shape,affine,Location,RMat,DimsBox=DimsBox,ChunkSize=7)
+        else:
+            FOVMask=bdp.ReturnFOVMask(shape,affine,Location,RMat,RadCone=RadCone,HeightCone=HeightCone,ChunkSize=7)
+        Result=(bdp.CPUVoxelize.VoxelizeToGrid(head,shape,affine)>0) & FOVMask
+
+        assert Truth.sum()>1000
+        # Differences are only allowed within one voxel of the boundary of the CSG result
+        Boundary=ndimage.binary_dilation(Truth,np.ones((3,3,3),bool)) & ~ndimage.binary_erosion(Truth,np.ones((3,3,3),bool))
+        assert np.all(Boundary[Result!=Truth])
+        assert abs(int(Result.sum())-int(Truth.sum()))/Truth.sum() < 0.05
+
+    @staticmethod
+    def _synthetic_head_grid(SpatialStep):
+        # skin, skull shell and brain as nested spheres, with a rotated grid covering part of the head
+        skull_outer=creation.icosphere(4,radius=76)
+        skull_inner=creation.icosphere(4,radius=70)
+        skull=trimesh.Trimesh(np.vstack((skull_outer.vertices,skull_inner.vertices)),
+                              np.vstack((skull_outer.faces,skull_inner.faces[:,::-1]+len(skull_outer.vertices))),process=False)
+        Meshes={1:creation.icosphere(4,radius=80),2:skull,4:creation.icosphere(4,radius=68)}
+        affine=np.eye(4)
+        affine[:3,:3]=trimesh.transformations.rotation_matrix(0.4,[1,0.3,0])[:3,:3]*SpatialStep
+        affine[:3,3]=affine[:3,:3]@np.array([-30,-30,-85])/SpatialStep
+        shape=tuple((np.array([60,60,60])/SpatialStep).astype(int))
+        return Meshes,shape,affine
+
+    @pytest.mark.parametrize('SpatialStep',[1.0,0.6])
+    def test_voxelize_to_mask_same_rule_in_both_backends(self,SpatialStep,monkeypatch):
+        Meshes,shape,affine=self._synthetic_head_grid(SpatialStep)
+        # previous mask path, point cloud at 0.75 of the step mapped to the nearest voxels
+        Truth=np.zeros(shape,np.uint8)
+        for Value,mesh in Meshes.items():
+            bdp.CPUVoxelize.PointsToGrid(bdp.CPUVoxelize.Voxelize(mesh,SpatialStep*0.75),affine,Truth,Value)
+        assert all(np.any(Truth==Value) for Value in Meshes)
+
+        def ReturnMask(bClipToGrid):
+            Mask=np.zeros(shape,np.uint8)
+            for Value,mesh in Meshes.items():
+                bdp.VoxelizeToMask(mesh,Mask,affine,SpatialStep,Value=Value,bClipToGrid=bClipToGrid and Value>1)
+            return Mask
+        monkeypatch.setattr(bdp,'VoxelizeFilter',None)
+        assert np.array_equal(ReturnMask(False),Truth)
+        # clipped meshes are sampled at the same points on the CPU
+        assert np.array_equal(ReturnMask(True),Truth)
+
+        # the GPU voxelizer samples the same grid of the mesh bounding box
+        Calls=[]
+        def GPUVoxelize(mesh,targetResolution=1.0,GPUBackend=''):
+            Calls.append(len(mesh.faces))
+            return bdp.CPUVoxelize.Voxelize(mesh,targetResolution)
+        monkeypatch.setattr(bdp,'VoxelizeFilter',GPUVoxelize)
+        assert np.array_equal(ReturnMask(False),Truth)
+        Calls.clear()
+        Clipped=ReturnMask(True)
+        # clipped meshes are smaller, their sampling grid starts at the box of the grid so labels only change on boundaries
+        assert Calls[1]<Meshes[2].faces.shape[0]
+        Cube=np.ones((3,3,3),bool)
+        for Value in [2,4]:
+            a=Clipped==Value
+            b=Truth==Value
+            Boundary=ndimage.binary_dilation(b,Cube) & ~ndimage.binary_erosion(b,Cube)
+            assert not np.any((a!=b) & ~Boundary)
+            assert abs(int(a.sum())-int(b.sum()))<0.03*b.sum()
+
+    @staticmethod
+    def _synthetic_quantized_ct(shape,spatial_step,CT_quantification=10,seed=0):
+        # Skull shell of random HU, quantized as in GetSkullMaskFromSimbNIBSSTL
+        rng=np.random.default_rng(seed)
+        z,y,x=np.ogrid[:shape[0],:shape[1],:shape[2]]
+        center=np.array(shape)/2
+        r=np.sqrt((z-center[0])**2+(y-center[1])**2+(x-center[2])**2)*spatial_step
+        nfct=(r>60)&(r<67)
+        ndataCT=np.zeros(shape,np.float32)
+        ndataCT[nfct]=rng.uniform(300,2100,nfct.sum())
+        minData=ndataCT[nfct].min()
+        A=ndataCT[nfct].max()-minData
+        M=2**CT_quantification-1
+        ndataCT[nfct]=A/M*np.round((M/A)*(ndataCT[nfct]-minData))+minData
+        return ndataCT,nfct
+
+    @staticmethod
+    def _map_unique_hu_per_value(ndataCT,nfct):
+        # Previous CPU mapping, one comparison of the whole volume per unique value
+        UniqueHU=np.unique(ndataCT[nfct])
+        ndataCTMap=np.zeros(ndataCT.shape,np.uint32)
+        for n,d in enumerate(UniqueHU):
+            ndataCTMap[ndataCT==d]=n
+        ndataCTMap[nfct==False]=0
+        return UniqueHU,ndataCTMap
+
+    def test_map_unique_hu_matches_per_value_mapping(self):
+        ndataCT,nfct=self._synthetic_quantized_ct((60,64,58),3.0)
+        TruthHU,TruthMap=self._map_unique_hu_per_value(ndataCT,nfct)
+        UniqueHU,ndataCTMap=bdp.MapUniqueHU(ndataCT,nfct)
+
+        assert len(UniqueHU)==1024
+        assert np.array_equal(UniqueHU,TruthHU)
+        assert ndataCTMap.dtype==TruthMap.dtype
+        assert np.array_equal(ndataCTMap,TruthMap)
+
+    @pytest.mark.slow
+    @pytest.mark.parametrize('spatial_step,shape',[(1.0,(150,150,150)),(0.3,(440,440,440))],ids=['1mm','0p3mm'])
+    def test_map_unique_hu_benchmark(self,spatial_step,shape):
+        ndataCT,nfct=self._synthetic_quantized_ct(shape,spatial_step)
+
+        t0=time.time()
+        TruthHU,TruthMap=self._map_unique_hu_per_value(ndataCT,nfct)
+        time_per_value=time.time()-t0
+        del TruthHU
+        t0=time.time()
+        UniqueHU,ndataCTMap=bdp.MapUniqueHU(ndataCT,nfct)
+        time_single_pass=time.time()-t0
+
+        logging.info(f"{spatial_step} mm grid {shape}, {nfct.sum()} bone voxels, {len(UniqueHU)} unique values: "
+                     f"per value {time_per_value:.3f} s, single pass {time_single_pass:.3f} s")
+        assert np.array_equal(ndataCTMap,TruthMap)
+        assert time_single_pass<time_per_value
+
+
+    @staticmethod
+    def _mask_to_stl_file_round_trip(binmask,affine,tmpdirname):
+        # Previous MaskToStl, the smoothed surface was passed through VTK and STL files
+        import vtk
+        import pyvista as pv
+        surface=pv.wrap(binmask.astype(np.float32)).contour(isosurfaces=np.array([0.9]))
+        surface.save(tmpdirname+os.sep+'__t.vtk')
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(tmpdirname+os.sep+'__t.vtk')
+        reader.ReadAllFieldsOn()
+        reader.Update()
+        writer = vtk.vtkSTLWriter()
+        writer.SetInputData(bdp.smooth(reader.GetOutput()))
+        writer.SetFileName(tmpdirname+os.sep+'__t.stl')
+        writer.SetFileTypeToBinary()
+        writer.Write()
+        meshsurface=trimesh.load_mesh(tmpdirname+os.sep+'__t.stl')
+        meshsurface.vertices=(affine[:3,:3]@meshsurface.vertices.T).T+affine[:3,3]
+        return meshsurface
+
+    @staticmethod
+    def _canonical_mesh(mesh):
+        # sorted vertices and faces, with each face rotated to start at its lowest vertex to keep the orientation
+        vertices,inverse=np.unique(mesh.vertices,axis=0,return_inverse=True)
+        faces=inverse.reshape(-1)[mesh.faces]
+        first=np.argmin(faces,axis=1)
+        faces=np.stack([faces[np.arange(len(faces)),(first+s)%3] for s in range(3)],axis=1)
+        return vertices,faces[np.lexsort(faces.T[::-1])]
+
+    def test_mask_to_stl_matches_file_round_trip(self,tmp_path):
+        i,j,k=np.meshgrid(*[np.arange(n) for n in (40,36,44)],indexing='ij')
+        mask=((i-20)**2/300+(j-18)**2/200+(k-22)**2/350<1)&~(((i-20)**2+(j-18)**2+(k-22)**2)<40)
+        affine=np.array([[0.9,0.1,0,-20],[0,1.1,0.05,5],[0,0,1.0,30],[0,0,0,1.]])
+        Truth=self._mask_to_stl_file_round_trip(mask,affine,str(tmp_path))
+        Mesh=bdp.MaskToStl(mask,affine)
+        # same surface, vertices are only numbered differently
+        for a,b in zip(self._canonical_mesh(Mesh),self._canonical_mesh(Truth)):
+            assert np.array_equal(a,b)
+
+    @staticmethod
+    def _save_charm_phantom(fname,Radius=20):
+        # concentric skin, bone and CSF labels as in final_tissues.nii.gz
+        import nibabel
+        i,j,k=np.meshgrid(*[np.arange(n) for n in (48,46,50)],indexing='ij')
+        r=np.sqrt((i-24)**2+(j-23)**2+(k-25)**2)
+        labels=np.zeros(r.shape,np.uint16)
+        labels[r<Radius]=5
+        labels[r<Radius-3]=7
+        labels[r<Radius-6]=3
+        nibabel.save(nibabel.Nifti1Image(labels[:,:,:,None],np.diag([1.0,1.0,1.0,1.0])),fname)
+
+    def test_charm_surface_cache(self,tmp_path,monkeypatch):
+        charminput=str(tmp_path/'final_tissues.nii.gz')
+        self._save_charm_phantom(charminput)
+        Calls=[]
+        MaskToStl=bdp.MaskToStl
+        monkeypatch.setattr(bdp,'MaskToStl',lambda *args: Calls.append(1) or MaskToStl(*args))
+        monkeypatch.setattr(bdp,'_CharmMeshCache',{})
+
+        Meshes=bdp.GetCharmSurfaceMeshes(charminput,str(tmp_path))
+        assert len(Calls)==3
+        CacheFiles=list(tmp_path.glob('charm_surfaces_*.npz'))
+        assert len(CacheFiles)==1
+        assert all(m.body_count==1 for m in Meshes)
+
+        def check_same(Cached):
+            for a,b in zip(Cached,Meshes):
+                assert np.array_equal(a.vertices,b.vertices) and np.array_equal(a.faces,b.faces)
+        # memory hit
+        check_same(bdp.GetCharmSurfaceMeshes(charminput,str(tmp_path)))
+        assert len(Calls)==3
+        # file hit
+        bdp._CharmMeshCache.clear()
+        check_same(bdp.GetCharmSurfaceMeshes(charminput,str(tmp_path)))
+        assert len(Calls)==3
+        # forced recalculation
+        check_same(bdp.GetCharmSurfaceMeshes(charminput,str(tmp_path),bForceRecalculation=True))
+        assert len(Calls)==6
+        # corrupted file
+        bdp._CharmMeshCache.clear()
+        CacheFiles[0].write_bytes(b'corrupted')
+        check_same(bdp.GetCharmSurfaceMeshes(charminput,str(tmp_path)))
+        assert len(Calls)==9
+        # a new segmentation replaces the cache file of the previous one
+        self._save_charm_phantom(charminput,Radius=18)
+        NewMeshes=bdp.GetCharmSurfaceMeshes(charminput,str(tmp_path))
+        assert len(Calls)==12
+        assert NewMeshes[0].vertices.shape!=Meshes[0].vertices.shape
+        NewCacheFiles=list(tmp_path.glob('charm_surfaces_*.npz'))
+        assert len(NewCacheFiles)==1 and NewCacheFiles[0]!=CacheFiles[0]
+        assert len(bdp._CharmMeshCache)<=bdp.MaxCharmMeshCache
@@ -0,0 +1,34 @@
+import sys
+sys.path.append('BabelBrain')
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import CPUMedianFilter
+
+def _Volume(shape,seed=0):
+    rng=np.random.default_rng(seed)
+    return ndimage.gaussian_filter(rng.random(shape),1.5)
+
+@pytest.mark.parametrize('shape',[(24,21,19),(5,9,30)])
+@pytest.mark.parametrize('mode',['reflect','constant'])
+def test_LabelMedianFilter_binary_matches_scipy(shape,mode):
+    Mask=_Volume(shape)>0.5
+    Truth=ndimage.median_filter(Mask,7,mode=mode,cval=0)
+    Result=CPUMedianFilter.LabelMedianFilter(Mask,7,mode=mode,cval=0)
+    assert Result.dtype==Truth.dtype
+    assert np.array_equal(Result,Truth)
+
+@pytest.mark.parametrize('mode',['reflect','constant'])
+def test_LabelMedianFilter_labels_matches_scipy(mode):
+    # Labels as in the final mask (skin, skull, brain)
+    Labels=np.random.default_rng(1).choice(np.array([0,1,2,4],np.uint8),(20,18,22))
+    Truth=ndimage.median_filter(Labels,7,mode=mode)
+    assert np.array_equal(CPUMedianFilter.LabelMedianFilter(Labels,7,mode=mode),Truth)
+
+def test_HistogramMedianFilter_error_bound():
+    CT=(_Volume((24,21,19),2)*3000-500).astype(np.float32)
+    Truth=ndimage.median_filter(CT,7)
+    Result,ErrorBound=CPUMedianFilter.HistogramMedianFilter(CT,7,nBins=64)
+    assert np.abs(Result-Truth).max()<=ErrorBound*(1+1e-5)
@@ -0,0 +1,91 @@
+import sys
+sys.path.append('BabelBrain')
+
+import numpy as np
+import pytest
+import trimesh
+from scipy import ndimage
+
+import CPUVoxelize
+
+def _TestMeshes():
+    rot=trimesh.transformations.rotation_matrix(0.4,[1,2,3])
+    return {'sphere':trimesh.creation.icosphere(4,radius=30),
+            'annulus':trimesh.creation.annulus(20,35,40),
+            'rotated_box':trimesh.creation.box((40,20,30)).apply_transform(rot)}
+
+@pytest.mark.parametrize('name',['sphere','annulus','rotated_box'])
+@pytest.mark.parametrize('pitch',[1.0,0.6])
+def test_VoxelizeToGrid_matches_trimesh(name,pitch):
+    mesh=_TestMeshes()[name]
+    vg=mesh.voxelized(pitch,max_iter=30).fill()
+    Truth=vg.matrix
+    Mask=CPUVoxelize.VoxelizeToGrid(mesh,Truth.shape,vg.transform).astype(bool)
+
+    # trimesh marks every voxel touched by the surface, voxels are marked here only if their center is inside
+    assert not np.any(Mask & ~Truth)
+    Missing=Truth & ~Mask
+    SurfaceLayer=Truth & ~ndimage.binary_erosion(Truth,iterations=2)
+    assert (Missing & ~SurfaceLayer).sum() < 1e-3*Truth.sum()
+    np.testing.assert_allclose(Mask.sum()*pitch**3,mesh.volume,rtol=0.03)
+
+def test_Voxelize_points():
+    mesh=_TestMeshes()['sphere']
+    Points=CPUVoxelize.Voxelize(mesh,targetResolution=1.0)
+    assert Points.dtype==np.float32
+    assert np.all(np.linalg.norm(Points,axis=1)<30)
+    np.testing.assert_allclose(Points.shape[0],mesh.volume,rtol=0.01)
+
+def _SyntheticHead():
+    # skin (1), skull shell (2) and brain (4) as nested spheres, radii in mm
+    skull_outer=trimesh.creation.icosphere(4,radius=76)
+    skull_inner=trimesh.creation.icosphere(4,radius=70)
+    skull=trimesh.Trimesh(np.vstack((skull_outer.vertices,skull_inner.vertices)),
+                          np.vstack((skull_outer.faces,skull_inner.faces[:,::-1]+len(skull_outer.vertices))),process=False)
+    return {1:trimesh.creation.icosphere(4,radius=80),2:skull,4:trimesh.creation.icosphere(4,radius=68)}
+
+def _BeamAlignedGrid(mesh,SpatialStep,seed=0):
+    RMat=trimesh.transformations.random_rotation_matrix(np.random.default_rng(seed).random(3))[:3,:3]
+    affine=np.eye(4)
+    affine[:3,:3]=RMat*SpatialStep
+    IJK=mesh.vertices@np.linalg.inv(affine[:3,:3]).T
+    affine[:3,3]=affine[:3,:3]@np.floor(IJK.min(axis=0))
+    return tuple((np.ceil(IJK.max(axis=0))-np.floor(IJK.min(axis=0))).astype(int)+1),affine
+
+@pytest.mark.parametrize('SpatialStep',[1.0,0.5])
+def test_VoxelizeToGridNearest_matches_point_cloud_path(SpatialStep):
+    # point cloud at 0.75 of the step mapped to the nearest voxels of the beam-aligned grid, as with the GPU voxelizer
+    Meshes=_SyntheticHead()
+    shape,affine=_BeamAlignedGrid(Meshes[1],SpatialStep)
+    New=np.zeros(shape,np.uint8)
+    Old=np.zeros(shape,np.uint8)
+    for Value,mesh in Meshes.items():
+        CPUVoxelize.VoxelizeToGridNearest(mesh,New,affine,SpatialStep*0.75,Value=Value,ChunkPlanes=7)
+        CPUVoxelize.PointsToGrid(CPUVoxelize.Voxelize(mesh,SpatialStep*0.75),affine,Old,Value)
+    assert np.array_equal(New,Old)
+    assert all(np.any(New==Value) for Value in Meshes)
+
+@pytest.mark.parametrize('name',['sphere','annulus','rotated_box'])
+def test_ClipMeshToGrid_same_mask(name):
+    # Rotated grid covering only part of the mesh, which sticks out on every side
+    mesh=_TestMeshes()[name]
+    affine=np.eye(4)
+    affine[:3,:3]=trimesh.transformations.rotation_matrix(0.7,[0.2,1,0.5])[:3,:3]*0.8
+    affine[:3,3]=affine[:3,:3]@np.array([-20.3,-12.6,-15.1])
+    shape=(40,30,45)
+    Clipped=CPUVoxelize.ClipMeshToGrid(mesh,shape,affine)
+    assert Clipped.is_watertight
+    assert Clipped.volume<mesh.volume
+    Full=CPUVoxelize.VoxelizeToGrid(mesh,shape,affine)
+    assert Full.any() and not Full.all()
+    assert np.array_equal(CPUVoxelize.VoxelizeToGrid(Clipped,shape,affine),Full)
+    # sampled at the points of the full mesh, the nearest voxels are the same
+    Full=CPUVoxelize.VoxelizeToGridNearest(mesh,np.zeros(shape,np.uint8),affine,0.6)
+    Result=CPUVoxelize.VoxelizeToGridNearest(Clipped,np.zeros(shape,np.uint8),affine,0.6,GridBounds=mesh.bounds)
+    assert np.array_equal(Result,Full)
+
+def test_ClipMeshToGrid_outside():
+    mesh=_TestMeshes()['sphere']
+    affine=np.eye(4)
+    affine[:3,3]=[100,0,0]
+    assert len(CPUVoxelize.ClipMeshToGrid(mesh,(10,10,10),affine).faces)==0
@@ -0,0 +1,22 @@
+import sys
+sys.path.append('BabelBrain')
+
+import pytest
+
+from Babel_Thermal import CalculateThermalProcess as ctp
+
+@pytest.mark.parametrize('nCores',[1,2,8,32])
+def test_ReturnThermalWorkers_CPU(nCores,monkeypatch):
+    monkeypatch.setattr(ctp.os,'cpu_count',lambda : nCores)
+    nWorkers,nThreads=ctp.ReturnThermalWorkers('CPU',['CPU'],10)
+    assert nWorkers==min(4,max(1,nCores//2))
+    assert nWorkers*nThreads<=nCores or nCores==1
+    assert ctp.ReturnThermalWorkers('CPU',['CPU'],2)[0]==min(2,nWorkers)
+
+def test_ReturnThermalWorkers_GPU(monkeypatch):
+    monkeypatch.setattr(ctp.os,'cpu_count',lambda : 16)
+    assert ctp.ReturnThermalWorkers('CUDA',['GPU0','GPU1'],10)==(2,8)
+    assert ctp.ReturnThermalWorkers('CUDA',['GPU0','GPU1'],1)==(1,16)
+    # the thermal profile overrides the default
+    assert ctp.ReturnThermalWorkers('Metal',['M1'],10,nThermalWorkers=3)==(3,5)
+    assert ctp.ReturnThermalWorkers('CPU',['CPU'],10,nThermalWorkers=1)==(1,16)
@@ -0,0 +1,107 @@
+import logging
+import time
+
+import numpy as np
+import pytest
+
+from ThermalModeling.BHTEBackends import BHTE,BHTEMultiplePressureFields
+
+def _ThermalPhantom():
+    shape=(24,20,28)
+    i,j,k=np.meshgrid(*[np.arange(n) for n in shape],indexing='ij')
+    r=np.sqrt((i-12)**2+(j-10)**2+(k-14)**2)
+    MaterialMap=np.zeros(shape,np.uint32)
+    MaterialMap[r<9]=1
+    MaterialMap[r<7]=2
+    MaterialList={'SoS':[1500,2800,1560],'Density':[1000,1850,1040],'Attenuation':[0,100,5],
+                  'SpecificHeat':[4178,1300,3630],'Conductivity':[0.6,0.32,0.51],'Perfusion':[0,10,559],
+                  'Absorption':[0,0.85,0.85],'InitTemperature':[37,37,37]}
+    Pressure=(2e6*np.exp(-((i-12)**2+(j-10)**2)/8-(k-14)**2/20)).astype(np.float32)
+    MonitoringPointsMap=np.zeros(shape,np.uint32)
+    MonitoringPointsMap[12,10,14]=1
+    MonitoringPointsMap[12,10,16]=2
+    return Pressure,MaterialMap,MaterialList,MonitoringPointsMap
+
+def test_BHTE_CPU_numba_matches_numpy():
+    Pressure,MaterialMap,MaterialList,MonitoringPointsMap=_ThermalPhantom()
+    Res=[BHTE(Pressure,MaterialMap,MaterialList,5e-4,200,150,10,nFactorMonitoring=5,dt=0.01,Backend='CPU',
+              MonitoringPointsMap=MonitoringPointsMap,bUseNumba=b) for b in [True,False]]
+    for a,b in zip(Res[0],Res[1]):
+        np.testing.assert_allclose(a,b,rtol=1e-5,atol=1e-9)
+    assert Res[0][0].max()>37.5, "Sonication should heat the phantom"
+    assert Res[0][2].shape==(MaterialMap.shape[0],MaterialMap.shape[2],40)
+    np.testing.assert_array_equal(Res[0][4][0,::5],Res[0][2][12,14,:])
+
+def test_BHTE_CPU_continuation():
+    Pressure,MaterialMap,MaterialList,_=_ThermalPhantom()
+    T,D,_,_=BHTE(Pressure,MaterialMap,MaterialList,5e-4,120,80,10,dt=0.01,Backend='CPU')
+    T1,D1,_,_=BHTE(Pressure,MaterialMap,MaterialList,5e-4,60,60,10,dt=0.01,Backend='CPU')
+    T2,D2,_,_=BHTE(Pressure,MaterialMap,MaterialList,5e-4,60,20,10,dt=0.01,Backend='CPU',initT0=T1,initDose=D1)
+    np.testing.assert_array_equal(T,T2)
+    np.testing.assert_array_equal(D,D2)
+
+def test_BHTEMultiplePressureFields_CPU_single_field():
+    Pressure,MaterialMap,MaterialList,_=_ThermalPhantom()
+    T,D,_,_=BHTE(Pressure,MaterialMap,MaterialList,5e-4,100,100,10,dt=0.01,Backend='CPU')
+    Tm,Dm,_,Qm=BHTEMultiplePressureFields(np.stack([Pressure,Pressure]),MaterialMap,MaterialList,5e-4,100,
+                                          np.array([[25,0],[25,0]]),10,dt=0.01,Backend='CPU')
+    assert Qm.shape==(2,)+MaterialMap.shape
+    np.testing.assert_array_equal(T,Tm)
+    np.testing.assert_array_equal(D,Dm)
+
+def test_dose_increment_at_reference_temperature():
+    from ThermalModeling import BHTEBackends
+    dt=np.float32(0.01)
+    Tin=np.array([42.5,43.0,43.0,43.5,43.0],np.float32)
+    Tout=np.array([43.0,42.5,43.5,43.0,43.0],np.float32)
+    Inc=BHTEBackends._DoseIncrementNumpy(Tin,Tout,dt)
+    assert np.all(np.isfinite(Inc))
+    # steps ending or starting at 43 degC are the limit of steps crossing it
+    Near=BHTEBackends._DoseIncrementNumpy(Tin+np.float32(1e-3)*np.sign(Tin-Tout),Tout+np.float32(1e-3)*np.sign(Tout-Tin),dt)
+    np.testing.assert_allclose(Inc[:4],Near[:4],rtol=5e-3)
+    np.testing.assert_allclose(Inc[4],dt,rtol=1e-6)
+    if BHTEBackends.bNumba:
+        np.testing.assert_allclose([BHTEBackends._DoseIncrement(a,b,dt) for a,b in zip(Tin,Tout)],Inc,rtol=1e-5)
+
+@pytest.mark.slow
+@pytest.mark.parametrize('shape',[(96,96,96),(160,160,160)],ids=['96','160'])
+def test_BHTE_CPU_step_benchmark(shape):
+    from ThermalModeling import BHTEBackends
+    i,j,k=np.meshgrid(*[np.arange(n) for n in shape],indexing='ij')
+    r=np.sqrt(sum((x-n/2)**2 for x,n in zip((i,j,k),shape)))
+    MaterialMap=np.zeros(shape,np.uint32)
+    MaterialMap[r<shape[0]*0.4]=1
+    MaterialMap[r<shape[0]*0.35]=2
+    bhArr=np.array([0.0,0.05,0.1],np.float32)
+    perfArr=np.array([0.0,1e-4,2e-3],np.float32)
+    Qarr=(0.2*np.exp(-(r/8)**2)).astype(np.float32)
+    nSteps=20
+    Times={}
+    Results={}
+    Kernels={'NumPy':BHTEBackends._BHTEStepNumpy}
+    if BHTEBackends.bNumba:
+        Kernels['Numba']=BHTEBackends._BHTEStepNumba
+    for name,StepFunction in Kernels.items():
+        T0=np.full(shape,37.0,np.float32)
+        Dose0=np.zeros(shape,np.float32)
+        T1=np.zeros_like(T0)
+        Dose1=np.zeros_like(Dose0)
+        # the first step compiles the Numba kernel
+        StepFunction(T1,Dose1,T0,Dose0,bhArr,perfArr,MaterialMap,Qarr,np.float32(37.0),True,np.float32(0.01))
+        T0[:]=37.0
+        Dose0[:]=0.0
+        t0=time.time()
+        for n in range(nSteps):
+            StepFunction(T1,Dose1,T0,Dose0,bhArr,perfArr,MaterialMap,Qarr,np.float32(37.0),True,np.float32(0.01))
+            T0,T1=T1,T0
+            Dose0,Dose1=Dose1,Dose0
+        Times[name]=(time.time()-t0)/nSteps/T0.size*1e9
+        Results[name]=(T0,Dose0)
+
+    logging.info(f"BHTE CPU step {shape}: "+', '.join(f"{name} {t:.2f} ns/voxel-step" for name,t in Times.items()))
+    assert Results['NumPy'][0].max()>37.0
+    if 'Numba' in Results:
+        np.testing.assert_allclose(Results['Numba'][0],Results['NumPy'][0],rtol=1e-5)
+        # the pow of float32 rounds differently in Numba and NumPy for the very small doses
+        np.testing.assert_allclose(Results['Numba'][1],Results['NumPy'][1],rtol=1e-4,atol=1e-9)
+        assert Times['Numba']<Times['NumPy']
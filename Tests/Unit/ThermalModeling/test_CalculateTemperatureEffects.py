@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+
+from ThermalModeling import CalculateTemperatureEffects as CTE
+
+def _LegacyAnalyzeLosses(pAmp,MaterialMap,LocIJK,Input,MaterialList,BrainID,pAmpWater,Isppa,SaveDict,xf,yf,zf):
+    # reference implementation with masked full-volume copies
+    pAmpWater=pAmpWater.copy()
+    if 'MaterialMapCT' in Input:
+        pAmpWater[MaterialMap!=2]=0.0
+    else:
+        pAmpWater[MaterialMap!=4]=0.0
+    pAmpTissue=np.ascontiguousarray(np.flip(Input['p_amp'],axis=2))
+    if 'MaterialMapCT' in Input:
+        pAmpTissue[MaterialMap!=2]=0.0
+    else:
+        pAmpTissue[MaterialMap!=4]=0.0
+    cxr,cyr,czr=np.where(pAmpTissue==pAmpTissue.max())
+    czr=czr[0]
+    AcousticEnergyWaterMaxLoc=(pAmpWater[:,:,czr]**2/2/MaterialList['Density'][0]/ MaterialList['SoS'][0]*((xf[1]-xf[0])**2)).sum()
+    AcousticEnergyTissue=(pAmpTissue[:,:,czr]**2/2/MaterialList['Density'][BrainID]/ MaterialList['SoS'][BrainID]*((xf[1]-xf[0])**2)).sum()
+    RatioLosses=AcousticEnergyTissue/AcousticEnergyWaterMaxLoc
+    PressureAdjust=np.sqrt(Isppa*1e4*2.0*SaveDict['MaterialList']['SoS'][BrainID]*SaveDict['MaterialList']['Density'][BrainID])
+    PressureRatio=PressureAdjust/pAmpTissue.max()
+    return PressureRatio,RatioLosses
+
+def _SyntheticPhantom(bCT):
+    rng=np.random.default_rng(0)
+    shape=(40,36,50)
+    xf=np.arange(shape[0])*5e-4
+    yf=np.arange(shape[1])*5e-4
+    zf=np.arange(shape[2])*5e-4
+    i,j,k=np.meshgrid(np.arange(shape[0]),np.arange(shape[1]),np.arange(shape[2]),indexing='ij')
+    r=np.sqrt((i-20)**2+(j-18)**2+(k-30)**2)
+    MaterialMap=np.zeros(shape,np.uint32)
+    MaterialMap[r<18]=1
+    MaterialMap[r<15]=2 if bCT else 4
+    if not bCT:
+        MaterialMap[r<6]=5
+    focus=np.exp(-((i-21)**2+(j-17)**2)/20-(k-28)**2/60)
+    pAmpWater=(1e5*(0.2+focus)*(1+0.05*rng.random(shape))).astype(np.float32)
+    pAmp=(0.6*pAmpWater*(1+0.05*rng.random(shape))).astype(np.float32)
+    Input={'p_amp':np.ascontiguousarray(np.flip(pAmp,axis=2)),
+           'MaterialMap':np.ascontiguousarray(np.flip(MaterialMap,axis=2)),
+           'x_vec':xf,'y_vec':yf,'z_vec':zf}
+    if bCT:
+        Input['MaterialMapCT']=Input['MaterialMap']
+    MaterialList={'Density':np.array([1000.,1850.,1040.,1000.,1040.,1045.]),
+                  'SoS':np.array([1500.,2800.,1560.,1480.,1560.,1550.])}
+    LocIJK=np.unravel_index(np.argmax(pAmp*(MaterialMap>1)),shape)
+    return pAmp,MaterialMap,LocIJK,Input,MaterialList,pAmpWater,xf,yf,zf
+
+@pytest.mark.parametrize('bCT',[True,False])
+@pytest.mark.parametrize('bUseNumba',[True,False])
+def test_AnalyzeLosses_matches_legacy(bCT,bUseNumba,monkeypatch):
+    pAmp,MaterialMap,LocIJK,Input,MaterialList,pAmpWater,xf,yf,zf=_SyntheticPhantom(bCT)
+    BrainID=2 if bCT else 4
+    SaveDict={'MaterialList':MaterialList}
+    Isppa=5.0
+
+    if not bUseNumba:
+        monkeypatch.setattr(CTE,'_bNumba',False)
+    pAmpWaterOrig=pAmpWater.copy()
+    PressureRatio,RatioLosses=CTE.AnalyzeLosses(pAmp,MaterialMap,LocIJK,Input,MaterialList,BrainID,
+                                                pAmpWater,Isppa,SaveDict,xf,yf,zf)
+    RefPressureRatio,RefRatioLosses=_LegacyAnalyzeLosses(pAmp,MaterialMap,LocIJK,Input,MaterialList,BrainID,
+                                                         pAmpWater,Isppa,SaveDict,xf,yf,zf)
+
+    np.testing.assert_allclose(PressureRatio,RefPressureRatio,rtol=1e-5)
+    np.testing.assert_allclose(RatioLosses,RefRatioLosses,rtol=1e-5)
+    assert np.array_equal(pAmpWater,pAmpWaterOrig), "AnalyzeLosses should not modify its inputs"
+
+@pytest.mark.parametrize('bUseNumba',[True,False])
+def test_ReturnPressureStatistics(bUseNumba):
+    pAmp,MaterialMap,_,_,_,_,_,_,_=_SyntheticPhantom(False)
+    Regions=[[0],[4,5]]
+    Energy,pMax,Loc=CTE.ReturnPressureStatistics(pAmp,MaterialMap,Regions,bUseNumba=bUseNumba)
+    p64=pAmp.astype(np.float64)
+    for r,ids in enumerate(Regions):
+        Mask=np.isin(MaterialMap,ids)
+        pMasked=np.where(Mask,p64,-np.inf)
+        np.testing.assert_allclose(Energy[r],(np.where(Mask,p64,0)**2).sum(axis=(0,1)),rtol=1e-10)
+        assert pMax[r]==pMasked.max()
+        assert tuple(Loc[r])==np.unravel_index(np.argmax(pMasked),pAmp.shape)
+
+def _ThermalHeadPhantom():
+    # skin, skull and brain shells with the skull heated by the beam entry and a focus in the brain
+    shape=(26,24,32)
+    i,j,k=np.meshgrid(*[np.arange(n) for n in shape],indexing='ij')
+    r=np.sqrt((i-13)**2+(j-12)**2+(k-24)**2)
+    MaterialMap=np.zeros(shape,np.uint32)
+    MaterialMap[r<22]=1
+    MaterialMap[r<20]=2
+    MaterialMap[r<17]=3
+    MaterialList={'SoS':[1500,1610,2800,1560],'Density':[1000,1090,1850,1040],'Attenuation':[0,30,250,20],
+                  'SpecificHeat':[4178,3391,1300,3630],'Conductivity':[0.6,0.37,0.32,0.51],'Perfusion':[0,106,10,559],
+                  'Absorption':[0,0.85,0.16,0.85],'InitTemperature':[37,37,37,37]}
+    Pressure=(1.2e6*np.exp(-((i-13)**2+(j-11)**2)/(4+0.3*np.abs(k-18)))*(0.5+np.exp(-(k-18)**2/40))).astype(np.float32)
+    RegionMasks=[MaterialMap==1,MaterialMap==3,MaterialMap==2]
+    return Pressure,MaterialMap,MaterialList,RegionMasks
+
+def _TwoPassHotspotProfiles(Pressure,MaterialMap,MaterialList,RegionMasks,FixedPoints,**kargs):
+    # previous implementation, a first run locates the maxima and a second run records their profiles
+    ResTemp=CTE.BHTE(Pressure,MaterialMap,MaterialList,5e-4,**kargs)[0]
+    Hotspots=[np.unravel_index(np.argmax(ResTemp*m),ResTemp.shape) for m in RegionMasks]
+    MonitoringPointsMap=np.zeros(MaterialMap.shape,np.uint32)
+    for n,p in enumerate(Hotspots+FixedPoints):
+        MonitoringPointsMap[p]=n+1
+    TemperaturePoints=CTE.BHTE(Pressure,MaterialMap,MaterialList,5e-4,MonitoringPointsMap=MonitoringPointsMap,**kargs)[4]
+    return ResTemp,Hotspots,TemperaturePoints
+
+@pytest.mark.parametrize('bMissedHotspots',[False,True])
+def test_BHTEWithHotspotTracking_matches_two_passes(bMissedHotspots,capsys,monkeypatch):
+    if bMissedHotspots:
+        # candidates at the border of each region, the hotspots are found in a second integration
+        monkeypatch.setattr(CTE,'ReturnRegionCandidates',lambda Temp,RegionIndexes,n: [ind[:1].tolist() for ind in RegionIndexes])
+    Pressure,MaterialMap,MaterialList,RegionMasks=_ThermalHeadPhantom()
+    FixedPoints=[(13,11,20)]
+    kargs={'TotalDurationSteps':300,'nStepsOn':250,'LocationMonitoring':11,'nFactorMonitoring':5,'dt':0.01,'DutyCycle':0.7,'Backend':'CPU'}
+    ResTemp,Hotspots,TemperaturePoints=_TwoPassHotspotProfiles(Pressure,MaterialMap,MaterialList,RegionMasks,FixedPoints,**kargs)
+    Res=CTE.BHTEWithHotspotTracking(Pressure,MaterialMap,MaterialList,5e-4,kargs.pop('TotalDurationSteps'),kargs.pop('nStepsOn'),
+                                    kargs.pop('LocationMonitoring'),RegionMasks,FixedPoints=FixedPoints,**kargs)
+    assert ('repeating the integration' in capsys.readouterr().out)==bMissedHotspots
+    np.testing.assert_array_equal(Res[0],ResTemp)
+    for a,b in zip(Res[4],Hotspots):
+        assert tuple(a)==tuple(b)
+    assert Res[5].shape==(4,300)
+    np.testing.assert_array_equal(Res[5],TemperaturePoints)
+
+def test_BHTEWithHotspotTracking_multiple_fields():
+    Pressure,MaterialMap,MaterialList,RegionMasks=_ThermalHeadPhantom()
+    Fields=np.stack([Pressure,np.roll(Pressure,3,axis=0)])
+    nStepsOnOffList=np.array([[20,10],[20,10]],np.int32)
+    ResTemp,_,_,_,Hotspots,TemperaturePoints=CTE.BHTEWithHotspotTracking(Fields,MaterialMap,MaterialList,5e-4,240,240,11,RegionMasks,
+                                                                         nStepsOnOffList=nStepsOnOffList,nFactorMonitoring=5,
+                                                                         dt=0.01,Backend='CPU')
+    MonitoringPointsMap=np.zeros(MaterialMap.shape,np.uint32)
+    for n,p in enumerate(Hotspots):
+        MonitoringPointsMap[tuple(p)]=n+1
+    Res=CTE.BHTEMultiplePressureFields(Fields,MaterialMap,MaterialList,5e-4,240,nStepsOnOffList,11,nFactorMonitoring=5,
+                                       dt=0.01,Backend='CPU',MonitoringPointsMap=MonitoringPointsMap)
+    np.testing.assert_array_equal(ResTemp,Res[0])
+    for p,m in zip(Hotspots,RegionMasks):
+        assert tuple(p)==np.unravel_index(np.argmax(Res[0]*m),MaterialMap.shape)
+    np.testing.assert_array_equal(TemperaturePoints,Res[4])
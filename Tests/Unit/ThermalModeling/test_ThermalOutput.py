@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+from scipy.io import loadmat
+
+from ThermalModeling.ThermalOutput import SaveThermalResults,ReadThermalResults,THERMAL_VOLUME_FIELDS,DOSE_INT16_SCALE
+
+def _ThermalResults():
+    # fields as saved by CalculateTemperatureEffects, doses span many decades and include voxels without dose
+    rng=np.random.default_rng(6)
+    shape=(24,20,30)
+    SaveDict={}
+    for k in ['TempEndFUS','FinalTemp']:
+        SaveDict[k]=(36.5+8*rng.random(shape)).astype(np.float32)
+    for k in ['DoseEndFUS','FinalDose']:
+        Dose=np.power(10.0,rng.uniform(-12,4,shape)).astype(np.float32)
+        Dose[rng.random(shape)<0.2]=0
+        SaveDict[k]=Dose
+    SaveDict['MonitorSlice']=(37+3*rng.random((24,30,10))).astype(np.float32)
+    SaveDict['TemperaturePoints']=(37+3*rng.random((4,500))).astype(np.float32)
+    SaveDict['TempProfileTarget']=SaveDict['TemperaturePoints'][2,:]
+    SaveDict['p_map']=rng.random(shape).astype(np.float32)*1e5
+    SaveDict['MaterialMap']=rng.integers(0,5,shape).astype(np.uint32)
+    SaveDict['TargetLocation']=np.array([12,10,17])
+    SaveDict['TI']=4.5
+    SaveDict['CEMBrain']=0.25
+    return SaveDict
+
+def _CheckDecoded(Data,SaveDict,Precision):
+    for k in ['TempEndFUS','FinalTemp','MonitorSlice','TemperaturePoints','TempProfileTarget']:
+        assert Data[k].dtype==np.float32,k
+        if Precision=='int16':
+            assert np.abs(Data[k]-SaveDict[k]).max()<=0.005+1e-4,k
+        else:
+            np.testing.assert_array_equal(Data[k],SaveDict[k],err_msg=k)
+    for k in ['DoseEndFUS','FinalDose']:
+        assert Data[k].dtype==np.float32,k
+        Zero=SaveDict[k]==0
+        assert np.all(Data[k][Zero]==0),k
+        if Precision=='int16':
+            # rounding in log10 is at most half a quantization step
+            MaxRelError=10**(DOSE_INT16_SCALE/2)-1
+            np.testing.assert_allclose(Data[k][~Zero],SaveDict[k][~Zero],rtol=MaxRelError*1.01,atol=0,err_msg=k)
+        else:
+            np.testing.assert_array_equal(Data[k],SaveDict[k],err_msg=k)
+    np.testing.assert_array_equal(Data['p_map'],SaveDict['p_map'])
+    np.testing.assert_array_equal(Data['MaterialMap'],SaveDict['MaterialMap'])
+    assert Data['TI']==SaveDict['TI'] and Data['CEMBrain']==SaveDict['CEMBrain']
+
+@pytest.mark.parametrize('Precision',[None,'float32','int16'])
+def test_thermal_results_round_trip(tmp_path,Precision):
+    SaveDict=_ThermalResults()
+    outfname=str(tmp_path/'thermal')
+    SaveThermalResults(SaveDict,outfname,Precision=Precision)
+    assert os.path.isfile(outfname+'.mat')
+    Data=ReadThermalResults(outfname+'.h5')
+    assert 'ThermalEncoding' not in Data
+    _CheckDecoded(Data,SaveDict,Precision)
+    if Precision=='int16':
+        Raw=loadmat(outfname+'.mat')
+        for k in ['TempEndFUS','FinalTemp','DoseEndFUS','FinalDose']:
+            assert Raw[k].dtype==np.int16,k
+        assert 'ThermalEncoding' in Raw
+
+def test_thermal_results_mat_only(tmp_path):
+    SaveDict=_ThermalResults()
+    outfname=str(tmp_path/'thermal')
+    SaveThermalResults(SaveDict,outfname,Precision='float32',Containers=('mat',))
+    assert not os.path.isfile(outfname+'.h5')
+    Raw=loadmat(outfname+'.mat',squeeze_me=True)
+    for k in ['TempEndFUS','FinalTemp','DoseEndFUS','FinalDose']:
+        assert Raw[k].dtype==np.float32,k
+        np.testing.assert_array_equal(Raw[k],SaveDict[k],err_msg=k)
+    with pytest.raises(AssertionError):
+        SaveThermalResults(SaveDict,outfname,Containers=())
+
+@pytest.mark.parametrize('Precision',[None,'int16'])
+def test_thermal_results_summary_only(tmp_path,Precision):
+    SaveDict=_ThermalResults()
+    outfname=str(tmp_path/'thermal')
+    SaveThermalResults(SaveDict,outfname,Precision=Precision,bSummaryOnly=True)
+    Data=ReadThermalResults(outfname+'.h5')
+    assert Data['bSummaryOnly']
+    cz=SaveDict['TargetLocation'][2]
+    for k in THERMAL_VOLUME_FIELDS:
+        assert k not in Data,k
+        assert Data[k+'_zslice'].shape==SaveDict[k].shape[:2],k
+    Slices={k:SaveDict[k][:,:,cz] for k in THERMAL_VOLUME_FIELDS}
+    Slices.update({k:SaveDict[k] for k in ['MonitorSlice','TemperaturePoints','TempProfileTarget','TI','CEMBrain']})
+    _CheckDecoded({k.replace('_zslice',''):v for k,v in Data.items()},Slices,Precision)
+    # the summary is not kept in the input dictionary
+    assert SaveDict['FinalTemp'].ndim==3
@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pytest
+
+from TranscranialModeling.DataForSimH5 import SaveDataForSim
+from ThermalModeling.CalculateTemperatureEffects import CalculateTemperatureEffects,ReturnRegionCandidates
+from ThermalModeling.ThermalOutput import ReadThermalResults
+from ThermalModeling.ThermalSuperposition import ThermalSuperpositionEngine,ReturnThermalDose
+
+def _SaveThermalPhantom(dirname,BroadHeating=0.0):
+    # layered head (skin, cortical, trabecular, brain) with a beam focused in the brain, BroadHeating adds a wide
+    # region in the brain that heats slower than the focus and cools slower
+    shape=(30,28,40)
+    dx=5e-4
+    i,j,k=np.meshgrid(*[np.arange(n) for n in shape],indexing='ij')
+    r=np.sqrt((i-15)**2+(j-14)**2+(k-30)**2)
+    MaterialMap=np.zeros(shape,np.uint32)
+    MaterialMap[r<27]=1
+    MaterialMap[r<24]=2
+    MaterialMap[r<22]=3
+    MaterialMap[r<20]=4
+    Target=(14,14,24)
+    MaterialMap[Target]=5
+    Beam=np.exp(-((i-14)**2+(j-14)**2)/(6+0.4*np.abs(k-24)))*(0.4+0.6*np.exp(-(k-24)**2/120))
+    pAmpWater=(3e5*Beam).astype(np.float32)
+    pAmp=pAmpWater*np.where(MaterialMap>=4,0.6,0.8)
+    Broad=np.exp(-((i-22)**2+(j-21)**2+(k-30)**2)/120)
+    pAmp=np.sqrt(pAmp**2+(BroadHeating*1.8e5)**2*Broad).astype(np.float32)
+    Material=np.array([[1000,1500,0,0,0],
+                       [1090,1610,0,30,0],
+                       [1850,2800,1500,250,100],
+                       [1700,2300,1400,300,100],
+                       [1040,1560,0,20,0]],np.float64)
+    Data={'Material':Material,
+          'x_vec':np.arange(shape[0])*dx,
+          'y_vec':np.arange(shape[1])*dx,
+          'z_vec':np.arange(shape[2])*dx,
+          'TargetLocation':np.array(Target).reshape((1,3)),
+          'AdjustmentInRAS':np.zeros(3),
+          'DistanceFromSkin':20.0,
+          'TxMechanicalAdjustmentZ':0.0,
+          'ZIntoSkinPixels':0}
+    # volumes are saved flipped in Z, as in the acoustic simulations
+    fname=os.path.join(dirname,'T1_500kHz_6PPW_DataForSim.h5')
+    SaveDataForSim(dict(Data,p_amp=np.flip(pAmp,axis=2),MaterialMap=np.flip(MaterialMap,axis=2)),fname)
+    MaterialMapWater=np.zeros_like(MaterialMap)
+    MaterialMapWater[Target]=5
+    SaveDataForSim(dict(Data,p_amp=np.flip(pAmpWater,axis=2),MaterialMap=np.flip(MaterialMapWater,axis=2)),
+                   fname.replace('DataForSim.h5','Water_DataForSim.h5'))
+    return fname
+
+# the last one shares the schedule of the second one
+_Combinations=[{'DC':0.3,'PRF':10,'Duration':2,'DurationOff':1,'Repetitions':1},
+               {'DC':0.6,'PRF':10,'Duration':1,'DurationOff':2,'Repetitions':3},
+               {'DC':1.0,'PRF':100,'Duration':1,'DurationOff':1,'Repetitions':2},
+               {'DC':0.2,'PRF':100,'Duration':1,'DurationOff':2,'Repetitions':3}]
+
+_CombinationsBroadHeating=[{'DC':1.0,'PRF':10,'Duration':3,'DurationOff':4,'Repetitions':1},
+                           {'DC':0.8,'PRF':10,'Duration':2,'DurationOff':2,'Repetitions':2}]
+
+def test_ReturnRegionCandidates():
+    Temp=np.random.default_rng(0).random((10,12,14)).astype(np.float32)
+    RegionIndexes=[np.flatnonzero(Temp>0.5),np.arange(3),np.array([],np.int64)]
+    Candidates=ReturnRegionCandidates(Temp,RegionIndexes,8)
+    assert Candidates[0][0]==RegionIndexes[0][np.argmax(Temp.flat[RegionIndexes[0]])]
+    assert sorted(Candidates[0])==sorted(RegionIndexes[0][np.argsort(Temp.flat[RegionIndexes[0]])[-8:]].tolist())
+    assert sorted(Candidates[1])==[0,1,2]
+    assert Candidates[2]==[]
+
+def test_ReturnThermalDose_constant_temperature():
+    # one minute at 43 degC is 1 CEM43 min, a degree below counts 1/4
+    for T,CEM in [(43.0,1.0),(42.0,0.25)]:
+        Dose=ReturnThermalDose(np.full((1,6000),T,np.float32),0.01,T0=T)
+        np.testing.assert_allclose(Dose/60,CEM,rtol=1e-5)
+
+@pytest.mark.parametrize('BroadHeating,Combinations',[(0.0,_Combinations),(0.85,_CombinationsBroadHeating)])
+def test_superposition_matches_direct_solve(tmp_path,BroadHeating,Combinations):
+    fname=_SaveThermalPhantom(str(tmp_path),BroadHeating)
+    Isppa=40.0
+    Direct=[]
+    for c in Combinations:
+        outfname=CalculateTemperatureEffects(fname,DutyCycle=c['DC'],Isppa=Isppa,PRF=c['PRF'],DurationUS=c['Duration'],
+                                             DurationOff=c['DurationOff'],Repetitions=c['Repetitions'],bPlot=False,
+                                             bForceRecalc=True,Frequency=500e3,Backend='CPU',RepetitionsTolerance=None)
+        Direct.append(ReadThermalResults(outfname+'.h5'))
+    Engine=ThermalSuperpositionEngine(fname,Isppa=Isppa,Frequency=500e3,Backend='CPU',dt=0.01)
+    Names=Engine.CalculateCombinations(Combinations)
+    for Truth,outfname in zip(Direct,Names):
+        Data=ReadThermalResults(outfname+'.h5')
+        assert Data['bThermalSuperposition']
+        assert Truth['TI']>0.5 and Truth['TIC']>0.5, "the phantom must heat"
+        for k in ['TempEndFUS','FinalTemp','MonitorSlice','TempProfileTarget']:
+            np.testing.assert_allclose(Data[k],Truth[k],atol=2e-3,err_msg=k)
+        for k in ['mSkin','mBrain','mSkull']:
+            np.testing.assert_array_equal(Data[k],Truth[k])
+        np.testing.assert_allclose(Data['TemperaturePoints'],Truth['TemperaturePoints'],atol=2e-3)
+        for k in ['TI','TIS','TIC']:
+            np.testing.assert_allclose(Data[k],Truth[k],atol=2e-3,err_msg=k)
+        # the dose maxima of the direct solve are over the whole regions
+        for k in ['CEMBrain','CEMSkin','CEMSkull']:
+            np.testing.assert_allclose(Data[k],Truth[k],rtol=1e-3,err_msg=k)
+    if BroadHeating>0:
+        # the maximal dose in the brain is not at the hottest voxel at the end of the sonication
+        MaterialMap=Truth['MaterialMap']
+        nMaxDose=np.argmax(np.where(MaterialMap>=4,Direct[0]['FinalDose'],0))
+        assert nMaxDose!=np.ravel_multi_index(Direct[0]['mBrain'],MaterialMap.shape)
+
+def test_repetitions_extrapolation_matches_all_repetitions(tmp_path):
+    # short pulses with long cooling converge to a periodic steady state well before the last repetition
+    fname=_SaveThermalPhantom(str(tmp_path))
+    kargs=dict(DutyCycle=1.0,Isppa=40.0,PRF=10,DurationUS=0.2,DurationOff=10,Repetitions=15,bPlot=False,
+               bForceRecalc=True,Frequency=500e3,Backend='CPU')
+    Truth=ReadThermalResults(CalculateTemperatureEffects(fname,**kargs)+'.h5')
+    assert Truth['RepetitionsSimulated']==15
+    assert Truth['RepetitionsExtrapolatedTailTemp']==0 and Truth['RepetitionsExtrapolatedTailCEM']==0
+    Data=ReadThermalResults(CalculateTemperatureEffects(fname,RepetitionsTolerance=0.01,**kargs)+'.h5')
+    assert Data['RepetitionsSimulated']<15, "the repetitions must be extrapolated"
+    TailTemp=Data['RepetitionsExtrapolatedTailTemp']
+    TailCEM=Data['RepetitionsExtrapolatedTailCEM']
+    assert 0<TailTemp<0.1
+    for k in ['TI','TIS','TIC']:
+        assert abs(Data[k]-Truth[k])<=min(TailTemp,0.01),k
+    for k in ['TempEndFUS','FinalTemp','TemperaturePoints','TempProfileTarget']:
+        assert Data[k].shape==Truth[k].shape,k
+        np.testing.assert_allclose(Data[k],Truth[k],atol=TailTemp,err_msg=k)
+    for k in ['CEMBrain','CEMSkin','CEMSkull']:
+        assert abs(Data[k]-Truth[k])<=TailCEM,k
+        np.testing.assert_allclose(Data[k],Truth[k],rtol=1e-2,err_msg=k)
+    np.testing.assert_allclose(Data['FinalDose'],Truth['FinalDose'],atol=TailCEM*60)
@@ -0,0 +1,86 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from TranscranialModeling import AcousticResultCache as arc
+
+def _WriteFile(fname,content):
+    with open(fname,'wb') as f:
+        f.write(content)
+    return fname
+
+def test_case_key(tmp_path,monkeypatch):
+    mask=_WriteFile(str(tmp_path/'mask.nii.gz'),b'mask data')
+    key=arc.ReturnCaseKey([mask],Frequency=500e3,PPW=6)
+    assert key==arc.ReturnCaseKey([mask],PPW=6,Frequency=500e3)
+    assert key!=arc.ReturnCaseKey([mask],Frequency=500e3,PPW=9)
+    _WriteFile(mask,b'other mask data')
+    assert key!=arc.ReturnCaseKey([mask],Frequency=500e3,PPW=6)
+    _WriteFile(mask,b'mask data')
+    assert key==arc.ReturnCaseKey([mask],Frequency=500e3,PPW=6)
+    # results of a different code version are never restored
+    monkeypatch.setattr(arc,'ReturnCodeVersion',lambda : 'another version')
+    assert key!=arc.ReturnCaseKey([mask],Frequency=500e3,PPW=6)
+
+def test_case_key_arrays(tmp_path):
+    # arrays are hashed by contents, their repr is truncated
+    mask=_WriteFile(str(tmp_path/'mask.nii.gz'),b'mask data')
+    Geometry=np.zeros((2000,3))
+    Changed=Geometry.copy()
+    Changed[1000,1]=1e-3
+    assert repr(Geometry)==repr(Changed)
+    key=arc.ReturnCaseKey([mask],TxSettings={'TxGeometry':Geometry})
+    assert key==arc.ReturnCaseKey([mask],TxSettings={'TxGeometry':Geometry.copy()})
+    assert key!=arc.ReturnCaseKey([mask],TxSettings={'TxGeometry':Changed})
+    assert key!=arc.ReturnCaseKey([mask],TxSettings={'TxGeometry':Geometry.astype(np.float32)})
+    assert key!=arc.ReturnCaseKey([mask],TxSettings={'TxGeometry':Geometry.reshape((3,2000))})
+
+def test_code_version():
+    assert arc.ReturnCodeVersion()==arc.ReturnCodeVersion()
+    assert len(arc.ReturnCodeVersion())==40
+
+def test_store_and_restore(tmp_path):
+    cache=arc.AcousticResultCache(str(tmp_path/'cache'))
+    outdir=tmp_path/'out'
+    outdir.mkdir()
+    files=[_WriteFile(str(outdir/f),f.encode()) for f in ['A_DataForSim.h5','A_Sub.nii.gz']]
+    assert not cache.Restore('key1',str(outdir))
+    cache.Store('key1',files)
+    for f in files:
+        os.remove(f)
+    assert cache.Restore('key1',str(outdir))
+    assert sorted(os.listdir(outdir))==['A_DataForSim.h5','A_Sub.nii.gz']
+    with open(files[0],'rb') as f:
+        assert f.read()==b'A_DataForSim.h5'
+    assert [f for f in os.listdir(tmp_path/'cache') if '.tmp-' in f]==[]
+
+def test_lru_eviction(tmp_path):
+    cache=arc.AcousticResultCache(str(tmp_path/'cache'),MaxSizeGB=2500/(1<<30))
+    outdir=tmp_path/'out'
+    outdir.mkdir()
+    for n,key in enumerate(['key1','key2']):
+        cache.Store(key,[_WriteFile(str(outdir/('%s.h5' % key)),b'x'*1000)])
+        os.utime(cache.EntryPath(key),(n,n))
+    # key1 is used again, so key2 is the least recently used when the limit is exceeded
+    assert cache.Restore('key1',str(outdir))
+    cache.Store('key3',[_WriteFile(str(outdir/'key3.h5'),b'x'*1000)])
+    assert os.path.isdir(cache.EntryPath('key1'))
+    assert not os.path.isdir(cache.EntryPath('key2'))
+    assert os.path.isdir(cache.EntryPath('key3'))
+
+def test_concurrent_eviction(tmp_path):
+    cache=arc.AcousticResultCache(str(tmp_path/'cache'),MaxSizeGB=3000/(1<<30))
+    outdir=tmp_path/'out'
+    outdir.mkdir()
+    def StoreCase(n):
+        fname=_WriteFile(str(outdir/('case%i.h5' % n)),b'x'*1000)
+        cache.Store('key%i' % n,[fname])
+        return n
+    with ThreadPoolExecutor(8) as executor:
+        assert sorted(executor.map(StoreCase,range(40)))==list(range(40))
+    Entries=[f for f in os.listdir(tmp_path/'cache')]
+    assert 1<=len(Entries)<=3
+    assert not any('.tmp-' in f for f in Entries)
@@ -1,7 +1,10 @@
 import os
 import sys
+import time
 import logging
+import threading
 
+import numpy as np
 import pytest
 import nibabel
 
@@ -30,4 +33,560 @@ def test_SaveNiftiEnforcedISO(dataset,load_files,check_data,tmp_path):
     # Check that data is isometric
     isometric = check_data['isometric'](enforced_iso_nifti)
 
-    assert isometric, "Data is not isometric"
\ No newline at end of file
+    assert isometric, "Data is not isometric"
+
+class _StubRayleighSettings(object):
+    # Minimal simulation conditions with the attributes created by a Tx class in the forward Rayleigh step
+    RayleighForwardAttributes=('_TxRC','_u2RayleighFieldFull','_SourceMapRayleigh','_u2RayleighSubVolume')
+    def __init__(self,bDomainFromContext):
+        self._bDomainFromContext=bDomainFromContext
+        self._u2RayleighSubVolume=None
+        self.Calls={'Forward':0,'SubVolume':0}
+
+    def CalculateRayleighFieldsForward(self,deviceName=''):
+        self.Calls['Forward']+=1
+        self._TxRC={'center':np.zeros((16,3),np.float32)}
+        self._u2RayleighFieldFull=np.ones((30,32,40),np.complex64)
+        self._SourceMapRayleigh=self._u2RayleighFieldFull[:,:,3].copy()
+        self._u2RayleighSubVolume=None
+
+    def ReturnRayleighFieldSubVolume(self):
+        if self._u2RayleighSubVolume is None:
+            self.Calls['SubVolume']+=1
+            self._u2RayleighSubVolume=self._u2RayleighFieldFull[4:-4,4:-4,4:-4].copy()
+        return self._u2RayleighSubVolume
+
+def test_rayleigh_source_shared_through_case_context():
+    # skull run followed by the water only run of the same case
+    CaseContext={}
+    Runs=[]
+    for bWaterOnly in [False,True]:
+        Sim=BIBase.BabelFTD_Simulations_BASE(bDisplay=False,bWaterOnly=bWaterOnly,CaseContext=CaseContext)
+        Sim._SIM_SETTINGS=_StubRayleighSettings(bDomainFromContext=bWaterOnly)
+        Sim.Step2_CalculateRayleighFieldsForward(bSkipSavingSTL=True)
+        Sim.PrepareRayleighFieldSubVolume()
+        Runs.append(Sim._SIM_SETTINGS)
+
+    assert [r.Calls['Forward'] for r in Runs]==[1,0]
+    # arrays are shared by reference, other entries are copied
+    assert Runs[1]._u2RayleighFieldFull is Runs[0]._u2RayleighFieldFull
+    assert Runs[1]._SourceMapRayleigh is Runs[0]._SourceMapRayleigh
+    assert Runs[1]._TxRC is not Runs[0]._TxRC
+    np.testing.assert_array_equal(Runs[1]._TxRC['center'],Runs[0]._TxRC['center'])
+    # the water field over the domain is calculated once for both runs
+    assert [r.Calls['SubVolume'] for r in Runs]==[1,0]
+    assert Runs[1].ReturnRayleighFieldSubVolume() is Runs[0].ReturnRayleighFieldSubVolume()
+
+    assert 'Calls' not in CaseContext['RayleighForward']
+
+@pytest.mark.parametrize('Tx',['ATAC','CONCAVE_PHASEDARRAY','CTX250','CTX500','DPX500','H246','H317','I12378','REMOPD','Single'])
+def test_rayleigh_forward_attributes_declared(Tx):
+    # every attribute assigned in the forward Rayleigh step must be shared through the case context
+    import importlib
+    import inspect
+    import re
+    SimConditions=importlib.import_module('TranscranialModeling.BabelIntegration'+Tx).SimulationConditions
+    Source=inspect.getsource(SimConditions.CalculateRayleighFieldsForward)+inspect.getsource(SimConditions.SetRayleighSource)
+    Assigned=set(re.findall(r'self\.(\w+)\s*=[^=]',Source))
+    assert Assigned<=set(SimConditions.RayleighForwardAttributes),Assigned-set(SimConditions.RayleighForwardAttributes)
+
+def test_case_context_keyed_by_input_files(tmp_path):
+    RunSim=BIBase.RUN_SIM_BASE()
+    Mask=str(tmp_path/'mask.nii.gz')
+    with open(Mask,'wb') as f:
+        f.write(b'first')
+    Context=RunSim.ReturnCaseContext(Mask,500e3,6,InputFiles=[Mask])
+    Context['SkullMask']='first'
+    assert RunSim.ReturnCaseContext(Mask,500e3,6,InputFiles=[Mask]) is Context
+    assert RunSim.ReturnCaseContext(Mask,500e3,9,InputFiles=[Mask]) is not Context
+    # the mask is regenerated with the same name
+    with open(Mask,'wb') as f:
+        f.write(b'second mask')
+    os.utime(Mask,ns=(os.stat(Mask).st_atime_ns,os.stat(Mask).st_mtime_ns+10**9))
+    assert RunSim.ReturnCaseContext(Mask,500e3,6,InputFiles=[Mask])=={}
+
+
+def _IterativeFitDomainToRayleighMap(self,SpatialStep):
+    # Previous implementation of FitDomainToRayleighMap, the domain is enlarged or shrunk until the incident beam fits in
+    PML=self._PMLThickness
+    Offsets={'XLOffset':PML,'YLOffset':PML,'XROffset':PML,'YROffset':PML}
+    Shrinks={'X_L':0,'X_R':0,'Y_L':0,'Y_R':0}
+    ZLOffset=PML+self._PaddingForRayleigh+self._PaddingForKArray+int(np.round(self._ZTxCorrecton/self._SpatialStep))
+    ZROffset=PML
+    ZShrink_R=0
+    MaskShape=self._SkullMaskDataOrig.shape
+    bMapFit=False
+    bCompleteForShrinking=False
+    nCountShrink=0
+    while not bMapFit or not bCompleteForShrinking:
+        bMapFit=True
+        N={'X':MaskShape[0]+Offsets['XLOffset']+Offsets['XROffset']-Shrinks['X_L']-Shrinks['X_R'],
+           'Y':MaskShape[1]+Offsets['YLOffset']+Offsets['YROffset']-Shrinks['Y_L']-Shrinks['Y_R']}
+        N3=MaskShape[2]+ZLOffset+ZROffset-ZShrink_R
+        FocalSpotLocation=np.array(np.where(self._SkullMaskDataOrig==5.0)).flatten()
+        FocalSpotLocation+=np.array([Offsets['XLOffset'],Offsets['YLOffset'],ZLOffset])
+        FocalSpotLocation-=np.array([Shrinks['X_L'],Shrinks['Y_L'],0])
+        xfield=np.arange(N['X'])*SpatialStep
+        yfield=np.arange(N['Y'])*SpatialStep
+        zfield=np.arange(N3)*SpatialStep
+        xfield-=xfield[FocalSpotLocation[0]]
+        yfield-=yfield[FocalSpotLocation[1]]
+        zfield-=zfield[FocalSpotLocation[2]]
+        zfield+=self._FocalLength
+        RadiusFace=self.ReturnRadiusFace(zfield[PML])
+        ypp,xpp=np.meshgrid(yfield,xfield)
+        RegionMap=((xpp-self._TxMechanicalAdjustmentX)**2+(ypp-self._TxMechanicalAdjustmentY)**2)<=RadiusFace**2
+        for EX,EY in zip (self._ExtraAdjustX,self._ExtraAdjustY):
+            RegionMap=(RegionMap)|(((xpp-self._TxMechanicalAdjustmentX-EX)**2+(ypp-self._TxMechanicalAdjustmentY-EY)**2)<=RadiusFace**2)
+        IndMap=dict(zip(['X','Y'],np.nonzero(RegionMap)))
+        for var in ['X','Y']:
+            if np.any(IndMap[var]<PML):
+                Offsets[var+'LOffset']+=PML-IndMap[var].min()
+                bMapFit=False
+            elif self._bTightNarrowBeamDomain:
+                if Offsets[var+'LOffset']==PML:
+                    Shrinks[var+'_L']+=IndMap[var].min()-Offsets[var+'LOffset']
+                nCountShrink+=1
+            if np.any(IndMap[var]>=N[var]-PML):
+                Offsets[var+'ROffset']+=IndMap[var].max()-(N[var]-PML)+1
+                bMapFit=False
+            elif self._bTightNarrowBeamDomain:
+                if Offsets[var+'ROffset']==PML:
+                    Shrinks[var+'_R']+=N[var]-Offsets[var+'ROffset']-IndMap[var].max()-1
+                nCountShrink+=1
+        if self._bTightNarrowBeamDomain:
+            nStepsZReduction=int(self._zLengthBeyonFocalPointWhenNarrow/self._SpatialStep)
+            ZShrink_R=np.max([0,ZShrink_R+N3-(FocalSpotLocation[2]+nStepsZReduction)])
+        if bMapFit:
+            bCompleteForShrinking=not self._bTightNarrowBeamDomain or nCountShrink>=8
+    return {'N':(N['X'],N['Y'],N3),
+            'FocalSpotLocation':FocalSpotLocation,
+            'XDim':xfield,'YDim':yfield,'ZDim':zfield}
+
+def _SyntheticSkullMask(shape,focus):
+    # skin, skull and brain layers along Z with the target voxel labeled 5
+    Mask=np.zeros(shape,np.uint8)
+    Mask[:,:,4:]=1
+    Mask[:,:,8:]=2
+    Mask[:,:,11:]=3
+    Mask[:,:,14:]=4
+    Mask[focus]=5
+    return Mask
+
+_DomainCases=[
+    # beam narrower than the mask
+    {'Aperture':0.03},
+    # beam wider than the mask, the domain is padded
+    {'Aperture':0.10},
+    {'Aperture':0.08,'TxMechanicalAdjustmentX':4e-3,'TxMechanicalAdjustmentY':-3e-3},
+    # steering enlarges the incident region
+    {'Aperture':0.03,'ExtraAdjustX':[0.0,5e-3,-4e-3],'ExtraAdjustY':[0.0,2e-3,6e-3]},
+    # tight domain following the beam
+    {'Aperture':0.03,'bTightNarrowBeamDomain':True},
+    {'Aperture':0.03,'bTightNarrowBeamDomain':True,'TxMechanicalAdjustmentX':3e-3,'ExtraAdjustX':[0.0,4e-3],'ExtraAdjustY':[0.0,-5e-3]},
+    {'Aperture':0.03,'bTightNarrowBeamDomain':True,'zLengthBeyonFocalPointWhenNarrow':1e-2},
+]
+
+@pytest.mark.parametrize('Settings',_DomainCases)
+@pytest.mark.parametrize('SpatialStep',[1e-3,0.6e-3])
+def test_FitDomainToRayleighMap_matches_iterative_fit(Settings,SpatialStep):
+    shape=(int(0.06/SpatialStep),int(0.055/SpatialStep),int(0.07/SpatialStep))
+    focus=(shape[0]//2-3,shape[1]//2+2,int(0.045/SpatialStep))
+    SIM=BIBase.SimulationConditionsBASE(bDisplay=False,FocalLength=60e-3,PMLThickness=12,**Settings)
+    SIM._SpatialStep=SpatialStep
+    SIM._SkullMaskDataOrig=_SyntheticSkullMask(shape,focus)
+    Truth=_IterativeFitDomainToRayleighMap(SIM,SpatialStep)
+    SIM.FitDomainToRayleighMap(SpatialStep)
+    assert (SIM._N1,SIM._N2,SIM._N3)==Truth['N']
+    np.testing.assert_array_equal(SIM._FocalSpotLocation,Truth['FocalSpotLocation'])
+    for k in ['XDim','YDim','ZDim']:
+        np.testing.assert_allclose(getattr(SIM,'_'+k),Truth[k],atol=1e-12)
+
+class _EstimateSimulations(BIBase.BabelFTD_Simulations_BASE):
+    def CreateSimConditions(self,**kargs):
+        return BIBase.SimulationConditionsBASE(FocalLength=60e-3,Aperture=0.05,**kargs)
+
+class _EstimateRunSim(BIBase.RUN_SIM_BASE):
+    def CreateSimObject(self,**kargs):
+        return _EstimateSimulations(**kargs)
+
+def test_RunCases_estimate_only(tmp_path):
+    Frequency=500e3
+    PPW=6
+    ID='Subject'
+    os.makedirs(tmp_path/ID)
+    SpatialStep=BIBase.GetSmallestSOS(Frequency,bShear=True)/Frequency/PPW
+    shape=(int(0.05/SpatialStep),int(0.05/SpatialStep),int(0.06/SpatialStep))
+    Mask=np.flip(_SyntheticSkullMask(shape,(shape[0]//2,shape[1]//2,int(0.04/SpatialStep))),axis=2)
+    affine=np.diag([SpatialStep*1e3]*3+[1])
+    for target in ['T1','T2']:
+        nibabel.save(nibabel.Nifti1Image(Mask,affine),str(tmp_path/ID/(target+'_500kHz_6PPW_BabelViscoInput.nii.gz')))
+    bGPU_INITIALIZED=BIBase.bGPU_INITIALIZED
+    Costs=_EstimateRunSim().RunCases(targets=['T1','T2'],ID=ID,basedir=str(tmp_path)+os.sep,deviceName='NoDevice',
+                                     Frequencies=[Frequency],basePPW=[PPW],bTightNarrowBeamDomain=True,
+                                     bDoRefocusing=True,bEstimateOnly=True)
+    # no device is initialized and nothing is written
+    assert BIBase.bGPU_INITIALIZED==bGPU_INITIALIZED
+    assert sorted(os.listdir(tmp_path/ID))==['T1_500kHz_6PPW_BabelViscoInput.nii.gz','T2_500kHz_6PPW_BabelViscoInput.nii.gz']
+    assert [os.path.basename(c['DataForSim']) for c in Costs]==['T1_500kHz_6PPW_DataForSim.h5','T2_500kHz_6PPW_DataForSim.h5']
+
+    # same domain as the full preparation of the case
+    TestClass=_EstimateSimulations(MASKFNAME=str(tmp_path/ID/'T1_500kHz_6PPW_BabelViscoInput.nii.gz'),Frequency=Frequency,
+                                   basePPW=PPW,AlphaCFL=0.5,SensorSubSampling=0,bTightNarrowBeamDomain=True,bDisplay=False)
+    TestClass.Step1_InitializeConditions()
+    SIM=TestClass._SIM_SETTINGS
+    Truth=_IterativeFitDomainToRayleighMap(SIM,SIM._SpatialStep)
+    for Cost in Costs:
+        assert (Cost['N1'],Cost['N2'],Cost['N3'])==Truth['N']==(SIM._N1,SIM._N2,SIM._N3)
+        assert Cost['TemporalStep']==SIM._TemporalStep
+        assert Cost['SensorSubSampling']==SIM._SensorSubSampling
+        assert Cost['TimeSteps']==int(np.round(SIM._TimeSimulation/SIM._TemporalStep))
+        assert Cost['DeviceMemory']>SIM._MaterialMap.size*4
+        assert Cost['Runtime']>0
+
+class _StubPipelineSimulation(object):
+    #records the Tx settings and the domain it used in its output, device steps must run in the thread calling RunCases
+    def __init__(self,MASKFNAME,Frequency,basePPW,CaseContext,XSteering,ZSteering,MainThread,**kargs):
+        self._MASKFNAME=MASKFNAME
+        self._Frequency=Frequency
+        self._CaseContext=CaseContext
+        self._XSteering=XSteering
+        self._ZSteering=ZSteering
+        self._MainThread=MainThread
+        self._Steps=[]
+
+    def _Step(self,name,bDevice=False):
+        assert (threading.current_thread() is self._MainThread) or not bDevice
+        time.sleep(0.01 if bDevice else 0.02)
+        self._Steps.append(name)
+
+    def Step1_InitializeConditions(self,bPlanOnly=False):
+        self._Step('1')
+        self._Mask=''
+        if os.path.isfile(self._MASKFNAME):
+            with open(self._MASKFNAME) as f:
+                self._Mask=f.read()
+        Domain=None
+        if self._CaseContext is not None:
+            Domain=self._CaseContext.get('Domain',None)
+        if Domain is None:
+            # the domain depends on the axial steering, not on the lateral one
+            Domain=(os.path.basename(self._MASKFNAME),self._ZSteering)
+            if self._CaseContext is not None:
+                self._CaseContext['Domain']=Domain
+                self._CaseContext['nDomainCalculations']=self._CaseContext.get('nDomainCalculations',0)+1
+        assert Domain[1]==self._ZSteering
+        self._Domain=Domain
+
+    def Step2_CalculateRayleighFieldsForward(self,prefix='',deviceName='',bSkipSavingSTL=False):
+        self._Step('2',True)
+    def Step3_CreateSourceSignal_and_Sensor(self):
+        self._Step('3',True)
+    def Step4_Run_Simulation(self,GPUName='',COMPUTING_BACKEND=1):
+        self._Step('4',True)
+    def PrepareRayleighFieldSubVolume(self):
+        self._Step('Rayleigh',True)
+    def Step5_ExtractPhaseDataForwardandBack(self):
+        self._Step('5')
+    def Step9_PrepAndPlotData(self):
+        self._Step('9')
+
+    def Step10_GetResults(self,FILENAMES,subsamplingFactor=1,bMinimalSaving=False,bUseRayleighForWater=False,FILENAMESWater=None):
+        self._Step('10')
+        with open(FILENAMES['DataForSim'],'w') as f:
+            f.write(repr((self._Frequency,self._XSteering,self._ZSteering,self._Domain,self._Steps,self._Mask)))
+
+class _StubPipelineRunSim(BIBase.RUN_SIM_BASE):
+    CaseContextSharedSettings=('_XSteering',)
+    def __init__(self):
+        self._XSteering=0.0
+        self._ZSteering=0.0
+
+    def CreateSimObject(self,**kargs):
+        return _StubPipelineSimulation(XSteering=self._XSteering,ZSteering=self._ZSteering,
+                                       MainThread=threading.main_thread(),**kargs)
+
+def _RunStubCases(basedir,nCaseWorkers,CaseVariants=None):
+    os.makedirs(os.path.join(basedir,'Subject'))
+    RunSim=_StubPipelineRunSim()
+    OutNames=RunSim.RunCases(targets=['T1','T2'],ID='Subject',basedir=basedir+os.sep,deviceName='NoDevice',
+                             Frequencies=[500e3,250e3],basePPW=[6],CaseVariants=CaseVariants,
+                             nCaseWorkers=nCaseWorkers,MaxCasesInFlight=2)
+    Results={}
+    for fname in OutNames:
+        with open(fname) as f:
+            Results[os.path.basename(fname)]=eval(f.read())
+    Contexts=sorted((c['Domain'],c['nDomainCalculations']) for c in RunSim._CaseContexts.values())
+    return [os.path.basename(f) for f in OutNames],Results,Contexts
+
+@pytest.mark.parametrize('nCaseWorkers',[2,3])
+def test_RunCases_pipelined_matches_serial(tmp_path,monkeypatch,nCaseWorkers):
+    monkeypatch.setattr(BIBase,'bGPU_INITIALIZED',True)
+    Serial=_RunStubCases(str(tmp_path/'serial'),0)
+    Pipelined=_RunStubCases(str(tmp_path/'pipelined'),nCaseWorkers)
+    assert Pipelined==Serial
+    Names,Results,Contexts=Serial
+    assert Names==['T1_500kHz_6PPW_DataForSim.h5','T1_250kHz_6PPW_DataForSim.h5',
+                   'T2_500kHz_6PPW_DataForSim.h5','T2_250kHz_6PPW_DataForSim.h5']
+    for name,(Frequency,XSteering,ZSteering,Domain,Steps,Mask) in Results.items():
+        assert Steps==['1','2','3','4','Rayleigh','5','9','10']
+        assert Domain==(name.replace('DataForSim.h5','BabelViscoInput.nii.gz'),0.0)
+    # one context per case, each domain is calculated once
+    assert [n for _,n in Contexts]==[1]*4
+
+_StubCaseVariants=[{'extrasuffix':'X0_Z0_','TxSettings':{'_XSteering':0.0,'_ZSteering':0.0}},
+                   {'extrasuffix':'X2_Z0_','TxSettings':{'_XSteering':2e-3,'_ZSteering':0.0}},
+                   {'extrasuffix':'X0_Z5_','TxSettings':{'_XSteering':0.0,'_ZSteering':5e-3}}]
+
+@pytest.mark.parametrize('nCaseWorkers',[0,3])
+def test_RunCases_case_variants_contexts(tmp_path,monkeypatch,nCaseWorkers):
+    monkeypatch.setattr(BIBase,'bGPU_INITIALIZED',True)
+    monkeypatch.setattr(_StubPipelineRunSim,'MaxCaseContexts',8)
+    Names,Results,Contexts=_RunStubCases(str(tmp_path),nCaseWorkers,CaseVariants=_StubCaseVariants)
+    assert len(Names)==12
+    assert Names[:2]==['T1_500kHz_6PPW_X0_Z0_DataForSim.h5','T1_250kHz_6PPW_X0_Z0_DataForSim.h5']
+    for name,(Frequency,XSteering,ZSteering,Domain,Steps,Mask) in Results.items():
+        assert ('X2_' in name)==(XSteering==2e-3) and ('Z5_' in name)==(ZSteering==5e-3)
+    # the lateral steering shares the context of the case, the axial steering needs its own
+    assert len(Contexts)==8
+    assert [n for _,n in Contexts]==[1]*8
+    assert Results['T2_250kHz_6PPW_X2_Z0_DataForSim.h5'][3]==Results['T2_250kHz_6PPW_X0_Z0_DataForSim.h5'][3]
+    assert Results['T2_250kHz_6PPW_X0_Z5_DataForSim.h5'][3]==('T2_250kHz_6PPW_BabelViscoInput.nii.gz',5e-3)
+
+def test_RunCases_acoustic_cache(tmp_path,monkeypatch):
+    monkeypatch.setattr(BIBase,'bGPU_INITIALIZED',True)
+    basedir=str(tmp_path)+os.sep
+    os.makedirs(tmp_path/'Subject')
+    MaskName=str(tmp_path/'Subject'/'T1_500kHz_6PPW_BabelViscoInput.nii.gz')
+    def RunCase(Mask,bForceRecalc=False):
+        with open(MaskName,'w') as f:
+            f.write(Mask)
+        fname=_StubPipelineRunSim().RunCases(targets=['T1'],ID='Subject',basedir=basedir,deviceName='NoDevice',
+                                             Frequencies=[500e3],basePPW=[6],bForceRecalc=bForceRecalc,
+                                             AcousticCacheDir=str(tmp_path/'cache'))[0]
+        with open(fname) as f:
+            return eval(f.read())[5]
+    assert RunCase('mask A')=='mask A'
+    # results of a previous mask are not reused
+    assert RunCase('mask B')=='mask B'
+    # unchanged inputs are restored from the cache without simulating
+    def NoSimulation(self,bPlanOnly=False):
+        raise AssertionError('the case should be restored from the cache')
+    with monkeypatch.context() as m:
+        m.setattr(_StubPipelineSimulation,'Step1_InitializeConditions',NoSimulation)
+        assert RunCase('mask A')=='mask A'
+        with pytest.raises(AssertionError):
+            RunCase('mask A',bForceRecalc=True)
+    assert RunCase('mask A',bForceRecalc=True)=='mask A'
+
+def _ForwardSimpleNumPy(cwvnb,center,ds,u0,rf,deviceMetal=None,**kargs):
+    # Rayleigh integral evaluated directly, stands for the GPU kernels
+    u0=np.asarray(u0).reshape(-1)
+    ds=np.asarray(ds).reshape(-1)
+    r=np.linalg.norm(rf[:,None,:].astype(np.float64)-center[None,:,:],axis=2)
+    return (1j*cwvnb/(2*np.pi)*np.exp(-1j*cwvnb*r)/r*ds[None,:]*u0[None,:]).sum(axis=1).astype(np.complex64)
+
+def test_rayleigh_planes_match_full_field(monkeypatch):
+    monkeypatch.setattr(BIBase,'ForwardSimple',_ForwardSimpleNumPy)
+    # chunks smaller than a plane and of several planes
+    for ChunkSize in [300,1200]:
+        Sim=BIBase.SimulationConditionsBASE(RayleighChunkSize=ChunkSize,bDisplay=False)
+        Sim._XDim=np.linspace(-0.01,0.01,21)
+        Sim._YDim=np.linspace(-0.01,0.012,23)
+        Sim._ZDim=np.linspace(0.02,0.05,17)
+        Sim._N1,Sim._N2,Sim._N3=21,23,17
+        Sim._XLOffset,Sim._XROffset,Sim._YLOffset,Sim._YROffset,Sim._ZLOffset,Sim._ZROffset=3,4,3,4,2,3
+        Sim._ZSourceLocation=4
+        rng=np.random.default_rng(0)
+        center=rng.random((30,3))*0.01
+        ds=np.full((30,1),1e-6)
+        u0=((1+rng.random((30,1)))*1e5*np.exp(1j*rng.random((30,1)))).astype(np.complex64)
+        cwvnb=np.complex64(2*np.pi*500e3/1500)
+        Sim.SetRayleighSource(cwvnb,center,ds,u0)
+        # previous implementation, the full field over a 3D meshgrid
+        yp,xp,zp=np.meshgrid(Sim._YDim,Sim._XDim,Sim._ZDim)
+        rf=np.hstack((xp.reshape(-1,1),yp.reshape(-1,1),zp.reshape(-1,1))).astype(np.float32)
+        Full=_ForwardSimpleNumPy(cwvnb,center.astype(np.float32),ds.astype(np.float32),u0,rf).reshape(xp.shape)
+        Tol=1e-5*np.abs(Full).max()
+
+        np.testing.assert_allclose(Sim.CalculateRayleighPlanes(Sim._ZSourceLocation)[:,:,0],Full[:,:,4],rtol=0,atol=Tol)
+        SubVolume=Sim.ReturnRayleighFieldSubVolume()
+        assert Sim._u2RayleighFieldFull is None, "the sub volume must not need the full field"
+        Expected=Full.copy()
+        Expected[:,:,:Sim._ZSourceLocation+1]=0
+        np.testing.assert_allclose(SubVolume,Expected[3:-4,3:-4,2:-3],rtol=0,atol=Tol)
+        np.testing.assert_allclose(Sim._u2RayleighField,Full,rtol=0,atol=Tol)
+        assert Sim.ReturnRayleighFieldSubVolume() is SubVolume
+
+def _LegacyPulseSource(SourcePlane,Frequency,TimeVectorSource,TemporalStep,ramp_length=4):
+    # previous per source loop of the Tx classes
+    ramp_length_points = int(np.round(ramp_length/Frequency/TemporalStep))
+    ramp = (-np.cos(np.arange(0,np.pi,np.pi/ramp_length_points)) + 1) * 0.5
+    SourceMaskIND=np.where(np.abs(SourcePlane)>0)
+    SourceMask=np.zeros(SourcePlane.shape,np.uint32)
+    PulseSource = np.zeros((len(SourceMaskIND[0]),TimeVectorSource.shape[0]))
+    for n,(i,j) in enumerate(zip(SourceMaskIND[0],SourceMaskIND[1])):
+        SourceMask[i,j]=n+1
+        u0=SourcePlane[i,j]
+        PulseSource[n,:] = np.abs(u0) *np.sin(2*np.pi*Frequency*TimeVectorSource+np.angle(u0))
+        PulseSource[n,:len(ramp)]*=ramp
+    return SourceMask,PulseSource
+
+@pytest.mark.parametrize('BlockSize',[4096,37])
+def test_CreateSources_matches_per_source_loop(BlockSize):
+    Sim=BIBase.SimulationConditionsBASE(Frequency=500e3,bDisplay=False)
+    Sim._TemporalStep=1/500e3/23.7
+    Sim._TimeSimulation=1e-4
+    Sim._N1,Sim._N2,Sim._N3=30,28,12
+    Sim._ZSourceLocation=3
+    rng=np.random.default_rng(2)
+    SourcePlane=((rng.random((30,28))*1e5)*np.exp(2j*np.pi*rng.random((30,28)))).astype(np.complex64)
+    SourcePlane[rng.random((30,28))<0.3]=0
+    Sim._SourceMapRayleigh=SourcePlane
+    Sim.CreateSources()
+    TimeVectorSource=Sim.ReturnTimeVectorSource()
+    SourceMask,PulseSource=_LegacyPulseSource(SourcePlane,500e3,TimeVectorSource,Sim._TemporalStep)
+    np.testing.assert_array_equal(Sim._SourceMap[:,:,3],SourceMask)
+    assert Sim._SourceMap[:,:,[0,1,2,4]].max()==0
+    assert Sim._PulseSource.dtype==np.float32
+    np.testing.assert_allclose(Sim._PulseSource,PulseSource,rtol=0,atol=1e-5*np.abs(PulseSource).max())
+    Blocks=Sim.BuildPulseSource(SourcePlane[np.abs(SourcePlane)>0],TimeVectorSource,BlockSize=BlockSize)
+    np.testing.assert_array_equal(Blocks,Sim._PulseSource)
+
+@pytest.mark.parametrize('dtype',[np.float32,np.float64])
+@pytest.mark.parametrize('nThreads',[1,3])
+def test_SingleFrequencyProjection_matches_fft(dtype,nThreads):
+    Sim=BIBase.SimulationConditionsBASE(bDisplay=False)
+    rng=np.random.default_rng(3)
+    t=np.arange(241)
+    Pressure=(rng.random((1000,1))*np.sin(2*np.pi*12*t/241+rng.random((1000,1))*6)+
+              0.1*rng.standard_normal((1000,241))).astype(dtype)
+    for IndSpectrum in [12,120]:
+        FSignal,Peak=Sim.SingleFrequencyProjection(Pressure,IndSpectrum,nStep=170,nThreads=nThreads)
+        Expected=np.fft.fft(Pressure,axis=1)[:,IndSpectrum]
+        assert FSignal.dtype==np.complex64
+        np.testing.assert_allclose(FSignal,Expected,rtol=0,atol=1e-5*np.abs(Expected).max())
+        np.testing.assert_array_equal(Peak,Pressure.max(axis=1).astype(np.float32))
+    assert Sim.SingleFrequencyProjection(Pressure,12,bPeak=False)[1] is None
+
+def _ResultsSimulation(bCT):
+    # simulation maps of a domain with PML and padding covering a shrunk region of the mask
+    rng=np.random.default_rng(4)
+    Sim=BIBase.SimulationConditionsBASE(bDisplay=False)
+    MaskShape=(40,44,50)
+    Sim._SkullMaskDataOrig=rng.integers(0,5,MaskShape).astype(np.float64)
+    Sim._XShrink_L,Sim._XShrink_R,Sim._YShrink_L,Sim._YShrink_R,Sim._ZShrink_L,Sim._ZShrink_R=3,0,0,5,2,7
+    Sim._XLOffset,Sim._XROffset,Sim._YLOffset,Sim._YROffset,Sim._ZLOffset,Sim._ZROffset=6,8,7,6,10,6
+    Shape=(MaskShape[0]-3+14,MaskShape[1]-5+13,MaskShape[2]-9+16)
+    Sim._ZSourceLocation=12
+    for k in ['_InPeakValue','_PhaseMap','_InPeakValueRefocus','_PhaseMapRefocus']:
+        setattr(Sim,k,rng.random(Shape).astype(np.float32))
+    for k in ['_PressMapFourier','_PressMapFourierRefocus']:
+        setattr(Sim,k,(rng.random(Shape)+1j*rng.random(Shape)).astype(np.complex64))
+    Sim._MaterialMap=rng.integers(0,5,Shape).astype(np.uint32)
+    Sim._DensityCTMap=None
+    if bCT:
+        Sim._DensityCTMap=np.ones(Shape,np.float32)
+        Sim._MaterialMapNoCT=Sim._MaterialMap.copy()
+        Sim._MaterialMap=rng.integers(0,9,Shape).astype(np.uint32)
+    Sim._FocalSpotLocation=np.array([20,22,30])
+    Sim._u2RayleighFieldFull=None
+    Sim._u2RayleighSubVolume=(rng.random((MaskShape[0]-3,MaskShape[1]-5,MaskShape[2]-9))+
+                              1j*rng.random((MaskShape[0]-3,MaskShape[1]-5,MaskShape[2]-9))).astype(np.complex64)
+    Sim._Materials=[[1000,1500,0,0,0]]
+    Sim._XDim,Sim._YDim,Sim._ZDim=[np.arange(n)*1e-3 for n in Shape]
+    Sim._SpatialStep=1e-3
+    Sim._zLengthBeyonFocalPointWhenNarrow=4e-2
+    return Sim
+
+def _LegacyResultVolume(Sim,Sub):
+    # previous ReturnResults, copy in a zeroed mask sized volume and flip
+    upper=[-s if s>0 else n for s,n in zip([Sim._XShrink_R,Sim._YShrink_R,Sim._ZShrink_R],Sim._SkullMaskDataOrig.shape)]
+    Volume=np.zeros(Sim._SkullMaskDataOrig.shape,Sub.dtype)
+    Volume[Sim._XShrink_L:upper[0],Sim._YShrink_L:upper[1],Sim._ZShrink_L:upper[2]]=Sub
+    return np.flip(Volume,axis=2)
+
+@pytest.mark.parametrize('bCT',[False,True])
+@pytest.mark.parametrize('bDoRefocusing',[False,True])
+def test_ReturnResultVolume_matches_copy_and_flip(bCT,bDoRefocusing):
+    Sim=_ResultsSimulation(bCT)
+    Domain=(slice(Sim._XLOffset,-Sim._XROffset),slice(Sim._YLOffset,-Sim._YROffset),slice(Sim._ZLOffset,-Sim._ZROffset))
+    Maps={k:getattr(Sim,k).copy() for k in ['_InPeakValue','_PhaseMap','_InPeakValueRefocus','_PhaseMapRefocus',
+                                             '_PressMapFourier','_PressMapFourierRefocus','_MaterialMap']}
+    for k in Maps:
+        if k!='_MaterialMap':
+            Maps[k][:,:,:Sim._ZSourceLocation+1]=0
+    Rayleigh=_LegacyResultVolume(Sim,Sim._u2RayleighSubVolume)
+    Expected={'RayleighWater':np.abs(Rayleigh),
+              'RayleighWaterPhase':np.angle(Rayleigh),
+              'FullSolutionPressure':_LegacyResultVolume(Sim,Maps['_InPeakValue'][Domain]),
+              'FullSolutionPhase':_LegacyResultVolume(Sim,Maps['_PhaseMap'][Domain])}
+    Expected['RayleighWaterOverlay']=Expected['RayleighWater']+np.flip(Sim._SkullMaskDataOrig,axis=2)*Expected['RayleighWater'].max()/10
+    if bDoRefocusing:
+        Expected['FullSolutionPressureRefocus']=_LegacyResultVolume(Sim,Maps['_InPeakValueRefocus'][Domain])
+        Expected['FullSolutionPhaseRefocus']=_LegacyResultVolume(Sim,Maps['_PhaseMapRefocus'][Domain])
+
+    Sim.PrepareResults(bDoRefocusing)
+    for k,v in Expected.items():
+        Volume=Sim.ReturnResultVolume(k)
+        assert Volume.shape==Sim._SkullMaskDataOrig.shape and Volume.dtype==np.float32
+        np.testing.assert_allclose(Volume,v,rtol=1e-6,atol=1e-6,err_msg=k)
+    with pytest.raises(ValueError):
+        Sim.ReturnResultVolume('MaskCalcRegions')
+
+    mx,my,mz=Sim.ReturnCalcRegionBounds()
+    MaskCalcRegions=_LegacyResultVolume(Sim,np.ones(Sim._u2RayleighSubVolume.shape,bool))
+    for b,ind in zip([mx,my,mz],np.where(MaskCalcRegions)):
+        assert b==[ind.min(),ind.max()]
+
+    DataForSim=Sim.ReturnDataForSim(bDoRefocusing,bUseRayleighForWater=True)
+    MaterialMap=(Maps['_MaterialMap'] if not bCT else Sim._MaterialMapNoCT).copy()
+    MaterialMap[tuple(Sim._FocalSpotLocation)]=5
+    MaterialMap=MaterialMap[Domain]
+    TargetLocation=np.array(np.where(MaterialMap==5)).flatten()
+    MaterialMap[MaterialMap==5]=4
+    ExpectedData={'p_amp':Maps['_InPeakValue'][Domain],'p_complex':Maps['_PressMapFourier'][Domain],'MaterialMap':MaterialMap,
+                  'p_complex_water':Sim._u2RayleighSubVolume,'p_amp_water':np.abs(Sim._u2RayleighSubVolume)}
+    if bDoRefocusing:
+        ExpectedData['p_amp_refocus']=Maps['_InPeakValueRefocus'][Domain]
+        ExpectedData['p_complex_refocus']=Maps['_PressMapFourierRefocus'][Domain]
+    if bCT:
+        ExpectedData['MaterialMapCT']=Maps['_MaterialMap'][Domain]
+    assert set(DataForSim)==set(ExpectedData)|{'Material','x_vec','y_vec','z_vec','SpatialStep','TargetLocation','zLengthBeyonFocalPoint'}
+    for k,v in ExpectedData.items():
+        np.testing.assert_array_equal(DataForSim[k],np.flip(v,axis=2),err_msg=k)
+    np.testing.assert_array_equal(DataForSim['TargetLocation'],TargetLocation)
+    # the simulation maps are not modified by marking the target
+    np.testing.assert_array_equal(Sim._MaterialMap,Maps['_MaterialMap'])
+
+def _SitkEnforcedISO(nii,fn):
+    # previous implementation, round trip through SimpleITK
+    import SimpleITK as sitk
+    nii.to_filename(fn)
+    res = float(np.round(np.array(nii.header.get_zooms()).mean(),5))
+    pre=sitk.ReadImage(fn)
+    pre.SetSpacing([res,res,res])
+    sitk.WriteImage(pre,fn.replace('__.nii.gz','_sitk.nii.gz'))
+    return nibabel.load(fn.replace('__.nii.gz','_sitk.nii.gz'))
+
+@pytest.mark.parametrize('Shear',[0.0,1e-3])
+def test_SaveNiftiEnforcedISO_matches_sitk(tmp_path,Shear):
+    rng=np.random.default_rng(5)
+    Rot,_=np.linalg.qr(rng.standard_normal((3,3)))
+    affine=np.eye(4)
+    affine[:3,:3]=Rot@np.diag([0.5,0.6,0.75])
+    affine[0,1]+=Shear
+    affine[:3,3]=[-30.2,12.5,40.1]
+    nii=nibabel.Nifti1Image(rng.random((20,22,18)).astype(np.float32),affine)
+    nii.set_qform(affine,code=1)
+    nii.set_sform(affine,code=1)
+    Expected=_SitkEnforcedISO(nii,str(tmp_path/'ref__.nii.gz'))
+    for GzipLevel in [1,6]:
+        fn=str(tmp_path/('new%i__.nii.gz' % GzipLevel))
+        Saved=BIBase.SaveNiftiEnforcedISO(nii,fn,GzipLevel=GzipLevel)
+        assert not os.path.isfile(fn)
+        Result=nibabel.load(fn.replace('__.nii.gz','.nii.gz'))
+        np.testing.assert_allclose(Result.header.get_zooms(),Expected.header.get_zooms(),rtol=1e-5)
+        np.testing.assert_allclose(Result.affine,Expected.affine,atol=1e-4)
+        np.testing.assert_allclose(Saved.affine,Result.affine,atol=1e-5)
+        np.testing.assert_array_equal(Result.get_fdata(),Expected.get_fdata())
@@ -0,0 +1,98 @@
+import h5py
+import numpy as np
+import pytest
+from BabelViscoFDTD.H5pySimple import SaveToH5py
+
+from TranscranialModeling.DataForSimH5 import DATAFORSIM_FORMAT_VERSION,ReadDataForSim,SaveDataForSim
+
+def _DataForSim():
+    rng=np.random.default_rng(0)
+    shape=(30,26,40)
+    return {'p_amp':rng.random(shape).astype(np.float32),
+            'p_complex':(rng.random(shape)+1j*rng.random(shape)).astype(np.complex64),
+            'MaterialMap':rng.integers(0,5,shape).astype(np.uint32),
+            'MaterialMapCT':rng.integers(0,1024,shape).astype(np.uint32),
+            'Material':rng.random((5,5)),
+            'x_vec':np.linspace(-0.02,0.02,shape[0]),
+            'TargetLocation':np.array([15,13,20]),
+            'ZSteering':0.01,
+            'bDoRefocusing':False}
+
+def _AssertSameData(Data,Truth):
+    assert sorted(Data.keys())==sorted(Truth.keys())
+    for k,v in Truth.items():
+        if type(v) is np.ndarray:
+            assert Data[k].dtype==v.dtype
+            np.testing.assert_array_equal(Data[k],v)
+        else:
+            assert Data[k]==v
+
+def test_round_trip(tmp_path):
+    fname=str(tmp_path/'DataForSim.h5')
+    Truth=_DataForSim()
+    SaveDataForSim(Truth,fname)
+    Data=ReadDataForSim(fname)
+    assert Data.FormatVersion==DATAFORSIM_FORMAT_VERSION
+    _AssertSameData(Data,Truth)
+
+def test_legacy_file(tmp_path):
+    fname=str(tmp_path/'DataForSim.h5')
+    Truth=_DataForSim()
+    SaveToH5py(Truth,fname)
+    Data=ReadDataForSim(fname)
+    assert Data.FormatVersion==0
+    _AssertSameData(Data,Truth)
+
+def test_lazy_load(tmp_path):
+    fname=str(tmp_path/'DataForSim.h5')
+    Truth=_DataForSim()
+    SaveDataForSim(Truth,fname)
+    Data=ReadDataForSim(fname)
+    # small entries are read on open, volumes only when accessed
+    assert Data['ZSteering']==Truth['ZSteering']
+    assert not any(k in Data._Data for k in ['p_amp','p_complex','MaterialMap','MaterialMapCT'])
+    assert 'MaterialMapCT' in Data
+    assert 'MaterialMapCT' not in Data._Data
+    assert 'RotationZ' not in Data
+    np.testing.assert_array_equal(Data['p_amp'],Truth['p_amp'])
+    assert 'p_amp' in Data._Data
+    assert 'MaterialMapCT' not in Data._Data
+    # assigned entries stay in memory
+    Data['p_amp']=Data['p_amp']*2
+    np.testing.assert_array_equal(Data['p_amp'],Truth['p_amp']*2)
+    del Data['MaterialMapCT']
+    assert 'MaterialMapCT' not in Data
+    with pytest.raises(KeyError):
+        Data['MaterialMapCT']
+
+def test_planes_are_chunks(tmp_path):
+    fname=str(tmp_path/'DataForSim.h5')
+    Truth=_DataForSim()
+    SaveDataForSim(Truth,fname,ChunkBytes=Truth['p_amp'][:,:,0].nbytes*4)
+    with h5py.File(fname,'r') as f:
+        assert f['p_amp'].chunks==(30,26,4)
+        assert f['p_complex'].chunks==(30,26,2)
+        np.testing.assert_array_equal(f['p_amp'][:,:,17],Truth['p_amp'][:,:,17])
+        np.testing.assert_array_equal(f['MaterialMap'][3:9,:,5:7],Truth['MaterialMap'][3:9,:,5:7])
+
+@pytest.mark.parametrize('bLegacy',[False,True])
+def test_read_slice(tmp_path,bLegacy):
+    fname=str(tmp_path/'DataForSim.h5')
+    Truth=_DataForSim()
+    if bLegacy:
+        SaveToH5py(Truth,fname)
+    else:
+        SaveDataForSim(Truth,fname,ChunkBytes=Truth['p_amp'][:,:,0].nbytes*4)
+    Data=ReadDataForSim(fname)
+    for k in ['p_amp','p_complex','MaterialMap']:
+        for sel in [np.s_[:,:,17],np.s_[3:9,:,5:7],np.s_[:,4,:]]:
+            Plane=Data.ReadSlice(k,sel)
+            assert Plane.dtype==Truth[k].dtype
+            np.testing.assert_array_equal(Plane,Truth[k][sel])
+        assert k not in Data._Data, "slices must not load the volume"
+    # loaded and assigned entries are sliced in memory
+    Data['p_amp']=Truth['p_amp']*2
+    np.testing.assert_array_equal(Data.ReadSlice('p_amp',np.s_[:,:,3]),Truth['p_amp'][:,:,3]*2)
+    np.testing.assert_array_equal(Data.ReadSlice('Material',np.s_[1,:]),Truth['Material'][1,:])
+    with pytest.raises(KeyError):
+        Data.ReadSlice('RotationZ',np.s_[:,:,0])
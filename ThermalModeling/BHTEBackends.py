@@ -0,0 +1,210 @@
+'''
+BHTE and BHTEMultiplePressureFields with the same signature and outputs as BabelViscoFDTD, adding Backend='CPU'
+
+The CPU backend runs the same explicit stencil as the GPU kernel (conduction, perfusion, heat source and CEM43
+accumulation) in single precision. It uses a multithreaded Numba kernel when numba is available and a vectorized
+NumPy step otherwise. Any other Backend is passed to BabelViscoFDTD.
+'''
+import time
+import numpy as np
+from BabelViscoFDTD.tools.RayleighAndBHTE import (getBHTECoefficient,getPerfusionCoefficient,getQCoeff)
+from BabelViscoFDTD.tools.RayleighAndBHTE import BHTE as BHTEGPU
+from BabelViscoFDTD.tools.RayleighAndBHTE import BHTEMultiplePressureFields as BHTEMultiplePressureFieldsGPU
+
+TREF=np.float32(43.0)
+
+try:
+    from numba import njit, prange
+
+    @njit(inline='always')
+    def _DoseIncrement(Tin,Tout,dt):
+        #a step starting or ending at TREF does not cross it, both ends use the same R
+        R1=np.float32(0.5) if Tin>TREF or (Tin==TREF and Tout>=TREF) else np.float32(0.25)
+        R2=np.float32(0.5) if Tout>TREF or (Tout==TREF and Tin>=TREF) else np.float32(0.25)
+        if abs(Tout-Tin)<np.float32(0.0001):
+            return dt*R1**(TREF-Tin)
+        elif R1==R2:
+            return (R2**(TREF-Tout)-R1**(TREF-Tin))/(-(Tout-Tin)/dt*np.log(R1))
+        else:
+            dtp=dt*(TREF-Tin)/(Tout-Tin)
+            return (np.float32(1)-R1**(TREF-Tin))/(-(TREF-Tin)/dtp*np.log(R1))+\
+                   (R2**(TREF-Tout)-np.float32(1))/(-(Tout-TREF)/(dt-dtp)*np.log(R2))
+
+    @njit(parallel=True,cache=True)
+    def _BHTEStepNumba(T1,Dose1,T0,Dose0,bhArr,perfArr,MaterialMap,Qarr,CoreTemp,bSonication,dt):
+        N1,N2,N3=T0.shape
+        six=np.float32(6.0)
+        for i in prange(N1):
+            for j in range(N2):
+                for k in range(N3):
+                    if i==0 or i==N1-1 or j==0 or j==N2-1 or k==0 or k==N3-1:
+                        T1[i,j,k]=T0[i,j,k]
+                        Dose1[i,j,k]=Dose0[i,j,k]
+                        continue
+                    label=MaterialMap[i,j,k]
+                    Tin=T0[i,j,k]
+                    Tout=Tin+bhArr[label]*(T0[i,j,k+1]+T0[i,j,k-1]+T0[i,j+1,k]+T0[i,j-1,k]+
+                                           T0[i+1,j,k]+T0[i-1,j,k]-six*Tin)+perfArr[label]*(CoreTemp-Tin)
+                    if bSonication:
+                        Tout+=Qarr[i,j,k]
+                    T1[i,j,k]=Tout
+                    Dose1[i,j,k]=Dose0[i,j,k]+_DoseIncrement(Tin,Tout,dt)
+    bNumba=True
+except ImportError:
+    bNumba=False
+
+def _DoseIncrementNumpy(Tin,Tout,dt):
+    R1=np.where((Tin>TREF)|((Tin==TREF)&(Tout>=TREF)),np.float32(0.5),np.float32(0.25))
+    R2=np.where((Tout>TREF)|((Tout==TREF)&(Tin>=TREF)),np.float32(0.5),np.float32(0.25))
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        Flat=dt*R1**(TREF-Tin)
+        Same=(R2**(TREF-Tout)-R1**(TREF-Tin))/(-(Tout-Tin)/dt*np.log(R1))
+        dtp=dt*(TREF-Tin)/(Tout-Tin)
+        Cross=(1-R1**(TREF-Tin))/(-(TREF-Tin)/dtp*np.log(R1))+(R2**(TREF-Tout)-1)/(-(Tout-TREF)/(dt-dtp)*np.log(R2))
+    return np.where(np.abs(Tout-Tin)<np.float32(0.0001),Flat,np.where(R1==R2,Same,Cross)).astype(np.float32)
+
+def _BHTEStepNumpy(T1,Dose1,T0,Dose0,bhArr,perfArr,MaterialMap,Qarr,CoreTemp,bSonication,dt):
+    I=(slice(1,-1),)*3
+    Labels=MaterialMap[I]
+    Tin=T0[I]
+    Tout=Tin+bhArr[Labels]*(T0[1:-1,1:-1,2:]+T0[1:-1,1:-1,:-2]+T0[1:-1,2:,1:-1]+T0[1:-1,:-2,1:-1]+
+                            T0[2:,1:-1,1:-1]+T0[:-2,1:-1,1:-1]-np.float32(6.0)*Tin)+perfArr[Labels]*(CoreTemp-Tin)
+    if bSonication:
+        Tout+=Qarr[I]
+    T1[:]=T0
+    Dose1[:]=Dose0
+    T1[I]=Tout
+    Dose1[I]+=_DoseIncrementNumpy(Tin,Tout,dt)
+
+def ReturnThermalCoefficients(MaterialMap,MaterialList,dx,TotalDurationSteps,dt,blood_rho,blood_ct):
+    '''
+    Per material arrays of conduction, perfusion, heat source coefficients and initial temperature, as in BabelViscoFDTD
+    '''
+    n_materials = int(MaterialMap.max()) + 1
+    perfArr   = np.zeros(n_materials, np.float32)
+    bhArr     = np.zeros(n_materials, np.float32)
+    qCoeffs   = np.zeros(n_materials, np.float32)
+    initTemps = np.zeros(n_materials, np.float32)
+    for n in range(n_materials):
+        bhArr[n] = getBHTECoefficient(MaterialList["Conductivity"][n],MaterialList["Density"][n],
+                                      MaterialList["SpecificHeat"][n],dx,TotalDurationSteps,dt=dt)
+        perfArr[n] = getPerfusionCoefficient(MaterialList["Perfusion"][n],MaterialList["SpecificHeat"][n],
+                                             blood_rho,blood_ct,dt=dt)
+        qCoeffs[n] = getQCoeff(MaterialList["Density"][n],MaterialList["SoS"][n],MaterialList["Attenuation"][n],
+                               MaterialList["SpecificHeat"][n],MaterialList["Absorption"][n],dx,dt)
+        initTemps[n] = MaterialList["InitTemperature"][n]
+    return bhArr,perfArr,qCoeffs,initTemps
+
+def _RunBHTECPU(QFields,SegmentSchedule,MaterialMap,bhArr,perfArr,initTemp,initDose,TotalDurationSteps,
+                LocationMonitoring,nFactorMonitoring,dt,stableTemp,MonitoringPointsMap,bUseNumba):
+    '''
+    Time loop shared by BHTECPU and BHTEMultiplePressureFieldsCPU, SegmentSchedule(n) returns (field index, sonication flag)
+    '''
+    N1,N2,N3=MaterialMap.shape
+    MaterialMap=np.ascontiguousarray(MaterialMap)
+    T0=np.array(initTemp,np.float32)
+    Dose0=np.array(initDose,np.float32) if initDose is not None else np.zeros(MaterialMap.shape,np.float32)
+    T1=np.zeros_like(T0)
+    Dose1=np.zeros_like(Dose0)
+    CoreTemp=np.float32(stableTemp)
+    dt32=np.float32(dt)
+
+    TotalStepsMonitoring=int(TotalDurationSteps/nFactorMonitoring)
+    if TotalStepsMonitoring % nFactorMonitoring!=0:
+        TotalStepsMonitoring+=1
+    if LocationMonitoring>=0:
+        MonitorSlice=np.zeros((N1,N3,TotalStepsMonitoring),np.float32)
+    else:
+        print('Not collecting MonitorSlice')
+        MonitorSlice=np.zeros((0),np.float32)
+
+    #as in the GPU kernel, only interior voxels are recorded
+    bInteriorSlice = LocationMonitoring>0 and LocationMonitoring<N2-1
+    if MonitoringPointsMap is not None:
+        assert(MonitoringPointsMap.shape==MaterialMap.shape and MonitoringPointsMap.dtype==np.uint32)
+        TemperaturePoints=np.zeros((int((MonitoringPointsMap>0).sum()),TotalDurationSteps),np.float32)
+        Interior=np.zeros(MaterialMap.shape,bool)
+        Interior[1:-1,1:-1,1:-1]=True
+        PointsIndex=np.flatnonzero((MonitoringPointsMap>0)&Interior)
+        PointsRow=MonitoringPointsMap.ravel()[PointsIndex].astype(np.int64)-1
+
+    StepFunction=_BHTEStepNumba if (bUseNumba and bNumba) else _BHTEStepNumpy
+    nFraction=max(int(TotalDurationSteps/10),1)
+    T0Clock=time.time()
+    for n in range(TotalDurationSteps):
+        nField,dUS=SegmentSchedule(n)
+        StepFunction(T1,Dose1,T0,Dose0,bhArr,perfArr,MaterialMap,QFields[nField],CoreTemp,dUS,dt32)
+        if bInteriorSlice and n % nFactorMonitoring==0:
+            MonitorSlice[1:-1,1:-1,n//nFactorMonitoring]=T1[1:-1,LocationMonitoring,1:-1]
+        if MonitoringPointsMap is not None:
+            TemperaturePoints[PointsRow,n]=T1.ravel()[PointsIndex]
+        T0,T1=T1,T0
+        Dose0,Dose1=Dose1,Dose0
+        if n % nFraction == 0:
+            print(n, TotalDurationSteps)
+    Elapsed=time.time()-T0Clock
+    print('CPU BHTE time per voxel-step (ns)',Elapsed/max(TotalDurationSteps,1)/T0.size*1e9)
+
+    if MonitoringPointsMap is not None:
+        return T0, Dose0, MonitorSlice, TemperaturePoints
+    return T0, Dose0, MonitorSlice, None
+
+def BHTECPU(Pressure,MaterialMap,MaterialList,dx,TotalDurationSteps,nStepsOn,LocationMonitoring,
+            nFactorMonitoring=1,dt=0.1,blood_rho=1050,blood_ct=3617,stableTemp=37.0,DutyCycle=1.0,
+            MonitoringPointsMap=None,initT0=None,initDose=None,bUseNumba=True):
+    '''
+    CPU version of BabelViscoFDTD BHTE
+    '''
+    bhArr,perfArr,qCoeffs,initTemps=ReturnThermalCoefficients(MaterialMap,MaterialList,dx,TotalDurationSteps,dt,blood_rho,blood_ct)
+    Qarr = (Pressure ** 2 * qCoeffs[MaterialMap] * np.float32(DutyCycle)).astype(np.float32)
+    initTemp = initTemps[MaterialMap] if initT0 is None else initT0
+    T1,Dose1,MonitorSlice,TemperaturePoints=_RunBHTECPU([Qarr],lambda n: (0,n<nStepsOn),MaterialMap,bhArr,perfArr,
+                                                       initTemp,initDose,TotalDurationSteps,LocationMonitoring,
+                                                       nFactorMonitoring,dt,stableTemp,MonitoringPointsMap,bUseNumba)
+    if MonitoringPointsMap is not None:
+        return T1, Dose1, MonitorSlice, Qarr, TemperaturePoints
+    return T1, Dose1, MonitorSlice, Qarr
+
+def BHTEMultiplePressureFieldsCPU(PressureFields,MaterialMap,MaterialList,dx,TotalDurationSteps,nStepsOnOffList,
+                                  LocationMonitoring,nFactorMonitoring=1,dt=0.1,blood_rho=1050,blood_ct=3617,
+                                  stableTemp=37.0,MonitoringPointsMap=None,initT0=None,initDose=None,bUseNumba=True):
+    '''
+    CPU version of BabelViscoFDTD BHTEMultiplePressureFields
+    '''
+    assert(PressureFields.shape[1:]==MaterialMap.shape)
+    assert(nStepsOnOffList.shape[0]==PressureFields.shape[0])
+    bhArr,perfArr,qCoeffs,initTemps=ReturnThermalCoefficients(MaterialMap,MaterialList,dx,TotalDurationSteps,dt,blood_rho,blood_ct)
+    qCoeffs_3d=qCoeffs[MaterialMap]
+    QArrList=np.zeros(PressureFields.shape,np.float32)
+    for m in range(PressureFields.shape[0]):
+        QArrList[m]=(PressureFields[m]**2*qCoeffs_3d).astype(np.float32)
+    #start, end of sonication and end of off time of each field within a cycle
+    TimingFields=np.zeros((nStepsOnOffList.shape[0],3),np.int32)
+    TimingFields[:,1]=nStepsOnOffList[:,0]
+    TimingFields[:,2]=nStepsOnOffList[:,0]+nStepsOnOffList[:,1]
+    TimingFields+=np.concatenate(([0],np.cumsum(nStepsOnOffList.sum(axis=1))[:-1])).astype(np.int32)[:,np.newaxis]
+    print("TimingFields", TimingFields)
+    NstepsPerCycle=TimingFields[-1,2]
+
+    def SegmentSchedule(n):
+        mStep=n % NstepsPerCycle
+        QSegment=int(np.searchsorted(TimingFields[:,2],mStep,side='right'))
+        return QSegment,mStep<TimingFields[QSegment,1]
+
+    initTemp = initTemps[MaterialMap] if initT0 is None else initT0
+    T1,Dose1,MonitorSlice,TemperaturePoints=_RunBHTECPU(QArrList,SegmentSchedule,MaterialMap,bhArr,perfArr,
+                                                       initTemp,initDose,TotalDurationSteps,LocationMonitoring,
+                                                       nFactorMonitoring,dt,stableTemp,MonitoringPointsMap,bUseNumba)
+    if MonitoringPointsMap is not None:
+        return T1, Dose1, MonitorSlice, QArrList, TemperaturePoints
+    return T1, Dose1, MonitorSlice, QArrList
+
+def BHTE(*args,Backend='OpenCL',**kargs):
+    if Backend=='CPU':
+        return BHTECPU(*args,**kargs)
+    return BHTEGPU(*args,Backend=Backend,**kargs)
+
+def BHTEMultiplePressureFields(*args,Backend='OpenCL',**kargs):
+    if Backend=='CPU':
+        return BHTEMultiplePressureFieldsCPU(*args,**kargs)
+    return BHTEMultiplePressureFieldsGPU(*args,Backend=Backend,**kargs)
@@ -11,11 +11,16 @@ ABOUT:
 import numpy as np
 import matplotlib.pyplot as plt
 from  scipy.io import loadmat,savemat
-from BabelViscoFDTD.tools.RayleighAndBHTE import BHTE,BHTEMultiplePressureFields
+from ThermalModeling.BHTEBackends import BHTE,BHTEMultiplePressureFields
 from BabelViscoFDTD.H5pySimple import SaveToH5py,ReadFromH5py
+from TranscranialModeling.DataForSimH5 import ReadDataForSim
+from ThermalModeling.ThermalOutput import SaveThermalResults
 from scipy.io import loadmat,savemat
+from scipy.ndimage import uniform_filter
 from platform import platform
-from os.path import isfile
+from os.path import isfile,getmtime
+
+_DataForSimCache={}
 
 def GetThermalOutName(InputPData,DurationUS,DurationOff,DutyCycle,Isppa,PRF,Repetitions):
     suffix = '-ThermalField-Duration-%i-DurationOff-%i-DC-%i-Isppa-%2.1fW-PRF-%iHz' % (DurationUS,DurationOff,DutyCycle*1000,Isppa,PRF)
@@ -27,71 +32,293 @@ def GetThermalOutName(InputPData,DurationUS,DurationOff,DutyCycle,Isppa,PRF,Repe
     else:
         return InputPData.split('.h5')[0]+suffix
 
+def ReturnCachedDataForSim(fname):
+    #inputs stay resident in long-lived thermal workers, they are reloaded if the file changes
+    key=(fname,getmtime(fname))
+    if key not in _DataForSimCache:
+        for k in [k for k in _DataForSimCache if k[0]==fname]:
+            _DataForSimCache.pop(k)
+        _DataForSimCache[key]=ReadDataForSim(fname)
+    return _DataForSimCache[key]
+
+def ReturnThermalMaterialList(Input,OutTemperature=37):
+    MaterialList={}
+    MaterialList['Density']=Input['Material'][:,0]
+    MaterialList['SoS']=Input['Material'][:,1]
+    MaterialList['Attenuation']=Input['Material'][:,3]
+    if 'MaterialMapCT' not in Input:
+        #Water, Skin, Cortical, Trabecular, Brain
+
+        #https://itis.swiss/virtual-population/tissue-properties/database/heat-capacity/
+        MaterialList['SpecificHeat']=[4178,3391,1313,2274,3630] #(J/kg/°C)
+        #https://itis.swiss/virtual-population/tissue-properties/database/thermal-conductivity/
+        MaterialList['Conductivity']=[0.6,0.37,0.32,0.31,0.51] # (W/m/°C)
+        #https://itis.swiss/virtual-population/tissue-properties/database/heat-transfer-rate/
+        MaterialList['Perfusion']=np.array([0,106,10,30,559])
+        
+        MaterialList['Absorption']=np.array([0,0.85,0.16,0.15,0.85])
+
+        MaterialList['InitTemperature']=[OutTemperature,37,37,37,37]
+    else:
+        #Water, Skin, Brain and skull material
+        MaterialList['SpecificHeat']=np.zeros_like(MaterialList['SoS'])
+        MaterialList['SpecificHeat'][0:3]=[4178,3391,3630]
+        MaterialList['SpecificHeat'][3:]=(1313+2274)/2
+
+        MaterialList['Conductivity']=np.zeros_like(MaterialList['SoS'])
+        MaterialList['Conductivity'][0:3]=[0.6,0.37,0.51]
+        MaterialList['Conductivity'][3:]=(0.32+0.31)/2
+
+        MaterialList['Perfusion']=np.zeros_like(MaterialList['SoS'])
+        MaterialList['Perfusion'][0:3]=[0,106,559]
+        MaterialList['Perfusion'][3:]=(10+30)/2
+
+        MaterialList['Absorption']=np.zeros_like(MaterialList['SoS'])
+        MaterialList['Absorption'][0:3]=[0,0.85,0.85]
+        MaterialList['Absorption'][3:]=(0.16+0.15)/2
+
+        MaterialList['InitTemperature']=np.zeros_like(MaterialList['SoS'])
+        MaterialList['InitTemperature'][0]=OutTemperature
+        MaterialList['InitTemperature'][1:]=37
+    return MaterialList
+
+def ReturnRegionMasks(MaterialMap,bCT):
+    #skin, brain and skull masks
+    if bCT:
+        SelBrain=MaterialMap==2
+    else:
+        SelBrain=MaterialMap>=4
+
+    SelSkin=MaterialMap==1
+    if bCT:
+        SelSkull =MaterialMap>=3
+    else:
+        SelSkull =(MaterialMap>1) &\
+            (MaterialMap<4)
+    return SelSkin,SelBrain,SelSkull
+
+def ExtrapolateGeometricTail(X1,X2,rho,n):
+    #value after n more cycles of a sequence ending in X1,X2 that converges geometrically with ratio rho
+    Tail=rho*(1.0-rho**n)/(1.0-rho) #sum of rho^j for j=1..n
+    return (X2+(X2-X1)*Tail).astype(X2.dtype)
+
+def ReturnRegionHotspots(Temp,RegionIndexes):
+    #flat index of the maximum of Temp in each region, same tie breaking as np.argmax over the masked volume
+    TempFlat=Temp.ravel()
+    Hotspots=[]
+    for ind in RegionIndexes:
+        if ind.size==0:
+            Hotspots.append(0)
+        else:
+            Hotspots.append(int(ind[np.argmax(TempFlat[ind])]))
+    return Hotspots
+
+def ReturnRegionCandidates(Temp,RegionIndexes,nCandidates):
+    #flat indexes of the nCandidates largest values of Temp in each region, starting with the hotspot of the region
+    TempFlat=Temp.ravel()
+    Candidates=[]
+    for ind,h in zip(RegionIndexes,ReturnRegionHotspots(Temp,RegionIndexes)):
+        if ind.size==0:
+            Candidates.append([])
+            continue
+        if ind.size>nCandidates:
+            ind=ind[np.argpartition(TempFlat[ind],-nCandidates)[-nCandidates:]]
+        Candidates.append(list(dict.fromkeys([h]+ind.tolist())))
+    return Candidates
+
+def BHTEWithHotspotTracking(PressureFields,
+                            MaterialMap,
+                            MaterialList,
+                            dx,
+                            TotalDurationSteps,
+                            nStepsOn,
+                            LocationMonitoring,
+                            RegionMasks,
+                            FixedPoints=[],
+                            nStepsOnOffList=None,
+                            nFactorMonitoring=1,
+                            dt=0.1,
+                            DutyCycle=1.0,
+                            Backend='OpenCL',
+                            nCandidates=32):
+    '''
+    Run BHTE (or BHTEMultiplePressureFields if nStepsOnOffList is given) and return the temperature profiles at the
+    location of the maximum temperature of each region of RegionMasks at the end of the integration.
+
+    The profiles of the nCandidates voxels with the largest heating (local and averaged over neighbours) of each region
+    are recorded during the integration, the hotspot is almost always one of them. If not, the integration is repeated monitoring the hotspots, as done
+    before with two passes.
+
+    Returns ResTemp,ResDose,MonitorSlice,Qarr, the (i,j,k) of the hotspots at the end of the integration and
+    TemperaturePoints with one row per region followed by one row per entry of FixedPoints
+    '''
+    bMultiple = nStepsOnOffList is not None
+    RegionIndexes=[np.flatnonzero(m) for m in RegionMasks]
+    FixedFlat=[int(np.ravel_multi_index(p,MaterialMap.shape)) for p in FixedPoints]
+
+    def RunMonitoringPoints(Points):
+        UniquePoints=list(dict.fromkeys(Points)) #a voxel can only have one label
+        MonitoringPointsMap=np.zeros(MaterialMap.shape,np.uint32)
+        MonitoringPointsMap.flat[UniquePoints]=np.arange(1,len(UniquePoints)+1)
+        if bMultiple:
+            Res=BHTEMultiplePressureFields(PressureFields,
+                                            MaterialMap,
+                                            MaterialList,
+                                            dx,
+                                            TotalDurationSteps,
+                                            nStepsOnOffList,
+                                            LocationMonitoring,
+                                            nFactorMonitoring=nFactorMonitoring,
+                                            dt=dt,
+                                            Backend=Backend,
+                                            MonitoringPointsMap=MonitoringPointsMap)
+        else:
+            Res=BHTE(PressureFields,
+                        MaterialMap,
+                        MaterialList,
+                        dx,
+                        TotalDurationSteps,
+                        nStepsOn,
+                        LocationMonitoring,
+                        nFactorMonitoring=nFactorMonitoring,
+                        dt=dt,
+                        DutyCycle=DutyCycle,
+                        Backend=Backend,
+                        MonitoringPointsMap=MonitoringPointsMap)
+        #profiles by flat index
+        return Res[:4],dict(zip(UniquePoints,Res[4]))
+
+    #candidates, voxels with maximal heating in each region, locally and averaged over neighbours to account for conduction
+    if bMultiple:
+        Heating=(PressureFields**2).sum(axis=0)
+    else:
+        Heating=PressureFields**2
+    Heating*=np.asarray(MaterialList['Attenuation'],np.float32)[MaterialMap]
+    Candidates=[]
+    for Map in [Heating,uniform_filter(Heating,5)]:
+        for c in ReturnRegionCandidates(Map,RegionIndexes,nCandidates):
+            Candidates+=c
+    del Heating
+
+    (ResTemp,ResDose,MonitorSlice,Qarr),Profiles=RunMonitoringPoints(Candidates+FixedFlat)
+    Hotspots=ReturnRegionHotspots(ResTemp,RegionIndexes)
+    Missing=[h for h in Hotspots if h not in Profiles]
+    if len(Missing)>0:
+        print('Hotspots not in the candidates, repeating the integration to record their profiles')
+        (ResTemp,ResDose,MonitorSlice,Qarr),Profiles=RunMonitoringPoints(Hotspots+FixedFlat)
+    TemperaturePoints=np.vstack([Profiles[p] for p in Hotspots+FixedFlat])
+
+    Hotspots=[np.array(np.unravel_index(h,MaterialMap.shape)) for h in Hotspots]
+    return ResTemp,ResDose,MonitorSlice,Qarr,Hotspots,TemperaturePoints
+
+def _PressureStatisticsNumpy(p,MaterialMap,RegionLUT,nRegions,SlabSize=16):
+    #same reduction as the Numba kernel, in slabs along x so only slab sized temporaries are created
+    N1,N2,N3=p.shape
+    Energy=np.zeros(nRegions*N3)
+    pMax=np.full(nRegions,-np.inf)
+    nMax=np.zeros(nRegions,np.int64)
+    for i0 in range(0,N1,SlabSize):
+        ps=p[i0:i0+SlabSize].astype(np.float64)
+        rs=RegionLUT[MaterialMap[i0:i0+SlabSize]]
+        sel=rs>=0
+        Energy+=np.bincount(rs[sel]*N3+np.nonzero(sel)[2],weights=ps[sel]**2,minlength=nRegions*N3)
+        for r in range(nRegions):
+            v=np.where(rs==r,ps,-np.inf)
+            n=np.argmax(v)
+            if v.flat[n]>pMax[r]:
+                pMax[r]=v.flat[n]
+                nMax[r]=i0*N2*N3+n
+    return Energy.reshape((nRegions,N3)),pMax,nMax
+
+try:
+    from numba import njit
+
+    @njit(cache=True)
+    def _PressureStatisticsNumba(p,MaterialMap,RegionLUT,nRegions):
+        N1,N2,N3=p.shape
+        Energy=np.zeros((nRegions,N3))
+        pMax=np.full(nRegions,-np.inf)
+        nMax=np.zeros(nRegions,np.int64)
+        for i in range(N1):
+            for j in range(N2):
+                for k in range(N3):
+                    r=RegionLUT[MaterialMap[i,j,k]]
+                    if r>=0:
+                        v=np.float64(p[i,j,k])
+                        Energy[r,k]+=v*v
+                        if v>pMax[r]:
+                            pMax[r]=v
+                            nMax[r]=(i*N2+j)*N3+k
+        return Energy,pMax,nMax
+    _bNumba=True
+except ImportError:
+    _bNumba=False
+
+def ReturnPressureStatistics(p,MaterialMap,Regions,bUseNumba=True):
+    '''
+    Single pass over the pressure field p, Regions is a list of lists of material IDs.
+    Returns for each region the sum of p**2 per z plane (nRegions,N3), the maximum of p and the (i,j,k) of its first occurrence
+    '''
+    RegionLUT=np.full(int(MaterialMap.max())+1,-1,np.int64)
+    for r,ids in enumerate(Regions):
+        for m in ids:
+            if m<RegionLUT.size:
+                RegionLUT[m]=r
+    if bUseNumba and _bNumba:
+        Energy,pMax,nMax=_PressureStatisticsNumba(p,MaterialMap,RegionLUT,len(Regions))
+    else:
+        Energy,pMax,nMax=_PressureStatisticsNumpy(p,MaterialMap,RegionLUT,len(Regions))
+    return Energy,pMax,[np.unravel_index(n,p.shape) for n in nMax]
+
 def AnalyzeLosses(pAmp,MaterialMap,LocIJK,Input,MaterialList,BrainID,pAmpWater,Isppa,SaveDict,xf,yf,zf):
-    pAmpBrain=pAmp.copy()
+    nMaterials=int(MaterialMap.max())+1
     if 'MaterialMapCT' in Input:
-        pAmpBrain[MaterialMap!=2]=0.0
+        BrainRegion=[2]
+        BrainRegionPlanes=[2]
     else:
-        pAmpBrain[MaterialMap<4]=0.0
+        BrainRegion=list(range(4,max(nMaterials,5)))
+        BrainRegionPlanes=[4]
+    #energy factors of plane integrals of p**2
+    EnergyBrain=1/2/MaterialList['Density'][BrainID]/ MaterialList['SoS'][BrainID]*((xf[1]-xf[0])**2)
+    EnergyWater=1/2/MaterialList['Density'][0]/ MaterialList['SoS'][0]*((xf[1]-xf[0])**2)
 
     cz=LocIJK[2]
     
-    PlanAtMaximum=pAmpBrain[:,:,cz]
-    AcousticEnergy=(PlanAtMaximum**2/2/MaterialList['Density'][BrainID]/ MaterialList['SoS'][BrainID]*((xf[1]-xf[0])**2)).sum()
+    PlanesBrain,_,_=ReturnPressureStatistics(pAmp,MaterialMap,[BrainRegion])
+    AcousticEnergy=PlanesBrain[0,cz]*EnergyBrain
     print('Acoustic Energy at maximum plane',AcousticEnergy)
     
-    
-    MateriaMapTissue=np.ascontiguousarray(np.flip(Input['MaterialMap'],axis=2))
     xfr=Input['x_vec']
     yfr=Input['y_vec']
     zfr=Input['z_vec']
     
-    
-    PlanAtMaximumWater=pAmpWater[:,:,2] 
-    AcousticEnergyWater=(PlanAtMaximumWater**2/2/MaterialList['Density'][0]/ MaterialList['SoS'][0]*((xf[1]-xf[0])**2)).sum()
+    AcousticEnergyWater=(pAmpWater[:,:,2].astype(np.float64)**2).sum()*EnergyWater
     print('Water Acoustic Energy entering',AcousticEnergyWater)
-    if 'MaterialMapCT' in Input:
-        pAmpWater[MaterialMap!=2]=0.0
-    else:
-        pAmpWater[MaterialMap!=4]=0.0
-    cxw,cyw,czw=np.where(pAmpWater==pAmpWater.max())
-    cxw=cxw[0]
-    cyw=cyw[0]
-    czw=czw[0]
+    PlanesWater,pMaxWater,LocWater=ReturnPressureStatistics(pAmpWater,MaterialMap,[BrainRegionPlanes])
+    cxw,cyw,czw=LocWater[0]
     print('Location Max Pessure Water',cxw,cyw,czw,'\n',
-            xf[cxw],yf[cyw],zf[czw],pAmpWater.max()/1e6)
+            xf[cxw],yf[cyw],zf[czw],pMaxWater[0]/1e6)
     
     pAmpTissue=np.ascontiguousarray(np.flip(Input['p_amp'],axis=2))
-    if 'MaterialMapCT' in Input:
-        pAmpTissue[MaterialMap!=2]=0.0
-    else:
-        pAmpTissue[MaterialMap!=4]=0.0
-
-    cxr,cyr,czr=np.where(pAmpTissue==pAmpTissue.max())
-    cxr=cxr[0]
-    cyr=cyr[0]
-    czr=czr[0]
+    PlanesTissue,pMaxTissue,LocTissue=ReturnPressureStatistics(pAmpTissue,MaterialMap,[BrainRegionPlanes])
+    cxr,cyr,czr=LocTissue[0]
     print('Location Max Pressure Tissue',cxr,cyr,czr,'\n',
-            xfr[cxr],yfr[cyr],zfr[czr],pAmpTissue.max()/1e6)
+            xfr[cxr],yfr[cyr],zfr[czr],pMaxTissue[0]/1e6)
     
-
-    PlanAtMaximumWaterMaxLoc=pAmpWater[:,:,czw]
-    AcousticEnergyWaterMaxLoc=(PlanAtMaximumWaterMaxLoc**2/2/MaterialList['Density'][0]/ MaterialList['SoS'][0]*((xf[1]-xf[0])**2)).sum()
+    AcousticEnergyWaterMaxLoc=PlanesWater[0,czw]*EnergyWater
     print('Water Acoustic Energy at maximum plane water max loc',AcousticEnergyWaterMaxLoc) #must be very close to AcousticEnergyWater
     
-    PlanAtMaximumWaterMaxLoc=pAmpWater[:,:,czr]
-    AcousticEnergyWaterMaxLoc=(PlanAtMaximumWaterMaxLoc**2/2/MaterialList['Density'][0]/ MaterialList['SoS'][0]*((xf[1]-xf[0])**2)).sum()
+    AcousticEnergyWaterMaxLoc=PlanesWater[0,czr]*EnergyWater
     print('Water Acoustic Energy at maximum plane tissue max loc',AcousticEnergyWaterMaxLoc) #must be very close to AcousticEnergyWater
     
-    PlanAtMaximumTissue=pAmpTissue[:,:,czr] 
-    AcousticEnergyTissue=(PlanAtMaximumTissue**2/2/MaterialList['Density'][BrainID]/ MaterialList['SoS'][BrainID]*((xf[1]-xf[0])**2)).sum()
+    AcousticEnergyTissue=PlanesTissue[0,czr]*EnergyBrain
     print('Tissue Acoustic Energy at maximum plane tissue',AcousticEnergyTissue)
     
     RatioLosses=AcousticEnergyTissue/AcousticEnergyWaterMaxLoc
     print('Total losses ratio and in dB',RatioLosses,np.log10(RatioLosses)*10)
         
     PressureAdjust=np.sqrt(Isppa*1e4*2.0*SaveDict['MaterialList']['SoS'][BrainID]*SaveDict['MaterialList']['Density'][BrainID])
-    PressureRatio=PressureAdjust/pAmpTissue.max()
+    PressureRatio=PressureAdjust/pMaxTissue[0]
     return PressureRatio,RatioLosses
 
 def CalculateTemperatureEffects(InputPData,
@@ -107,7 +334,13 @@ def CalculateTemperatureEffects(InputPData,
                                 OutTemperature=37,
                                 bGlobalDCMultipoint=False,
                                 Frequency=7e5,
-                                Backend='CUDA'):#this will help to calculate the final voltage to apply during experiments
+                                Backend='CUDA',
+                                bCacheInputs=False,
+                                RepetitionsTolerance=None,
+                                RepetitionsDoseTolerance=0.01,
+                                OutputPrecision=None,
+                                OutputContainers=('h5','mat'),
+                                bOutputSummaryOnly=False):#this will help to calculate the final voltage to apply during experiments
 
 
     if type(InputPData) is str:    
@@ -120,33 +353,37 @@ def CalculateTemperatureEffects(InputPData,
     print('Thermal sim with Backend',Backend)
     print('Operating Frequency',Frequency)
     if bForceRecalc==False:
-        if isfile(outfname+'.h5'):
+        if isfile(outfname+'.'+OutputContainers[0]):
             print('skipping', outfname)
             return outfname
     dt=0.01
+    if bCacheInputs:
+        ReadInput=ReturnCachedDataForSim
+    else:
+        ReadInput=ReadDataForSim
     
     if type(InputPData) is str:   
-        Input=ReadFromH5py(InputPData)
+        Input=ReadInput(InputPData)
         WaterInputPData=InputPData.replace('DataForSim.h5','Water_DataForSim.h5')
         print('Load water',WaterInputPData)
-        InputWater=ReadFromH5py(WaterInputPData)
+        InputWater=ReadInput(WaterInputPData)
         
         pAmp=np.ascontiguousarray(np.flip(Input[sel_p],axis=2))
         pAmpWater=np.ascontiguousarray(np.flip(InputWater['p_amp'],axis=2))
         
     else:
         ALL_ACFIELDSKULL=[]
-        Input=ReadFromH5py(InputPData[0])
+        Input=ReadInput(InputPData[0])
         
         AllInputs=np.zeros((len(InputPData),Input[sel_p].shape[0],Input[sel_p].shape[1],
                             Input[sel_p].shape[2]),Input[sel_p].dtype)
         AllInputsWater=np.zeros((len(InputPData),Input[sel_p].shape[0],Input[sel_p].shape[1],
                             Input[sel_p].shape[2]),Input[sel_p].dtype)
         for n in range(len(InputPData)):
-            ALL_ACFIELDSKULL.append(ReadFromH5py(InputPData[n]))
+            ALL_ACFIELDSKULL.append(ReadInput(InputPData[n]))
             AllInputs[n,:,:,:]=np.ascontiguousarray(np.flip(ALL_ACFIELDSKULL[-1][sel_p],axis=2))
             fwater=InputPData[n].replace('DataForSim.h5','Water_DataForSim.h5')
-            AllInputsWater[n,:,:,:]=np.ascontiguousarray(np.flip(ReadFromH5py(fwater)['p_amp'],axis=2))
+            AllInputsWater[n,:,:,:]=np.ascontiguousarray(np.flip(ReadInput(fwater)['p_amp'],axis=2))
         
         if DurationUS>len(InputPData)*2 and bGlobalDCMultipoint: 
         #ad-hoc rule, if sonication last at least 2x seconds the number of focal spots, we  approximate the heating as each point would take 1 second (with DC indicating how much percentage will  be on), this is valid for long sonications
@@ -176,45 +413,7 @@ def CalculateTemperatureEffects(InputPData,
         nStepsOnOffList[:,1]=NCyclesOff
         
     
-    MaterialList={}
-    MaterialList['Density']=Input['Material'][:,0]
-    MaterialList['SoS']=Input['Material'][:,1]
-    MaterialList['Attenuation']=Input['Material'][:,3]
-    if 'MaterialMapCT' not in Input:
-        #Water, Skin, Cortical, Trabecular, Brain
-
-        #https://itis.swiss/virtual-population/tissue-properties/database/heat-capacity/
-        MaterialList['SpecificHeat']=[4178,3391,1313,2274,3630] #(J/kg/°C)
-        #https://itis.swiss/virtual-population/tissue-properties/database/thermal-conductivity/
-        MaterialList['Conductivity']=[0.6,0.37,0.32,0.31,0.51] # (W/m/°C)
-        #https://itis.swiss/virtual-population/tissue-properties/database/heat-transfer-rate/
-        MaterialList['Perfusion']=np.array([0,106,10,30,559])
-        
-        MaterialList['Absorption']=np.array([0,0.85,0.16,0.15,0.85])
-
-        MaterialList['InitTemperature']=[OutTemperature,37,37,37,37]
-    else:
-        #Water, Skin, Brain and skull material
-        MaterialList['SpecificHeat']=np.zeros_like(MaterialList['SoS'])
-        MaterialList['SpecificHeat'][0:3]=[4178,3391,3630]
-        MaterialList['SpecificHeat'][3:]=(1313+2274)/2
-
-        MaterialList['Conductivity']=np.zeros_like(MaterialList['SoS'])
-        MaterialList['Conductivity'][0:3]=[0.6,0.37,0.51]
-        MaterialList['Conductivity'][3:]=(0.32+0.31)/2
-
-        MaterialList['Perfusion']=np.zeros_like(MaterialList['SoS'])
-        MaterialList['Perfusion'][0:3]=[0,106,559]
-        MaterialList['Perfusion'][3:]=(10+30)/2
-
-        MaterialList['Absorption']=np.zeros_like(MaterialList['SoS'])
-        MaterialList['Absorption'][0:3]=[0,0.85,0.85]
-        MaterialList['Absorption'][3:]=(0.16+0.15)/2
-
-        MaterialList['InitTemperature']=np.zeros_like(MaterialList['SoS'])
-        MaterialList['InitTemperature'][0]=OutTemperature
-        MaterialList['InitTemperature'][1:]=37
-    
+    MaterialList=ReturnThermalMaterialList(Input,OutTemperature)
 
     SaveDict={}
     SaveDict['MaterialList']=MaterialList
@@ -265,52 +464,36 @@ def CalculateTemperatureEffects(InputPData,
             
 
 
-    if 'MaterialMapCT' in Input:
-        SelBrain=MaterialMap==2
-    else:
-        SelBrain=MaterialMap>=4
+    SelSkin,SelBrain,SelSkull=ReturnRegionMasks(MaterialMap,'MaterialMapCT' in Input)
 
-    SelSkin=MaterialMap==1
-    if 'MaterialMapCT' in Input:
-        SelSkull =MaterialMap>=3
-    else:
-        SelSkull =(MaterialMap>1) &\
-            (MaterialMap<4)
-
-    
+    #a single pass of the first sonication locates the maxima in skin, brain and skull while recording their profiles
     if type(InputPData) is str:
-        ResTemp,ResDose,MonitorSlice,Qarr=BHTE(pAmp*PressureRatio,
-                                                        MaterialMap,
-                                                        MaterialList,
-                                                        (Input['x_vec'][1]-Input['x_vec'][0]),
-                                                        TotalDurationSteps,
-                                                        nStepsOn,
-                                                        cy,
-                                                        nFactorMonitoring=nFactorMonitoring,
-                                                        dt=dt,
-                                                        DutyCycle=DutyCycle,
-                                                        Backend=Backend)
+        PressureBHTE=pAmp*PressureRatio
+        nStepsOnOffTracking=None
     else:
         InputsBHTE=AllInputs.copy()
         for n in range(len(InputPData)):
             InputsBHTE[n,:,:,:]*=PressureRatio[n]
-        ResTemp,ResDose,MonitorSlice,Qarr=BHTEMultiplePressureFields(InputsBHTE,
-                                                      MaterialMap,
-                                                      MaterialList,
-                                                      (Input['x_vec'][1]-Input['x_vec'][0]),
-                                                      TotalDurationSteps,
-                                                      nStepsOnOffList,
-                                                      cy,
-                                                      nFactorMonitoring=nFactorMonitoring,
-                                                      dt=dt,
-                                                      Backend=Backend)
-
-    ResTempSkin=ResTemp * SelSkin.astype(np.float32)
-    ResTempBrain=ResTemp * SelBrain.astype(np.float32)
-    ResTempSkull=ResTemp * SelSkull.astype(np.float32)
-    mxSkin,mySkin,mzSkin=np.unravel_index(np.argmax(ResTempSkin, axis=None), ResTempSkin.shape)
-    mxBrain,myBrain,mzBrain=np.unravel_index(np.argmax(ResTempBrain, axis=None), ResTempBrain.shape)
-    mxSkull,mySkull,mzSkull=np.unravel_index(np.argmax(ResTempSkull, axis=None), ResTempSkull.shape)
+        PressureBHTE=InputsBHTE
+        nStepsOnOffTracking=nStepsOnOffList
+    ResTemp,ResDose,MonitorSlice,Qarr,Hotspots,TemperaturePointsTracked=BHTEWithHotspotTracking(PressureBHTE,
+                                                    MaterialMap,
+                                                    MaterialList,
+                                                    (Input['x_vec'][1]-Input['x_vec'][0]),
+                                                    TotalDurationSteps,
+                                                    nStepsOn,
+                                                    cy,
+                                                    [SelSkin,SelBrain,SelSkull],
+                                                    FixedPoints=[(cx,cy,cz)],
+                                                    nStepsOnOffList=nStepsOnOffTracking,
+                                                    nFactorMonitoring=nFactorMonitoring,
+                                                    dt=dt,
+                                                    DutyCycle=DutyCycle,
+                                                    Backend=Backend)
+
+    mxSkin,mySkin,mzSkin=Hotspots[0]
+    mxBrain,myBrain,mzBrain=Hotspots[1]
+    mxSkull,mySkull,mzSkull=Hotspots[2]
 
     MonitoringPointsMap=np.zeros(MaterialMap.shape,np.uint32)
     MonitoringPointsMap[mxSkin,mySkin,mzSkin]=1
@@ -318,7 +501,15 @@ def CalculateTemperatureEffects(InputPData,
     MonitoringPointsMap[mxSkull,mySkull,mzSkull]=3
     if not(cx==mxBrain and cy==myBrain and cz==mzBrain):
         MonitoringPointsMap[cx,cy,cz]=4
+        TemperaturePointsTracked=TemperaturePointsTracked[:4,:]
+    else:
+        TemperaturePointsTracked=TemperaturePointsTracked[:3,:]
     print('Total number of repetitions:',Repetitions)
+    PointsFlat=np.flatnonzero(MonitoringPointsMap)
+    RepHistory=[]
+    RepetitionsExtrapolatedTailTemp=0.0
+    RepetitionsExtrapolatedTailCEM=0.0
+    RepetitionsSimulated=Repetitions
     for NTotalRep in range(Repetitions):
         if NTotalRep >0:
             initT0=FinalTemp
@@ -327,7 +518,10 @@ def CalculateTemperatureEffects(InputPData,
             initT0=None
             initDose=None
             
-        if type(InputPData) is str:
+        if NTotalRep==0:
+            #first sonication was already calculated while tracking the hotspots
+            TemperaturePointsOn=TemperaturePointsTracked
+        elif type(InputPData) is str:
             ResTemp,ResDose,MonitorSlice,Qarr,TemperaturePointsOn=BHTE(pAmp*PressureRatio,
                                                             MaterialMap,
                                                             MaterialList,
@@ -380,6 +574,51 @@ def CalculateTemperatureEffects(InputPData,
         else:
             TemperaturePoints=np.hstack((TemperaturePoints,TemperaturePointsOn,TemperaturePointsOff))
 
+        if RepetitionsTolerance is None:
+            continue
+        #only with an explicit RepetitionsTolerance (in degC), by default all repetitions are simulated
+        #the cycles converge geometrically to a periodic steady state, once the cycle-to-cycle change of the peak
+        #temperature and of the dose per cycle is under tolerance, the remaining repetitions are extrapolated
+        #with the ratio of the slowest converging voxel
+        RepHistory.append({'ResTemp':ResTemp,
+                           'ResDose':ResDose,
+                           'FinalTemp':FinalTemp,
+                           'FinalDose':FinalDose,
+                           'MonitorSlice':MonitorSlice.copy(),
+                           'Points':np.hstack((TemperaturePointsOn,TemperaturePointsOff)),
+                           'PointsDose':FinalDose.ravel()[PointsFlat]})
+        RepHistory=RepHistory[-3:]
+        nRemaining=Repetitions-1-NTotalRep
+        if len(RepHistory)<3 or nRemaining==0:
+            continue
+        First,Prev,Last=RepHistory
+        DeltaPeak=(Last['ResTemp']-Prev['ResTemp']).ravel()
+        nMaxDelta=np.argmax(np.abs(DeltaPeak))
+        DoseCycle=Last['PointsDose']-Prev['PointsDose']
+        DoseChange=np.abs(DoseCycle-(Prev['PointsDose']-First['PointsDose'])).max()
+        if abs(DeltaPeak[nMaxDelta])>RepetitionsTolerance or DoseChange>RepetitionsDoseTolerance*max(DoseCycle.max(),1e-12):
+            continue
+        DeltaPeakPrev=(Prev['ResTemp']-First['ResTemp']).ravel()[nMaxDelta]
+        if DeltaPeakPrev!=0:
+            rho=float(np.clip(DeltaPeak[nMaxDelta]/DeltaPeakPrev,0.0,0.99))
+        else:
+            rho=0.0
+        print('Periodic steady state after %i repetitions, extrapolating %i (ratio %f)' % (NTotalRep+1,nRemaining,rho))
+        ResTemp=ExtrapolateGeometricTail(Prev['ResTemp'],Last['ResTemp'],rho,nRemaining)
+        FinalTemp=ExtrapolateGeometricTail(Prev['FinalTemp'],Last['FinalTemp'],rho,nRemaining)
+        MonitorSlice=ExtrapolateGeometricTail(Prev['MonitorSlice'],Last['MonitorSlice'],rho,nRemaining)
+        ResDose=Last['ResDose']+(Last['FinalDose']-Prev['FinalDose'])*nRemaining
+        FinalDose=Last['FinalDose']+(Last['FinalDose']-Prev['FinalDose'])*nRemaining
+        TemperaturePoints=np.hstack([TemperaturePoints]+
+                                    [ExtrapolateGeometricTail(Prev['Points'],Last['Points'],rho,n) for n in range(1,nRemaining+1)])
+        #size of what is extrapolated rather than simulated (not an error bound, the actual error is usually much smaller):
+        #temperature change of the geometric tail with ratio rho, and dose accumulated by the drift of the dose per cycle
+        RepetitionsExtrapolatedTailTemp=abs(DeltaPeak[nMaxDelta])*rho/(1.0-rho)
+        RepetitionsExtrapolatedTailCEM=DoseChange*nRemaining*(nRemaining+1)/2/60 # in min
+        RepetitionsSimulated=NTotalRep+1
+        print('Extrapolated tail temperature, CEM',RepetitionsExtrapolatedTailTemp,RepetitionsExtrapolatedTailCEM)
+        break
+
     SaveDict['MonitorSlice']=MonitorSlice[:,:,int(nStepsOn/nFactorMonitoring)-1]
     SaveDict['mSkin']=np.array([mxSkin,mySkin,mzSkin]).astype(int)
     SaveDict['mBrain']=np.array([mxBrain,myBrain,mzBrain]).astype(int)
@@ -465,11 +704,13 @@ def CalculateTemperatureEffects(InputPData,
     SaveDict['RatioLosses']=RatioLosses
     SaveDict['DurationUS']=DurationUS
     SaveDict['DurationOff']=DurationOff
+    SaveDict['RepetitionsSimulated']=RepetitionsSimulated
+    SaveDict['RepetitionsExtrapolatedTailTemp']=RepetitionsExtrapolatedTailTemp
+    SaveDict['RepetitionsExtrapolatedTailCEM']=RepetitionsExtrapolatedTailCEM
     SaveDict['DutyCycle']=DutyCycle
     SaveDict['PRF']=PRF
     
-    SaveToH5py(SaveDict,outfname+'.h5')
-    savemat(outfname+'.mat',SaveDict)
+    SaveThermalResults(SaveDict,outfname,Precision=OutputPrecision,Containers=OutputContainers,bSummaryOnly=bOutputSummaryOnly)
     
     return outfname
         
@@ -0,0 +1,88 @@
+'''
+Writer and reader of the thermal simulation results
+
+By default the results are saved as computed to both .h5 and .mat, as done historically. Leaner outputs can be selected:
+    Precision='float32' - temperature and dose fields are saved in single precision
+    Precision='int16'   - temperatures are saved as int16 in steps of 0.01 degC above 37 degC and doses as int16
+                          of log10(dose) in steps of 0.001 decades. Encoded fields are listed in 'ThermalEncoding'
+                          and decoded by ReadThermalResults
+    Containers          - any of 'h5' and 'mat'
+    bSummaryOnly=True   - 3D volumes are replaced by their plane at the target z location (entries '<name>_zslice'),
+                          maxima, monitoring traces and central planes are kept
+'''
+import numpy as np
+from scipy.io import savemat
+from BabelViscoFDTD.H5pySimple import SaveToH5py,ReadFromH5py
+
+THERMAL_TEMPERATURE_FIELDS=['TempEndFUS','FinalTemp','MonitorSlice','TemperaturePoints','TempProfileTarget']
+THERMAL_DOSE_FIELDS=['DoseEndFUS','FinalDose']
+THERMAL_VOLUME_FIELDS=['TempEndFUS','FinalTemp','DoseEndFUS','FinalDose','p_map','MaterialMap']
+
+TEMPERATURE_INT16_SCALE=0.01 # degC
+DOSE_INT16_SCALE=1e-3 # decades of log10(dose)
+
+def EncodeInt16(v,Scale,Offset=0.0,bLog10=False):
+    v=np.asarray(v,np.float64)
+    if bLog10:
+        v=np.log10(np.maximum(v,1e-30))
+    return np.clip(np.round((v-Offset)/Scale),-32767,32767).astype(np.int16)
+
+def DecodeInt16(v,Scale,Offset=0.0,bLog10=False):
+    v=v.astype(np.float32)*np.float32(Scale)+np.float32(Offset)
+    if bLog10:
+        v=np.power(np.float32(10),v)
+        v[v<=np.float32(1e-29)]=0
+    return v
+
+def PrepareThermalResults(SaveDict,Precision=None,bSummaryOnly=False):
+    '''
+    Return a copy of SaveDict with the precision and summary options applied
+    '''
+    Out=dict(SaveDict)
+    if bSummaryOnly:
+        cz=int(np.asarray(SaveDict['TargetLocation']).flatten()[2])
+        for k in THERMAL_VOLUME_FIELDS:
+            if k in Out and np.ndim(Out[k])==3:
+                Out[k+'_zslice']=np.ascontiguousarray(Out.pop(k)[:,:,cz])
+        Out['bSummaryOnly']=True
+    if Precision is None:
+        return Out
+    assert(Precision in ['float32','int16'])
+    Encoding={}
+    for kbase in THERMAL_TEMPERATURE_FIELDS+THERMAL_DOSE_FIELDS:
+        for k in [kbase,kbase+'_zslice']:
+            if k not in Out:
+                continue
+            if Precision=='float32':
+                Out[k]=np.asarray(Out[k],np.float32)
+            elif kbase in THERMAL_DOSE_FIELDS:
+                Encoding[k]={'Scale':DOSE_INT16_SCALE,'Offset':0.0,'bLog10':1}
+                Out[k]=EncodeInt16(Out[k],DOSE_INT16_SCALE,bLog10=True)
+            else:
+                Encoding[k]={'Scale':TEMPERATURE_INT16_SCALE,'Offset':37.0,'bLog10':0}
+                Out[k]=EncodeInt16(Out[k],TEMPERATURE_INT16_SCALE,37.0)
+    if len(Encoding)>0:
+        Out['ThermalEncoding']=Encoding
+    return Out
+
+def SaveThermalResults(SaveDict,outfname,Precision=None,Containers=('h5','mat'),bSummaryOnly=False,complevel=9):
+    '''
+    Save SaveDict as outfname.h5 and/or outfname.mat
+    '''
+    assert(len(Containers)>0 and all([c in ['h5','mat'] for c in Containers]))
+    bLean = Precision is not None or bSummaryOnly
+    Out=PrepareThermalResults(SaveDict,Precision,bSummaryOnly)
+    if 'h5' in Containers:
+        SaveToH5py(Out,outfname+'.h5',complevel=complevel)
+    if 'mat' in Containers:
+        savemat(outfname+'.mat',Out,do_compression=bLean)
+
+def ReadThermalResults(fname):
+    '''
+    Read a .h5 file of thermal results, fields saved as int16 are decoded to float32
+    '''
+    Data=ReadFromH5py(fname)
+    if 'ThermalEncoding' in Data:
+        for k,enc in Data.pop('ThermalEncoding').items():
+            Data[k]=DecodeInt16(Data[k],enc['Scale'],enc['Offset'],bool(enc['bLog10']))
+    return Data
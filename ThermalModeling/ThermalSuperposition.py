@@ -0,0 +1,332 @@
+'''
+Thermal simulations of several sonication regimes by linear superposition
+
+The BHTE solved by BabelViscoFDTD is linear in the heat source (conduction and perfusion with constant properties) and
+the time step is fixed, so the temperature rise produced by any on/off schedule of the same acoustic field is a sum of
+time-shifted copies of the step response (the source switched on at t=0 and kept on), scaled by the duty cycle and Isppa.
+
+ThermalSuperpositionEngine solves the step response once for the longest regime of a sweep and synthesizes the results
+of all the combinations of duty cycle, duration, off time and repetitions, saved in the same format as
+CalculateTemperatureEffects.
+
+Only single focus fields are supported. The thermal dose (CEM43) is not linear, it is calculated from the synthesized
+temperature profiles at a set of candidate voxels of skin, brain and skull, so dose maps are not saved. The temperature at
+the end of the sonication is, voxel by voxel, the largest of the ends of all the repetitions (each repetition adds a
+non-negative response to the previous one), so the candidates are the hottest voxels of each region at the end of the
+sonication and at the end of the cooling. Files are flagged with bThermalSuperposition and have no DoseEndFUS or FinalDose
+entries, for this reason the GUI only uses this engine when bThermalSuperposition is set in the thermal profile.
+
+Memory: the step response is accumulated in 2 float32 volumes per distinct schedule (3 with repetitions), combinations
+that only differ in duty cycle or PRF share them. They are kept until the combination is saved.
+'''
+import numpy as np
+from ThermalModeling.BHTEBackends import BHTE
+from TranscranialModeling.DataForSimH5 import ReadDataForSim
+from ThermalModeling.CalculateTemperatureEffects import (GetThermalOutName,AnalyzeLosses,ReturnThermalMaterialList,
+                                                         ReturnRegionMasks,ReturnRegionHotspots,ReturnRegionCandidates)
+from ThermalModeling.ThermalOutput import SaveThermalResults
+
+def ReturnSuperpositionTerms(N,Intervals):
+    '''
+    Terms (m,weight) so that the response after N steps to a unit source on during the steps [a,b) of each interval
+    is sum(weight*S(m)), with S(m) the step response after m steps
+    '''
+    Terms=[]
+    for a,b in Intervals:
+        if N>a:
+            Terms.append((N-a,1.0))
+        if N>b:
+            Terms.append((N-b,-1.0))
+    return Terms
+
+def ReturnThermalDose(TempProfiles,dt,T0=37.0):
+    '''
+    CEM43 (in s) of temperature profiles (one row per point, one column per step), same integration as the BHTE kernel
+    '''
+    Tref=43.0
+    Temp=np.hstack((np.full((TempProfiles.shape[0],1),T0),TempProfiles)).astype(np.float64)
+    Tin=Temp[:,:-1]
+    Tout=Temp[:,1:]
+    R1=np.where((Tin>Tref)|((Tin==Tref)&(Tout>=Tref)),0.5,0.25)
+    R2=np.where((Tout>Tref)|((Tout==Tref)&(Tin>=Tref)),0.5,0.25)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        Flat=dt*R1**(Tref-Tin)
+        Same=(R2**(Tref-Tout)-R1**(Tref-Tin))/(-(Tout-Tin)/dt*np.log(R1))
+        dtp=dt*(Tref-Tin)/(Tout-Tin)
+        Cross=(1-R1**(Tref-Tin))/(-(Tref-Tin)/dtp*np.log(R1))+\
+              (R2**(Tref-Tout)-1)/(-(Tout-Tref)/(dt-dtp)*np.log(R2))
+    Inc=np.where(np.abs(Tout-Tin)<0.0001,Flat,np.where(R1==R2,Same,Cross))
+    return Inc.sum(axis=1)
+
+class ThermalSuperpositionEngine(object):
+    def __init__(self,InputPData,
+                 Isppa=5,
+                 sel_p='p_amp',
+                 OutTemperature=37,
+                 Frequency=7e5,
+                 Backend='CUDA',
+                 dt=0.01,
+                 OutputPrecision=None,
+                 OutputContainers=('h5','mat'),
+                 bOutputSummaryOnly=False,
+                 nDoseCandidates=16): #voxels per region and per map (end of sonication and of cooling) where CEM43 is calculated
+        assert(type(InputPData) is str) #only single focus
+        assert(OutTemperature==37) #the response without source must be stationary
+        self._InputPData=InputPData
+        self._Isppa=Isppa
+        self._Frequency=Frequency
+        self._Backend=Backend
+        self._dt=dt
+        self._nDoseCandidates=nDoseCandidates
+        self._OutputOptions={'Precision':OutputPrecision,'Containers':OutputContainers,'bSummaryOnly':bOutputSummaryOnly}
+        self._nFactorMonitoring=int(50e-3/dt) # we just track every 50 ms
+
+        Input=ReadDataForSim(InputPData)
+        WaterInputPData=InputPData.replace('DataForSim.h5','Water_DataForSim.h5')
+        print('Load water',WaterInputPData)
+        InputWater=ReadDataForSim(WaterInputPData)
+        pAmp=np.ascontiguousarray(np.flip(Input[sel_p],axis=2))
+        pAmpWater=np.ascontiguousarray(np.flip(InputWater['p_amp'],axis=2))
+
+        self._Input=Input
+        self._MaterialList=ReturnThermalMaterialList(Input,OutTemperature)
+        bCT='MaterialMapCT' in Input
+        if bCT:
+            MaterialMap=np.ascontiguousarray(np.flip(Input['MaterialMapCT'],axis=2))
+            self._BrainID=2
+        else:
+            MaterialMap=np.ascontiguousarray(np.flip(Input['MaterialMap'],axis=2))
+            #Materal == 5 is the voxel of the desired target, we set it as brain
+            MaterialMap[MaterialMap>4]=4
+            self._BrainID=4
+        self._MaterialMap=MaterialMap
+        self._LocIJK=Input['TargetLocation'].flatten()
+        self._xf=Input['x_vec']
+        self._yf=Input['y_vec']
+        self._zf=Input['z_vec']
+
+        self._BaseDict={'MaterialList':self._MaterialList}
+        self._PressureRatio,self._RatioLosses=AnalyzeLosses(pAmp,MaterialMap,self._LocIJK,Input,self._MaterialList,
+                                                            self._BrainID,pAmpWater,Isppa,self._BaseDict,
+                                                            self._xf,self._yf,self._zf)
+        self._pAmp=pAmp*self._PressureRatio
+        self._SelSkin,self._SelBrain,self._SelSkull=ReturnRegionMasks(MaterialMap,bCT)
+        self._RegionIndexes=[np.flatnonzero(m) for m in [self._SelSkin,self._SelBrain,self._SelSkull]]
+
+    def ReturnSchedule(self,combination):
+        #number of steps and intervals with the source on of a combination, same discretization as CalculateTemperatureEffects
+        dt=self._dt
+        nStepsOn=int(combination['Duration']/dt)
+        TotalDurationSteps=int((combination['Duration']+.001)/dt)
+        TotalDurationStepsOff=int((combination['DurationOff']+.001)/dt)
+        Period=TotalDurationSteps+TotalDurationStepsOff
+        Intervals=[(r*Period,r*Period+nStepsOn) for r in range(combination['Repetitions'])]
+        return {'nStepsOn':nStepsOn,
+                'TotalDurationSteps':TotalDurationSteps,
+                'Period':Period,
+                'Intervals':Intervals,
+                'TotalSteps':Period*combination['Repetitions']}
+
+    def RunStepResponse(self,TotalSteps,Requests=[],MonitoringPointsMap=None):
+        '''
+        Integrate the step response during TotalSteps. Requests is a list of (m,weight,accumulator,selector), the
+        response after m steps (minus 37 degrees) is added with weight to accumulator (a volume or a selection of it)
+        Returns the temperature profile at MonitoringPointsMap, with one extra column at the start for m=0
+        '''
+        Stops=sorted(set([r[0] for r in Requests]+[TotalSteps]))
+        ResTemp=None
+        ResDose=None
+        Profiles=[]
+        nPrev=0
+        for m in Stops:
+            nSteps=m-nPrev
+            if nSteps==0:
+                continue
+            Res=BHTE(self._pAmp,
+                     self._MaterialMap,
+                     self._MaterialList,
+                     (self._xf[1]-self._xf[0]),
+                     nSteps,
+                     nSteps,
+                     -1,
+                     dt=self._dt,
+                     DutyCycle=1.0,
+                     Backend=self._Backend,
+                     initT0=ResTemp,
+                     initDose=ResDose,
+                     MonitoringPointsMap=MonitoringPointsMap)
+            ResTemp,ResDose=Res[0],Res[1]
+            if MonitoringPointsMap is not None:
+                Profiles.append(Res[4])
+            for mr,weight,acc,sel in Requests:
+                if mr==m:
+                    acc+=weight*(ResTemp[sel]-37.0)
+            nPrev=m
+        if MonitoringPointsMap is None:
+            return None
+        Profiles=np.hstack(Profiles)-37.0
+        return np.hstack((np.zeros((Profiles.shape[0],1),Profiles.dtype),Profiles))
+
+    def CalculateCombinations(self,AllDC_PRF_Duration,CombinationCallback=None):
+        '''
+        Calculate and save the thermal results of all the combinations, returns the list of output names
+        CombinationCallback(n,outfname) is called as soon as the results of combination n are saved
+        '''
+        dt=self._dt
+        nF=self._nFactorMonitoring
+        cx,cy,cz=self._LocIJK
+        Schedules=[]
+        Requests=[]
+        #accumulators with the same superposition terms (combinations only differing in DC or PRF) are shared
+        Accumulators={}
+        def ReturnAccumulator(N,Intervals,bSlice=False):
+            Terms=ReturnSuperpositionTerms(N,Intervals)
+            key=(tuple(Terms),bSlice)
+            if key not in Accumulators:
+                if bSlice:
+                    acc=np.zeros((self._MaterialMap.shape[0],self._MaterialMap.shape[2]),np.float32)
+                    sel=(slice(None),cy,slice(None))
+                else:
+                    acc=np.zeros(self._MaterialMap.shape,np.float32)
+                    sel=Ellipsis
+                for m,weight in Terms:
+                    Requests.append((m,weight,acc,sel))
+                Accumulators[key]=acc
+            return Accumulators[key]
+
+        for combination in AllDC_PRF_Duration:
+            sch=self.ReturnSchedule(combination)
+            LastStart=sch['Intervals'][-1][0]
+            #MonitorSlice is saved at the last monitoring step of the sonication
+            NSlice=LastStart+max(int(sch['nStepsOn']/nF)-1,0)*nF+1
+            sch['TempEndFUS']=ReturnAccumulator(LastStart+sch['TotalDurationSteps'],sch['Intervals'])
+            sch['FinalTemp']=ReturnAccumulator(sch['TotalSteps'],sch['Intervals'])
+            sch['MonitorSlice']=ReturnAccumulator(NSlice,sch['Intervals'],bSlice=True)
+            if len(sch['Intervals'])>1:
+                #as in CalculateTemperatureEffects, the monitoring points are the maxima at the end of the first sonication
+                sch['TempEndFirstFUS']=ReturnAccumulator(sch['TotalDurationSteps'],sch['Intervals'])
+            Schedules.append(sch)
+        del Accumulators
+        MaxSteps=max([sch['TotalSteps'] for sch in Schedules])
+
+        print('Calculating step response for %i steps' % (MaxSteps))
+        self.RunStepResponse(MaxSteps,Requests)
+
+        #monitoring points and maxima of each combination at the end of the sonication, and candidates for the maxima of the dose
+        Points=[]
+        for combination,sch in zip(AllDC_PRF_Duration,Schedules):
+            sch['Hotspots']=ReturnRegionHotspots(sch.pop('TempEndFirstFUS',sch['TempEndFUS']),self._RegionIndexes)
+            sch['Maxima']=ReturnRegionHotspots(sch['TempEndFUS'],self._RegionIndexes)
+            sch['DoseCandidates']=[list(dict.fromkeys(a+b)) for a,b in 
+                                   zip(ReturnRegionCandidates(sch['TempEndFUS'],self._RegionIndexes,self._nDoseCandidates),
+                                       ReturnRegionCandidates(sch['FinalTemp'],self._RegionIndexes,self._nDoseCandidates))]
+            Points+=sch['Hotspots']
+            for c in sch['DoseCandidates']:
+                Points+=c
+        Target=int(np.ravel_multi_index((cx,cy,cz),self._MaterialMap.shape))
+        UniquePoints=list(dict.fromkeys(Points+[Target]))
+        MonitoringPointsMap=np.zeros(self._MaterialMap.shape,np.uint32)
+        MonitoringPointsMap.flat[UniquePoints]=np.arange(1,len(UniquePoints)+1)
+        print('Calculating step response at %i monitoring points' % (len(UniquePoints)))
+        StepProfiles=self.RunStepResponse(MaxSteps,MonitoringPointsMap=MonitoringPointsMap)
+
+        AllNames=[]
+        for ncomb,(combination,sch) in enumerate(zip(AllDC_PRF_Duration,Schedules)):
+            outfname=GetThermalOutName(self._InputPData,combination['Duration'],combination['DurationOff'],
+                                       combination['DC'],self._Isppa,combination['PRF'],combination['Repetitions'])
+            print(outfname)
+            DutyCycle=combination['DC']
+            Rows=list(sch['Hotspots'])
+            mBrain=sch['Hotspots'][1]
+            if mBrain!=Target:
+                Rows.append(Target)
+            #profiles of the monitoring points and dose candidates of this combination
+            CombPoints=list(dict.fromkeys(Rows+[p for c in sch['DoseCandidates'] for p in c]))
+            SelProfiles=StepProfiles[[UniquePoints.index(p) for p in CombPoints],:]
+            N=np.arange(1,sch['TotalSteps']+1)
+            Excess=np.zeros((len(CombPoints),N.size),np.float32)
+            for a,b in sch['Intervals']:
+                Excess+=SelProfiles[:,np.clip(N-a,0,None)]-SelProfiles[:,np.clip(N-b,0,None)]
+            CombTemperature=Excess*DutyCycle+37.0
+            del Excess
+            TemperaturePoints=CombTemperature[[CombPoints.index(p) for p in Rows],:]
+            PointsDose=dict(zip(CombPoints,ReturnThermalDose(CombTemperature,dt)))
+            del CombTemperature
+
+            SaveDict=dict(self._BaseDict)
+            ResTemp=sch['TempEndFUS']*DutyCycle+37.0
+            FinalTemp=sch['FinalTemp']*DutyCycle+37.0
+            #as in the BHTE kernels, only the interior of the monitoring slice is written
+            SaveDict['MonitorSlice']=np.zeros_like(sch['MonitorSlice'])
+            if cy>0 and cy<self._MaterialMap.shape[1]-1:
+                SaveDict['MonitorSlice'][1:-1,1:-1]=sch['MonitorSlice'][1:-1,1:-1]*DutyCycle+37.0
+            for k,h in zip(['mSkin','mBrain','mSkull'],sch['Hotspots']):
+                SaveDict[k]=np.array(np.unravel_index(h,self._MaterialMap.shape)).astype(int)
+            SaveDict['dt']=dt
+            SaveDict['p_map']=self._pAmp
+            SaveDict['p_map_central']=self._pAmp[:,cy,:]
+            SaveDict['MaterialMap_central']=self._MaterialMap[:,cy,:]
+            SaveDict['MaterialMap']=self._MaterialMap
+
+            TI=ResTemp.ravel()[sch['Maxima'][1]]
+            TIS=ResTemp.ravel()[sch['Maxima'][0]]
+            TIC=ResTemp.ravel()[sch['Maxima'][2]]
+            print('Max. Temp. Brain, Max Temp. Skin, Max Temp. Skull',TI,TIS,TIC);
+
+            #dose is only known at the candidates, the maximum of each region is taken over them
+            CEMRegions=[]
+            for Candidates in sch['DoseCandidates']:
+                Dose=[PointsDose[p] for p in Candidates]
+                CEMRegions.append(max(Dose)/60 if len(Dose)>0 else 0.0) # in min
+            CEMSkin,CEMBrain,CEMSkull=CEMRegions
+            print('CEMBrain,CEMSkin,CEMSkull',CEMBrain,CEMSkin,CEMSkull)
+
+            MaxBrainPressure = SaveDict['p_map'][self._SelBrain].max()
+            MI=MaxBrainPressure/1e6/np.sqrt(self._Frequency/1e6)
+            MaxIsppa=MaxBrainPressure**2/(2.0*self._MaterialList['SoS'][self._BrainID]*self._MaterialList['Density'][self._BrainID])
+            MaxIsppa=MaxIsppa/1e4
+            MaxIspta=DutyCycle*MaxIsppa
+            Ispta =DutyCycle*self._Isppa
+
+            SaveDict['MaxBrainPressure']=MaxBrainPressure
+            IndTarget=3 if mBrain!=Target else 2
+            SaveDict['TempProfileTarget']=TemperaturePoints[IndTarget,:]
+            SaveDict['TimeProfileTarget']=np.arange(SaveDict['TempProfileTarget'].size)*dt
+            SaveDict['TemperaturePoints']=TemperaturePoints #these are max points in skin, brain, skull and target
+            SaveDict['MI']=MI
+            SaveDict['x_vec']=self._xf*1e3
+            SaveDict['y_vec']=self._yf*1e3
+            SaveDict['z_vec']=self._zf*1e3
+            SaveDict['TI']=TI-37.0
+            SaveDict['TIC']=TIC-37.0
+            SaveDict['TIS']=TIS-37.0
+            SaveDict['CEMBrain']=CEMBrain
+            SaveDict['CEMSkin']=CEMSkin
+            SaveDict['CEMSkull']=CEMSkull
+            SaveDict['MaxIsppa']=MaxIsppa
+            SaveDict['MaxIspta']=MaxIspta
+            SaveDict['Isppa']=self._Isppa
+            SaveDict['Ispta']=Ispta
+            SaveDict['TempEndFUS']=ResTemp
+            SaveDict['FinalTemp']=FinalTemp
+            SaveDict['bThermalSuperposition']=True
+            for k in ['XSteering','YSteering','ZSteering']:
+                if k in self._Input:
+                    SaveDict[k]=self._Input[k]
+            for k in ['AdjustmentInRAS','DistanceFromSkin','TxMechanicalAdjustmentZ','TargetLocation','ZIntoSkinPixels']:
+                SaveDict[k]=self._Input[k]
+            SaveDict['RatioLosses']=self._RatioLosses
+            SaveDict['DurationUS']=combination['Duration']
+            SaveDict['DurationOff']=combination['DurationOff']
+            SaveDict['DutyCycle']=DutyCycle
+            SaveDict['PRF']=combination['PRF']
+
+            SaveThermalResults(SaveDict,outfname,**self._OutputOptions)
+            del SaveDict,ResTemp,FinalTemp
+            #volumes are released once no other combination shares them
+            for k in ['TempEndFUS','FinalTemp','MonitorSlice']:
+                sch.pop(k)
+            AllNames.append(outfname)
+            if CombinationCallback is not None:
+                CombinationCallback(ncomb,outfname)
+        return AllNames
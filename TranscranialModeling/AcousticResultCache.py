@@ -0,0 +1,158 @@
+'''
+Content-addressed cache of acoustic simulation results
+
+Results of a case are stored in a directory named after a hash of the contents of the input files (mask, CT),
+the simulation parameters and the version of the code (files of TranscranialModeling, BabelViscoFDTD and BabelBrain
+versions), so results of a different code are never restored. Entries are evicted in least-recently-used order when
+the size limit is exceeded.
+'''
+import os
+import glob
+import hashlib
+import shutil
+import functools
+import importlib.metadata
+from threading import Lock
+
+import numpy as np
+
+CACHE_FORMAT_VERSION='1'
+
+def HashFileContents(filename,hashobj):
+    with open(filename, 'rb') as file:
+        while True:
+            data = file.read(1<<20)  # Read data in 1 MB chunks
+            if not data:
+                break
+            hashobj.update(data)
+
+@functools.lru_cache(maxsize=None)
+def ReturnCodeVersion():
+    '''
+    Hash of the files of TranscranialModeling (sources, transducer and calibration data), the BabelViscoFDTD version
+    and the BabelBrain version
+    '''
+    h=hashlib.blake2b(digest_size=20)
+    basedir=os.path.dirname(os.path.abspath(__file__))
+    for f in sorted(os.listdir(basedir)):
+        fname=os.path.join(basedir,f)
+        if os.path.isfile(fname) and not f.endswith('.pyc'):
+            h.update(f.encode())
+            HashFileContents(fname,h)
+    try:
+        h.update(importlib.metadata.version('BabelViscoFDTD').encode())
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    fversion=os.path.join(basedir,'..','BabelBrain','version-gui.txt')
+    if os.path.isfile(fversion):
+        HashFileContents(fversion,h)
+    return h.hexdigest()
+
+def HashParameter(value,hashobj):
+    #arrays are hashed by contents, their repr is truncated for large arrays
+    if isinstance(value,np.ndarray):
+        hashobj.update(repr((value.dtype.str,value.shape)).encode())
+        hashobj.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value,dict):
+        hashobj.update(b'{')
+        for k in sorted(value.keys(),key=repr):
+            hashobj.update(repr(k).encode())
+            HashParameter(value[k],hashobj)
+        hashobj.update(b'}')
+    elif isinstance(value,(list,tuple)):
+        hashobj.update(b'[' if isinstance(value,list) else b'(')
+        for v in value:
+            HashParameter(v,hashobj)
+        hashobj.update(b']' if isinstance(value,list) else b')')
+    else:
+        hashobj.update(repr(value).encode())
+    hashobj.update(b',')
+
+def ReturnCaseKey(InputFiles,**params):
+    '''
+    Return the hex key of a case from the code version, the contents of the input files and the sorted parameters
+    '''
+    h=hashlib.blake2b(digest_size=20)
+    h.update(CACHE_FORMAT_VERSION.encode())
+    h.update(ReturnCodeVersion().encode())
+    for f in InputFiles:
+        h.update(os.path.basename(f).encode())
+        HashFileContents(f,h)
+    HashParameter(params,h)
+    return h.hexdigest()
+
+class AcousticResultCache(object):
+    def __init__(self,CacheDir,MaxSizeGB=10.0):
+        self._CacheDir=CacheDir
+        self._MaxSize=int(MaxSizeGB*(1<<30))
+        self._EvictLock=Lock()
+        os.makedirs(CacheDir,exist_ok=True)
+
+    def EntryPath(self,key):
+        return os.path.join(self._CacheDir,key)
+
+    def Restore(self,key,OutDir):
+        '''
+        Copy the files of entry key into OutDir, returns False if the entry does not exist
+        '''
+        entry=self.EntryPath(key)
+        if not os.path.isdir(entry):
+            return False
+        for f in os.listdir(entry):
+            shutil.copyfile(os.path.join(entry,f),os.path.join(OutDir,f))
+        os.utime(entry) #most recently used
+        print('Results restored from acoustic cache',entry)
+        return True
+
+    def Store(self,key,OutputFiles):
+        '''
+        Store OutputFiles as entry key, the entry is written in a temporary directory and renamed when complete
+        '''
+        entry=self.EntryPath(key)
+        if os.path.isdir(entry) or len(OutputFiles)==0:
+            return
+        tmpentry=entry+'.tmp-%i' % os.getpid()
+        shutil.rmtree(tmpentry,ignore_errors=True)
+        os.makedirs(tmpentry)
+        for f in OutputFiles:
+            shutil.copyfile(f,os.path.join(tmpentry,os.path.basename(f)))
+        try:
+            os.rename(tmpentry,entry)
+        except OSError:
+            #another process stored the same entry
+            shutil.rmtree(tmpentry,ignore_errors=True)
+        self.Evict()
+
+    def Evict(self):
+        #remove least recently used entries until the cache fits in the size limit
+        #cases finishing in other threads evict at the same time, and other processes may remove entries while they are listed
+        with self._EvictLock:
+            Entries=[]
+            TotalSize=0
+            for entry in os.listdir(self._CacheDir):
+                fentry=os.path.join(self._CacheDir,entry)
+                if not os.path.isdir(fentry) or '.tmp-' in entry:
+                    continue
+                try:
+                    size=sum(os.path.getsize(os.path.join(fentry,f)) for f in os.listdir(fentry))
+                    Entries.append((os.path.getmtime(fentry),size,fentry))
+                except FileNotFoundError:
+                    continue
+                TotalSize+=size
+            Entries.sort()
+            while TotalSize>self._MaxSize and len(Entries)>1:
+                _,size,fentry=Entries.pop(0)
+                shutil.rmtree(fentry,ignore_errors=True)
+                TotalSize-=size
+
+def ReturnCaseOutputFiles(OutDir,OutPrefix,StartTime,ExcludePrefix=None):
+    '''
+    Return the files in OutDir starting with OutPrefix that were written after StartTime
+    '''
+    OutputFiles=[]
+    for f in glob.glob(os.path.join(glob.escape(OutDir),glob.escape(OutPrefix)+'*')):
+        if ExcludePrefix is not None and os.path.basename(f).startswith(ExcludePrefix):
+            continue
+        if os.path.isfile(f) and os.path.getmtime(f)>=StartTime:
+            OutputFiles.append(f)
+    return OutputFiles
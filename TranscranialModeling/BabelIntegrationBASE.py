@@ -16,25 +16,25 @@ import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 from BabelViscoFDTD.H5pySimple import ReadFromH5py,SaveToH5py
 from BabelViscoFDTD.PropagationModel import PropagationModel
-from BabelViscoFDTD.tools.RayleighAndBHTE import InitCuda,InitOpenCL, InitMetal
+from BabelViscoFDTD.tools.RayleighAndBHTE import InitCuda,InitOpenCL, InitMetal, ForwardSimple
 import nibabel
 import SimpleITK as sitk
 from scipy import interpolate
 import warnings
 import time
 import gc
+import copy
+import gzip
 import os
 import os
 import pandas as pd
 import h5py
 from linetimer import CodeTimer
+from .AcousticResultCache import AcousticResultCache, ReturnCaseKey, ReturnCaseOutputFiles
+from .DataForSimH5 import SaveDataForSim
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
-try:
-    import mkl_fft as fft
-except:
-    print('mkl_fft not available')
-    from numpy import fft
-    
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 import os
@@ -319,53 +319,111 @@ def DensityToSSoSPichardo(density):
     return density*0.422 + 680.515  
     
 
-def SaveNiftiEnforcedISO(nii,fn):
-    nii.to_filename(fn)
-    newfn=fn.split('__.nii.gz')[0]+'.nii.gz'
+def ReturnNiftiEnforcedISO(nii):
+    '''
+    Return an image sharing the data of nii, with isotropic zooms equal to the mean of the original ones.
+    The direction cosines are kept (made orthonormal if needed, as done by ITK) and the data is not resampled
+    '''
     res = float(np.round(np.array(nii.header.get_zooms()).mean(),5))
-    try:
-        pre=sitk.ReadImage(fn)
-        pre.SetSpacing([res,res,res])
-        sitk.WriteImage(pre, newfn)
-        os.remove(fn)
-    except:
-        res = '%6.5f' % (res)
-        cmd='flirt -in "'+fn + '" -ref "'+ fn + '" -applyisoxfm ' +res + ' -nosearch -out "' +fn.split('__.nii.gz')[0]+'.nii.gz'+'"'
-        print(cmd)
-        assert(os.system(cmd)==0)
-        os.remove(fn)
-
-def ResaveNormalized(RPath,Mask):
+    affine=nii.affine.copy()
+    Rot=affine[:3,:3]/np.linalg.norm(affine[:3,:3],axis=0)
+    if not np.allclose(Rot.T@Rot,np.eye(3),atol=1e-4):
+        U,_,Vt=np.linalg.svd(Rot)
+        Rot=U@Vt
+    affine[:3,:3]=Rot*res
+    newnii=nibabel.Nifti1Image(nii.dataobj,affine,header=nii.header)
+    newnii.set_qform(affine,code=1)
+    newnii.set_sform(affine,code=1)
+    newnii.header.set_xyzt_units('mm','sec')
+    return newnii
+
+def WriteNifti(nii,fn,GzipLevel=1):
+    #single write, with the requested compression level for .gz files
+    if fn.endswith('.gz'):
+        with gzip.open(fn,'wb',compresslevel=GzipLevel) as f:
+            file_map=nii.make_file_map({'image':f})
+            nii.to_file_map(file_map)
+    else:
+        nii.to_filename(fn)
+
+def SaveNiftiEnforcedISO(nii,fn,GzipLevel=1):
+    '''
+    Save nii with isotropic voxel size, fn is expected to end with __.nii.gz that is removed from the final name. 
+    Returns the saved image
+    '''
+    newfn=fn.split('__.nii.gz')[0]+'.nii.gz'
+    newnii=ReturnNiftiEnforcedISO(nii)
+    WriteNifti(newnii,newfn,GzipLevel=GzipLevel)
+    return newnii
+
+def ResaveNormalized(RPath,Mask,Results=None,GzipLevel=1):
+    '''
+    Save a normalized version of the results in RPath, with regions outside the brain set to 0. If Results is given, 
+    it is used instead of loading RPath
+    '''
     assert('_Sub.nii.gz' in RPath)
     NRPath=RPath.replace('_Sub.nii.gz','_Sub_NORM.nii.gz')
 
-    Results=nibabel.load(RPath)
+    if Results is None:
+        Results=nibabel.load(RPath)
 
-    ResultsData=Results.get_fdata()
+    ResultsData=np.array(Results.dataobj,dtype=np.float32)
     MaskData=Mask.get_fdata()
-    ii,jj,kk=np.mgrid[0:ResultsData.shape[0],0:ResultsData.shape[1],0:ResultsData.shape[2]]
-
-    Indexes=np.c_[(ii.flatten().T,jj.flatten().T,kk.flatten().T,np.ones((kk.size,1)))].T
-
-    PosResults=Results.affine.dot(Indexes)
-
-    IndexesMask=np.round(np.linalg.inv(Mask.affine).dot(PosResults)).astype(int)
-
-    SubMask=MaskData[IndexesMask[0,:],IndexesMask[1,:],IndexesMask[2,:]].reshape(ResultsData.shape)
+    #indexes in the mask of each voxel of the results
+    ResultsToMask=np.linalg.inv(Mask.affine) @ Results.affine
+    ii,jj,kk=[np.arange(n) for n in ResultsData.shape]
+    IndexesMask=[np.round(ResultsToMask[n,0]*ii[:,None,None]+
+                          ResultsToMask[n,1]*jj[None,:,None]+
+                          ResultsToMask[n,2]*kk[None,None,:]+ResultsToMask[n,3]).astype(int) for n in range(3)]
+
+    SubMask=MaskData[IndexesMask[0],IndexesMask[1],IndexesMask[2]]
     ResultsData[SubMask<4]=0
     ResultsData/=ResultsData.max()
     NormalizedNifti=nibabel.Nifti1Image(ResultsData,Results.affine,header=Results.header)
-    NormalizedNifti.to_filename(NRPath)
+    WriteNifti(NormalizedNifti,NRPath,GzipLevel=GzipLevel)
     
 ####
 bGPU_INITIALIZED = False
 ###
 
+def ShareContextAttributes(Attributes):
+    '''
+    Return a copy of attributes kept in a case context. Arrays are read-only once calculated (Tx geometry, Rayleigh source and fields),
+    so they are shared by reference, other entries are deep copied
+    '''
+    return {k:(v if isinstance(v,np.ndarray) else copy.deepcopy(v)) for k,v in Attributes.items()}
+
 class RUN_SIM_BASE(object):
+    MaxCaseContexts=4 #number of case contexts kept between calls of RunCases
+    CaseContextSharedSettings=() #Tx settings not used as key of case contexts, the simulation object keys the entries that depend on them
+    
     def CreateSimObject(self,**kargs):
         #this passes extra parameters needed for a given Tx
         raise NotImplementedError("Need to implement this")
 
+    def ReturnCaseContext(self,*args,InputFiles=[],**kargs):
+        '''
+        Return the dictionary shared by all runs with the same case parameters (e.g. skull and water only),
+        the Tx settings stored in this object (steering, aperture, etc.) and the modification time and size of
+        InputFiles (mask, CT) are part of the key, so a context is not reused after the inputs are regenerated
+        '''
+        if not hasattr(self,'_CaseContexts'):
+            self._CaseContexts={}
+        TxSettings={k:v for k,v in self.__dict__.items() if k!='_CaseContexts' and k not in self.CaseContextSharedSettings}
+        FileStamps=[]
+        for f in InputFiles:
+            if os.path.isfile(f):
+                st=os.stat(f)
+                FileStamps.append((f,st.st_mtime_ns,st.st_size))
+            else:
+                FileStamps.append((f,None))
+        key=repr((args,sorted(kargs.items()),sorted(TxSettings.items()),FileStamps))
+        if key not in self._CaseContexts:
+            while len(self._CaseContexts)>=self.MaxCaseContexts:
+                self._CaseContexts.pop(next(iter(self._CaseContexts)))
+            self._CaseContexts[key]={}
+        return self._CaseContexts[key]
+
     def RunCases(self,targets=[''],deviceName='A6000',COMPUTING_BACKEND=1,
                 ID='LIFU1-01',
                 basedir='../LIFU Clinical Trial Data/Participants/',
@@ -384,11 +442,18 @@ class RUN_SIM_BASE(object):
                 bWaterOnly=False,
                 bDryRun=False,
                 bUseRayleighForWater=False,
+                nCaseWorkers=0, #number of worker threads for the CPU stages of other cases, 0 runs all cases serially
+                MaxCasesInFlight=2, #maximum number of cases kept in memory on top of the one running in the device
+                bReuseCaseContext=True, #reuse mask, domain and Rayleigh source from a previous run of the same case (e.g. skull run before water only)
+                AcousticCacheDir=None, #if not None, results are stored and recovered (unless bForceRecalc) from a cache keyed on the contents of inputs, parameters and code version
+                AcousticCacheMaxSizeGB=10.0,
+                bEstimateOnly=False, #if True, a list with the domain size and cost estimates of each case is returned instead of running simulations
+                CaseVariants=None, #list of dictionaries with 'extrasuffix' and 'TxSettings' (attributes of this object, e.g. steering), each target is run for every variant
                 **kargs):
         
         global bGPU_INITIALIZED
         
-        if not bGPU_INITIALIZED:
+        if not bGPU_INITIALIZED and not bEstimateOnly:
             if COMPUTING_BACKEND==1:
                 InitCuda(deviceName)
             elif COMPUTING_BACKEND==2:
@@ -397,8 +462,19 @@ class RUN_SIM_BASE(object):
                 InitMetal(deviceName)
             bGPU_INITIALIZED=True
             
+        ResultCache=None
+        if AcousticCacheDir is not None:
+            ResultCache=AcousticResultCache(AcousticCacheDir,MaxSizeGB=AcousticCacheMaxSizeGB)
+            
+        if CaseVariants is None:
+            CaseVariants=[{'extrasuffix':extrasuffix,'TxSettings':{}}]
+
         OutNames=[]
-        for target in targets:
+        Cases=[]
+        for Variant,target in [(v,t) for v in CaseVariants for t in targets]:
+            #variants differ only in Tx settings, so they can share case contexts (mask, domain, material map)
+            self.__dict__.update(Variant['TxSettings'])
+            CaseSuffix=Variant.get('extrasuffix',extrasuffix)
             subsamplingFactor=1 
             #sub sample when save the final results.
             for Frequency in Frequencies:
@@ -418,15 +494,16 @@ class RUN_SIM_BASE(object):
                     else:
                         CTFNAME=None
 
-                    FILENAMES=OutputFileNames(MASKFNAME,target,Frequency,PPW,extrasuffix,bWaterOnly)
+                    FILENAMES=OutputFileNames(MASKFNAME,target,Frequency,PPW,CaseSuffix,bWaterOnly)
                     FILENAMESWater=None
                     if bUseRayleighForWater:
                         # we store also the filenames for water only
-                        FILENAMESWater=OutputFileNames(MASKFNAME,target,Frequency,PPW,extrasuffix,True)
+                        FILENAMESWater=OutputFileNames(MASKFNAME,target,Frequency,PPW,CaseSuffix,True)
                     cname=FILENAMES['DataForSim']
                     print(cname)
                     OutNames.append(cname)
-                    if (os.path.isfile(cname)and not bForceRecalc):
+                    #with a cache, existing results are only reused if inputs, parameters and code match (checked below)
+                    if (ResultCache is None and os.path.isfile(cname)and not bForceRecalc and not bEstimateOnly):
                         print('*'*50)
                         print (' Skipping '+ cname)
                         print('*'*50)
@@ -436,60 +513,169 @@ class RUN_SIM_BASE(object):
                         #we just need to calculate the filenames
                         continue
 
-                    TestClass=self.CreateSimObject(MASKFNAME=MASKFNAME,
-                                                    bTightNarrowBeamDomain=bTightNarrowBeamDomain,
-                                                    Frequency=Frequency,
-                                                    basePPW=PPW,
-                                                    SensorSubSampling=SensorSubSampling,
-                                                    AlphaCFL=AlphaCFL,
-                                                    bWaterOnly=bWaterOnly,
-                                                    TxMechanicalAdjustmentX=TxMechanicalAdjustmentX,
-                                                    TxMechanicalAdjustmentY=TxMechanicalAdjustmentY,
-                                                    TxMechanicalAdjustmentZ=TxMechanicalAdjustmentZ,
-                                                    bDoRefocusing=bDoRefocusing,
-                                                    CTFNAME=CTFNAME,
-                                                    bDisplay=bDisplay,
-                                                    **kargs)
-                    print('  Step 1')
-
-                    #with suppress_stdout():
-                    with CodeTimer("Time for step 1",unit='s'):
-                        TestClass.Step1_InitializeConditions()
-                    print('  Step 2')
-                    with CodeTimer("Time for step 2",unit='s'):
-                        TestClass.Step2_CalculateRayleighFieldsForward(prefix=FILENAMES['outName'],
-                                                                    deviceName=deviceName,
-                                                                    bSkipSavingSTL= bMinimalSaving)
-
-                    print('  Step 3')
-                    with CodeTimer("Time for step 3",unit='s'):
-                        TestClass.Step3_CreateSourceSignal_and_Sensor()
-                    print('  Step 4')
-                    with CodeTimer("Time for step 4",unit='s'):
-                        TestClass.Step4_Run_Simulation(GPUName=deviceName,COMPUTING_BACKEND=COMPUTING_BACKEND)
-                    print('  Step 5')
-                    with CodeTimer("Time for step 5",unit='s'):
-                        TestClass.Step5_ExtractPhaseDataForwardandBack()
-                    if bDoRefocusing:
-
-                        print('  Step 6')
-                        with CodeTimer("Time for step 6",unit='s'):
-                            TestClass.Step6_BackPropagationRayleigh(deviceName=deviceName)
-                        print('  Step 7')
-                        with CodeTimer("Time for step 7",unit='s'):
-                            TestClass.Step7_Run_Simulation_Refocus(GPUName=deviceName,COMPUTING_BACKEND=COMPUTING_BACKEND)
-                        print('  Step 8')
-                        with CodeTimer("Time for step 8",unit='s'):
-                            TestClass.Step8_ExtractPhaseDataRefocus()
-                    print('  Step 9')
-                    with CodeTimer("Time for step 9",unit='s'):
-                        TestClass.Step9_PrepAndPlotData()
-                    print('  Step 10')
-                    with CodeTimer("Time for step 10",unit='s'):
-                        TestClass.Step10_GetResults(FILENAMES,subsamplingFactor=subsamplingFactor,
-                                                        bMinimalSaving=bMinimalSaving,
-                                                        bUseRayleighForWater=bUseRayleighForWater,
-                                                        FILENAMESWater=FILENAMESWater)
+                    CacheKey=None
+                    if ResultCache is not None and not bEstimateOnly:
+                        #with bForceRecalc results are recomputed, and stored again
+                        InputFiles=[MASKFNAME]
+                        if CTFNAME is not None:
+                            InputFiles+=[CTFNAME,CTFNAME.split('CT.nii.gz')[0]+'CT-cal.npz']
+                        CacheKey=ReturnCaseKey(InputFiles,
+                                               target=target,
+                                               Frequency=Frequency,
+                                               PPW=PPW,
+                                               extrasuffix=CaseSuffix,
+                                               TxMechanicalAdjustment=(TxMechanicalAdjustmentX,TxMechanicalAdjustmentY,TxMechanicalAdjustmentZ),
+                                               bTightNarrowBeamDomain=bTightNarrowBeamDomain,
+                                               bDoRefocusing=bDoRefocusing,
+                                               bWaterOnly=bWaterOnly,
+                                               bUseRayleighForWater=bUseRayleighForWater,
+                                               bMinimalSaving=bMinimalSaving,
+                                               Materials=MatFreq.get(Frequency,None),
+                                               TxSettings={k:v for k,v in self.__dict__.items() if k!='_CaseContexts'},
+                                               kargs=kargs)
+                        if not bForceRecalc and ResultCache.Restore(CacheKey,os.path.dirname(MASKFNAME)):
+                            continue
+
+                    CaseContext=None
+                    if bReuseCaseContext:
+                        CaseContext=self.ReturnCaseContext(MASKFNAME,Frequency,PPW,bTightNarrowBeamDomain,
+                                                           TxMechanicalAdjustmentX,TxMechanicalAdjustmentY,
+                                                           TxMechanicalAdjustmentZ,
+                                                           InputFiles=[MASKFNAME]+([CTFNAME] if CTFNAME is not None else []),
+                                                           **kargs)
+                    Cases.append({'MASKFNAME':MASKFNAME,
+                                  'CaseContext':CaseContext,
+                                  'TxSettings':dict(Variant['TxSettings']),
+                                  'CacheKey':CacheKey,
+                                  'CTFNAME':CTFNAME,
+                                  'Frequency':Frequency,
+                                  'PPW':PPW,
+                                  'SensorSubSampling':SensorSubSampling,
+                                  'AlphaCFL':AlphaCFL,
+                                  'subsamplingFactor':subsamplingFactor,
+                                  'FILENAMES':FILENAMES,
+                                  'FILENAMESWater':FILENAMESWater})
+
+        TxSettingsLock=Lock()
+        def PrepareCase(Case,bPlanOnly=False):
+            #CPU stage: mask loading and domain conditions
+            StartTime=time.time()
+            with TxSettingsLock:
+                #the simulation object copies the Tx settings of this object when created
+                self.__dict__.update(Case['TxSettings'])
+                TestClass=self.CreateSimObject(MASKFNAME=Case['MASKFNAME'],
+                                                bTightNarrowBeamDomain=bTightNarrowBeamDomain,
+                                                Frequency=Case['Frequency'],
+                                                basePPW=Case['PPW'],
+                                                SensorSubSampling=Case['SensorSubSampling'],
+                                                AlphaCFL=Case['AlphaCFL'],
+                                                bWaterOnly=bWaterOnly,
+                                                TxMechanicalAdjustmentX=TxMechanicalAdjustmentX,
+                                                TxMechanicalAdjustmentY=TxMechanicalAdjustmentY,
+                                                TxMechanicalAdjustmentZ=TxMechanicalAdjustmentZ,
+                                                bDoRefocusing=bDoRefocusing,
+                                                CTFNAME=Case['CTFNAME'],
+                                                bDisplay=bDisplay,
+                                                CaseContext=Case['CaseContext'],
+                                                **kargs)
+            print('  Step 1')
+            with CodeTimer("Time for step 1",unit='s'):
+                TestClass.Step1_InitializeConditions(bPlanOnly=bPlanOnly)
+            TestClass._StartTime=StartTime
+            return TestClass
+
+        def RunDeviceSteps(TestClass,Case):
+            #all steps using the GPU device run in the calling thread
+            print('  Step 2')
+            with CodeTimer("Time for step 2",unit='s'):
+                TestClass.Step2_CalculateRayleighFieldsForward(prefix=Case['FILENAMES']['outName'],
+                                                            deviceName=deviceName,
+                                                            bSkipSavingSTL= bMinimalSaving)
+
+            print('  Step 3')
+            with CodeTimer("Time for step 3",unit='s'):
+                TestClass.Step3_CreateSourceSignal_and_Sensor()
+            print('  Step 4')
+            with CodeTimer("Time for step 4",unit='s'):
+                TestClass.Step4_Run_Simulation(GPUName=deviceName,COMPUTING_BACKEND=COMPUTING_BACKEND)
+            if bDoRefocusing:
+                print('  Step 5')
+                with CodeTimer("Time for step 5",unit='s'):
+                    TestClass.Step5_ExtractPhaseDataForwardandBack()
+
+                print('  Step 6')
+                with CodeTimer("Time for step 6",unit='s'):
+                    TestClass.Step6_BackPropagationRayleigh(deviceName=deviceName)
+                print('  Step 7')
+                with CodeTimer("Time for step 7",unit='s'):
+                    TestClass.Step7_Run_Simulation_Refocus(GPUName=deviceName,COMPUTING_BACKEND=COMPUTING_BACKEND)
+            #the water field used in Step 10 also needs the device
+            TestClass.PrepareRayleighFieldSubVolume()
+
+        def FinishCase(TestClass,Case):
+            #CPU stage: phase extraction and saving of results
+            StartTime=TestClass._StartTime
+            if not bDoRefocusing:
+                print('  Step 5')
+                with CodeTimer("Time for step 5",unit='s'):
+                    TestClass.Step5_ExtractPhaseDataForwardandBack()
+            else:
+                print('  Step 8')
+                with CodeTimer("Time for step 8",unit='s'):
+                    TestClass.Step8_ExtractPhaseDataRefocus()
+            print('  Step 9')
+            with CodeTimer("Time for step 9",unit='s'):
+                TestClass.Step9_PrepAndPlotData()
+            print('  Step 10')
+            with CodeTimer("Time for step 10",unit='s'):
+                TestClass.Step10_GetResults(Case['FILENAMES'],subsamplingFactor=Case['subsamplingFactor'],
+                                                bMinimalSaving=bMinimalSaving,
+                                                bUseRayleighForWater=bUseRayleighForWater,
+                                                FILENAMESWater=Case['FILENAMESWater'])
+            if ResultCache is not None:
+                #all outputs of a case share the same prefix, we take those written during this run
+                OutPrefix=os.path.basename(Case['FILENAMES']['DataForSim']).split('DataForSim.h5')[0]
+                ExcludePrefix=None
+                if not bWaterOnly and not bUseRayleighForWater:
+                    ExcludePrefix=OutPrefix+'Water_'
+                OutputFiles=ReturnCaseOutputFiles(os.path.dirname(Case['MASKFNAME']),OutPrefix,StartTime-2.0,ExcludePrefix=ExcludePrefix)
+                ResultCache.Store(Case['CacheKey'],OutputFiles)
+
+        if bEstimateOnly:
+            Costs=[]
+            for Case in Cases:
+                TestClass=PrepareCase(Case,bPlanOnly=True)
+                Cost=TestClass.ReturnSimulationCost()
+                Cost['DataForSim']=Case['FILENAMES']['DataForSim']
+                Costs.append(Cost)
+            return Costs
+
+        if nCaseWorkers<1 or bDisplay or len(Cases)<2:
+            #serial execution, also used when plotting as matplotlib is not thread safe
+            for Case in Cases:
+                TestClass=PrepareCase(Case)
+                RunDeviceSteps(TestClass,Case)
+                FinishCase(TestClass,Case)
+        else:
+            #the CPU stages of the next and previous cases overlap with the device stages of the current case
+            MaxCasesInFlight=np.max([MaxCasesInFlight,1])
+            with ThreadPoolExecutor(max_workers=nCaseWorkers) as executor:
+                Pending=[]
+                NextPrep=executor.submit(PrepareCase,Cases[0])
+                for n,Case in enumerate(Cases):
+                    TestClass=NextPrep.result()
+                    #we wait for finishing cases to keep memory bounded
+                    while len(Pending)>0 and len(Pending)+1>MaxCasesInFlight:
+                        Pending.pop(0).result()
+                    if n+1<len(Cases):
+                        NextPrep=executor.submit(PrepareCase,Cases[n+1])
+                    RunDeviceSteps(TestClass,Case)
+                    Pending.append(executor.submit(FinishCase,TestClass,Case))
+                    del TestClass
+                for f in Pending:
+                    f.result()
+            gc.collect()
+
         if 'TEST_FORCE_ERROR_BABEL_STEP2' in os.environ:
             if  os.environ['TEST_FORCE_ERROR_BABEL_STEP2']=='1':
                 raise ValueError('TEST_FORCE_ERROR_BABEL_STEP2 was set to 1')
@@ -549,6 +735,10 @@ class BabelFTD_Simulations_BASE(object):
                  MappingMethod='Webb-Marsac',
                  CTMapCombo=('GE','120','B','','0.5, 0.6'),
                  bPETRA = False, #Specify if CT is derived from PETRA
+                 bRayleighSourcePlaneOnly=True, #Only the source plane of the Rayleigh field is calculated in Step 2
+                 CaseContext=None, #dictionary shared between runs of the same case (e.g. skull and water only) to reuse mask, domain and Rayleigh source
+                 NiftiGzipLevel=1, #compression level of the Nifti files saved in Step 10
+                 nNiftiWriteThreads=4, #number of threads writing Nifti files in Step 10
                  CTFNAME=None):
         self._MASKFNAME=MASKFNAME
         
@@ -581,6 +771,10 @@ class BabelFTD_Simulations_BASE(object):
         self._ExtraDepthAdjust = 0.0 
         self._ExtraAdjustX = ExtraAdjustX 
         self._ExtraAdjustY = ExtraAdjustY
+        self._bRayleighSourcePlaneOnly = bRayleighSourcePlaneOnly
+        self._CaseContext = CaseContext
+        self._NiftiGzipLevel = NiftiGzipLevel
+        self._nNiftiWriteThreads = nNiftiWriteThreads
 
     def CreateSimConditions(self,**kargs):
         raise NotImplementedError("Need to implement this")
@@ -589,8 +783,14 @@ class BabelFTD_Simulations_BASE(object):
         #in some Tx settings, we adjust here settings of distance
         pass
 
-    def Step1_InitializeConditions(self): #in case it is desired to move up or down in the Z direction the focal spot
-        self._SkullMask=nibabel.load(self._MASKFNAME)
+    def Step1_InitializeConditions(self,bPlanOnly=False): #in case it is desired to move up or down in the Z direction the focal spot
+        if self._CaseContext is not None and 'SkullMask' in self._CaseContext:
+            #same nifti object, its data is already loaded in memory
+            self._SkullMask=self._CaseContext['SkullMask']
+        else:
+            self._SkullMask=nibabel.load(self._MASKFNAME)
+            if self._CaseContext is not None:
+                self._CaseContext['SkullMask']=self._SkullMask
         SkullMaskDataOrig=np.flip(self._SkullMask.get_fdata(),axis=2)
         voxelS=np.array(self._SkullMask.header.get_zooms())*1e-3
         Dims=np.array(SkullMaskDataOrig.shape)*voxelS
@@ -678,7 +878,8 @@ class BabelFTD_Simulations_BASE(object):
                                 DispersionCorrection=[-2307.53581298, 6875.73903172, -7824.73175146, 4227.49417250, -975.22622721],
                                 ExtraDepthAdjust=self._ExtraDepthAdjust,
                                 ExtraAdjustX=self._ExtraAdjustX,
-                                ExtraAdjustY=self._ExtraAdjustY)
+                                ExtraAdjustY=self._ExtraAdjustY,
+                                bRayleighSourcePlaneOnly=self._bRayleighSourcePlaneOnly)
         if  self._CTFNAME is not None and not self._bWaterOnly:
             for k in ['Skin','Brain']:
                 SelM=MatFreq[self._Frequency][k]
@@ -710,20 +911,53 @@ class BabelFTD_Simulations_BASE(object):
                                             SelM[2]*self._Shear,
                                             SelM[3],
                                             SelM[4]*self._Shear)
-        self._SIM_SETTINGS.UpdateConditions(self._SkullMask,AlphaCFL=self._AlphaCFL,bWaterOnly=self._bWaterOnly)
+        if bPlanOnly:
+            #only domain and time settings, no 3D maps are allocated
+            self._SIM_SETTINGS.PlanConditions(self._SkullMask,AlphaCFL=self._AlphaCFL,CaseContext=self._CaseContext)
+        else:
+            self._SIM_SETTINGS.UpdateConditions(self._SkullMask,AlphaCFL=self._AlphaCFL,bWaterOnly=self._bWaterOnly,
+                                                CaseContext=self._CaseContext)
         gc.collect()
 
+    def ReturnSimulationCost(self,**kargs):
+        return self._SIM_SETTINGS.ReturnSimulationCost(bDoRefocusing=self._bDoRefocusing,**kargs)
+
     def GenerateSTLTx(self,prefix):
         pass
+
+    def ReturnRayleighForwardContextKey(self):
+        #key of the Rayleigh source in the case context, Tx with steering add the settings the source depends on
+        return 'RayleighForward'
         
     def Step2_CalculateRayleighFieldsForward(self,prefix='',deviceName='6800',bSkipSavingSTL=False):
         #we use Rayliegh to forward propagate until a plane on top the skull, this plane will be used as a source in BabelVisco
-        self._SIM_SETTINGS.CalculateRayleighFieldsForward(deviceName=deviceName)
+        ContextKey=self.ReturnRayleighForwardContextKey()
+        if self._CaseContext is not None and ContextKey in self._CaseContext and self._SIM_SETTINGS._bDomainFromContext:
+            print('Reusing Tx geometry and Rayleigh source from case context')
+            self._SIM_SETTINGS.__dict__.update(ShareContextAttributes(self._CaseContext[ContextKey]))
+        else:
+            self._SIM_SETTINGS.CalculateRayleighFieldsForward(deviceName=deviceName)
+            if self._CaseContext is not None:
+                self._CaseContext[ContextKey]=ShareContextAttributes({k:getattr(self._SIM_SETTINGS,k)
+                                                                      for k in self._SIM_SETTINGS.RayleighForwardAttributes})
         if bSkipSavingSTL ==False:
             self.GenerateSTLTx(prefix)
         gc.collect()
         
 
+    def PrepareRayleighFieldSubVolume(self):
+        #the water field over the domain used in Step 10 depends only on the Rayleigh source and the domain,
+        #so it is calculated once and shared with the other runs of the case (e.g. skull and water only)
+        ContextKey=self.ReturnRayleighForwardContextKey()
+        if self._CaseContext is not None and ContextKey in self._CaseContext:
+            Shared=self._CaseContext[ContextKey]
+            if Shared.get('_u2RayleighSubVolume',None) is None:
+                Shared['_u2RayleighSubVolume']=self._SIM_SETTINGS.ReturnRayleighFieldSubVolume()
+            else:
+                self._SIM_SETTINGS._u2RayleighSubVolume=Shared['_u2RayleighSubVolume']
+        else:
+            self._SIM_SETTINGS.ReturnRayleighFieldSubVolume()
+
     def Step3_CreateSourceSignal_and_Sensor(self):
         self._SIM_SETTINGS.CreateSources()
         gc.collect()
@@ -770,67 +1004,64 @@ class BabelFTD_Simulations_BASE(object):
 
     def Step10_GetResults(self,FILENAMES,subsamplingFactor=1,bMinimalSaving=False,bUseRayleighForWater=False,FILENAMESWater=None):
         ss=subsamplingFactor
+        SIM=self._SIM_SETTINGS
+        SIM.PrepareResults(bDoRefocusing=self._bDoRefocusing)
 
-        RayleighWater,RayleighWaterOverlay,\
-            FullSolutionPressure,\
-            FullSolutionPressureRefocus,\
-            DataForSim,\
-            MaskCalcRegions,\
-            FullSolutionPhase,\
-            FullSolutionPhaseRefocus,\
-            RayleighWaterPhase= self._SIM_SETTINGS.ReturnResults(bDoRefocusing=self._bDoRefocusing,bUseRayleighForWater=bUseRayleighForWater)
         affine=self._SkullMask.affine.copy()
         affineSub=affine.copy()
         affine[0:3,0:3]=affine[0:3,0:3] @ (np.eye(3)*subsamplingFactor)
 
-        if bMinimalSaving==False and not bUseRayleighForWater:
-            nii=nibabel.Nifti1Image(RayleighWaterOverlay[::ss,::ss,::ss],affine=affine)
-            SaveNiftiEnforcedISO(nii,FILENAMES['RayleighFreeWaterWOverlay__'])
-        
-        if not bUseRayleighForWater: 
-            nii=nibabel.Nifti1Image(RayleighWater[::ss,::ss,::ss],affine=affine)
-            SaveNiftiEnforcedISO(nii,FILENAMES['RayleighFreeWater__'])
-
-        [mx,my,mz]=np.where(MaskCalcRegions)
+        mx,my,mz=SIM.ReturnCalcRegionBounds()
         locm=np.array([[mx[0],my[0],mz[0],1]]).T
         NewOrig=affineSub @ locm
         affineSub[0:3,3]=NewOrig[0:3,0]
-        mx=np.unique(mx.flatten())
-        my=np.unique(my.flatten())
-        mz=np.unique(mz.flatten())
-        if self._bDoRefocusing:
-            nii=nibabel.Nifti1Image(FullSolutionPressureRefocus[::ss,::ss,::ss],affine=affine)
-            SaveNiftiEnforcedISO(nii,FILENAMES['FullElasticSolutionRefocus__'])
-            nii=nibabel.Nifti1Image(FullSolutionPhaseRefocus[::ss,::ss,::ss],affine=affine)
-            SaveNiftiEnforcedISO(nii,FILENAMES['FullElasticSolutionRefocusPhase__'])
-            nii=nibabel.Nifti1Image(FullSolutionPressureRefocus[mx[0]:mx[-1],my[0]:my[-1],mz[0]:mz[-1]],affine=affineSub)
-            SaveNiftiEnforcedISO(nii,FILENAMES['FullElasticSolutionRefocus_Sub__'])
-            ResaveNormalized(FILENAMES['FullElasticSolutionRefocus_Sub'],self._SkullMask)
-
-                
-        nii=nibabel.Nifti1Image(FullSolutionPressure[::ss,::ss,::ss],affine=affine)
-        SaveNiftiEnforcedISO(nii,FILENAMES['FullElasticSolution__'])
-
-        nii=nibabel.Nifti1Image(FullSolutionPhase[::ss,::ss,::ss],affine=affine)
-        SaveNiftiEnforcedISO(nii,FILENAMES['FullElasticSolutionPhase__'])
-        if bUseRayleighForWater:
-            nii=nibabel.Nifti1Image(RayleighWater[::ss,::ss,::ss],affine=affine)
-            SaveNiftiEnforcedISO(nii,FILENAMESWater['FullElasticSolution__'])
-            nii=nibabel.Nifti1Image(RayleighWaterPhase[::ss,::ss,::ss],affine=affine)
-            SaveNiftiEnforcedISO(nii,FILENAMESWater['FullElasticSolution__'])
-
-        nii=nibabel.Nifti1Image(FullSolutionPressure[mx[0]:mx[-1],my[0]:my[-1],mz[0]:mz[-1]],affine=affineSub)
-        SaveNiftiEnforcedISO(nii,FILENAMES['FullElasticSolution_Sub__'])
-        ResaveNormalized(FILENAMES['FullElasticSolution_Sub'],self._SkullMask)
 
+        #list of (volume, [(filename, bSub, normalized filename)]), each volume is created, saved and released before the next one
+        ListOutputs=[]
+        if not bUseRayleighForWater:
+            if bMinimalSaving==False:
+                ListOutputs.append(('RayleighWaterOverlay',[(FILENAMES['RayleighFreeWaterWOverlay__'],False,None)]))
+            ListOutputs.append(('RayleighWater',[(FILENAMES['RayleighFreeWater__'],False,None),
+                                                 (FILENAMES['RayleighFreeWater__'].replace('RayleighFreeWater','RayleighFreeWater_Sub'),True,None)]))
+        if self._bDoRefocusing:
+            ListOutputs.append(('FullSolutionPressureRefocus',[(FILENAMES['FullElasticSolutionRefocus__'],False,None),
+                                                               (FILENAMES['FullElasticSolutionRefocus_Sub__'],True,FILENAMES['FullElasticSolutionRefocus_Sub'])]))
+            ListOutputs.append(('FullSolutionPhaseRefocus',[(FILENAMES['FullElasticSolutionRefocusPhase__'],False,None)]))
+        ListOutputs.append(('FullSolutionPressure',[(FILENAMES['FullElasticSolution__'],False,None),
+                                                    (FILENAMES['FullElasticSolution_Sub__'],True,FILENAMES['FullElasticSolution_Sub'])]))
+        ListOutputs.append(('FullSolutionPhase',[(FILENAMES['FullElasticSolutionPhase__'],False,None)]))
         if bUseRayleighForWater:
-            nii=nibabel.Nifti1Image(RayleighWater[mx[0]:mx[-1],my[0]:my[-1],mz[0]:mz[-1]],affine=affineSub)
-            SaveNiftiEnforcedISO(nii,FILENAMESWater['FullElasticSolution_Sub__'])
-            ResaveNormalized(FILENAMESWater['FullElasticSolution_Sub'],self._SkullMask)
+            ListOutputs.append(('RayleighWater',[(FILENAMESWater['FullElasticSolution__'],False,None),
+                                                 (FILENAMESWater['FullElasticSolution_Sub__'],True,FILENAMESWater['FullElasticSolution_Sub'])]))
+            ListOutputs.append(('RayleighWaterPhase',[(FILENAMESWater['FullElasticSolutionPhase__'],False,None)]))
+
+        def WriteOutput(nii,fname,fnameNormalized):
+            newnii=SaveNiftiEnforcedISO(nii,fname,GzipLevel=self._NiftiGzipLevel)
+            if fnameNormalized is not None:
+                ResaveNormalized(fnameNormalized,self._SkullMask,Results=newnii,GzipLevel=self._NiftiGzipLevel)
+
+        #the writes of a volume run in the pool while the next volume is created, at most two volumes are kept in memory
+        with ThreadPoolExecutor(max_workers=max(1,self._nNiftiWriteThreads)) as executor:
+            PendingWrites=[]
+            for Name,Outputs in ListOutputs:
+                Volume=SIM.ReturnResultVolume(Name)
+                for f in PendingWrites:
+                    f.result()
+                PendingWrites=[]
+                gc.collect()
+                for fname,bSub,fnameNormalized in Outputs:
+                    if bSub:
+                        nii=nibabel.Nifti1Image(Volume[mx[0]:mx[-1],my[0]:my[-1],mz[0]:mz[-1]],affine=affineSub)
+                    else:
+                        nii=nibabel.Nifti1Image(Volume[::ss,::ss,::ss],affine=affine)
+                    PendingWrites.append(executor.submit(WriteOutput,nii,fname,fnameNormalized))
+                del nii, Volume
+            for f in PendingWrites:
+                f.result()
+            del PendingWrites
+        gc.collect()
 
-        if not bUseRayleighForWater: 
-            nii=nibabel.Nifti1Image(RayleighWater[mx[0]:mx[-1],my[0]:my[-1],mz[0]:mz[-1]],affine=affineSub)
-            SaveNiftiEnforcedISO(nii,FILENAMES['RayleighFreeWater__'].replace('RayleighFreeWater','RayleighFreeWater_Sub'))
+        DataForSim=SIM.ReturnDataForSim(bDoRefocusing=self._bDoRefocusing,bUseRayleighForWater=bUseRayleighForWater)
         
         if subsamplingFactor>1:
             kt = ['p_amp','p_complex','MaterialMap']
@@ -840,7 +1071,7 @@ class BabelFTD_Simulations_BASE(object):
                 kt.append('p_amp_refocus')
                 kt.append('p_complex_refocus')
             if bUseRayleighForWater:
-                kt.append('p_amp_water','p_complex_water')
+                kt+=['p_amp_water','p_complex_water']
             for k in kt:
                 DataForSim[k]=DataForSim[k][::ss,::ss,::ss]
             for k in ['x_vec','y_vec','z_vec']:
@@ -893,7 +1124,7 @@ class BabelFTD_Simulations_BASE(object):
             
         sname=FILENAMES['DataForSim']
         if bMinimalSaving==False:
-            SaveToH5py(DataForSim,sname)
+            SaveDataForSim(DataForSim,sname)
             if bUseRayleighForWater:
                 #we save now the h5 file for water
                 DataForSim['p_amp']= p_amp_water
@@ -901,7 +1132,7 @@ class BabelFTD_Simulations_BASE(object):
                 if self._bDoRefocusing:
                     DataForSim.pop('p_amp_refocus')
                 sname=FILENAMESWater['DataForSim']
-                SaveToH5py(DataForSim,sname)
+                SaveDataForSim(DataForSim,sname)
 
         gc.collect()
         
@@ -933,6 +1164,9 @@ class SimulationConditionsBASE(object):
     '''
     Class implementing the low level interface to prepare the details of the simulation conditions and execute the simulation
     '''
+    #attributes created by CalculateRayleighFieldsForward, shared by the runs of a case through the case context.
+    #Tx classes add the ones they set (Tx geometry, source plane, phases of the elements)
+    RayleighForwardAttributes=('_RayleighSource','_u2RayleighFieldFull','_u2RayleighSubVolume')
     def __init__(self,baseMaterial=Material['Water'],
                       basePPW=9,
                       PMLThickness = 12, # grid points for perect matching layer, HIGHLY RECOMMENDED DO NOT CHANGE THIS SIZE 
@@ -960,6 +1194,8 @@ class SimulationConditionsBASE(object):
                       ExtraDepthAdjust= 0.0, #for any need to stretch the cone used to calculate the cross section are
                       ExtraAdjustX =[0.0],
                       ExtraAdjustY =[0.0],
+                      bRayleighSourcePlaneOnly=True, # if True, only the source plane of the Rayleigh field is calculated in Step 2, the full volume is calculated on demand when saving results
+                      RayleighChunkSize=4000000, # maximum number of points evaluated per call when calculating Rayleigh fields
                       DispersionCorrection=[-2307.53581298, 6875.73903172, -7824.73175146, 4227.49417250, -975.22622721]):  #coefficients to correct for values lower of CFL =1.0 in wtaer conditions.
         self._Materials=[[baseMaterial[0],baseMaterial[1],baseMaterial[2],baseMaterial[3],baseMaterial[4]]]
         self._basePPW=basePPW
@@ -998,6 +1234,11 @@ class SimulationConditionsBASE(object):
         self._ExtraAdjustX =ExtraAdjustX
         self._ExtraAdjustY =ExtraAdjustY
         self._ZTxCorrecton=ZTxCorrecton
+        self._bRayleighSourcePlaneOnly=bRayleighSourcePlaneOnly
+        self._RayleighChunkSize=RayleighChunkSize
+        self._RayleighSource=None
+        self._u2RayleighFieldFull=None
+        self._u2RayleighSubVolume=None
 
         
         
@@ -1015,9 +1256,117 @@ class SimulationConditionsBASE(object):
     def SpatialStep(self):
         return self._SpatialStep
         
-    def UpdateConditions(self, SkullMaskNii,AlphaCFL=1.0,bWaterOnly=False):
+    #attributes defined by FitDomainToRayleighMap
+    _DomainAttributes=['_SpatialStep','_XLOffset','_YLOffset','_ZLOffset','_XROffset','_YROffset','_ZROffset',
+                       '_XShrink_L','_XShrink_R','_YShrink_L','_YShrink_R','_ZShrink_L','_ZShrink_R',
+                       'bMapFit','_N1','_N2','_N3',
+                       '_FocalSpotLocationOrig','_FocalSpotLocation','_XDim','_YDim','_ZDim']
+
+    def ReturnRadiusFace(self,TopZ):
+        #radius of the cross section of the incident beam at the top of the domain
+        if self._FocalLength!=0:
+            DistanceToFocus=self._FocalLength-TopZ+self._TxMechanicalAdjustmentZ+self._ExtraDepthAdjust
+            Alpha=np.arcsin(self._Aperture/2/(self._FocalLength+self._ExtraDepthAdjust))
+            RadiusFace=DistanceToFocus*np.tan(Alpha)*1.10 # we make a bit larger to be sure of covering all incident beam
+        else:
+            RadiusFace=self._Aperture/2*1.10
+        return RadiusFace
+
+    def ReturnIncidentRegionExtent(self,RadiusFace,SpatialStep):
         '''
-        Update simulation conditions
+        Return the min and max indexes in X and Y, relative to the focal spot, of the voxels covered by the incident beam circle(s).
+        Only the bounding box of each circle is evaluated
+        '''
+        Centers=[[self._TxMechanicalAdjustmentX,self._TxMechanicalAdjustmentY]]
+        for EX,EY in zip (self._ExtraAdjustX,self._ExtraAdjustY):
+            Centers.append([self._TxMechanicalAdjustmentX+EX,self._TxMechanicalAdjustmentY+EY])
+        Extent=np.array([[np.iinfo(np.int64).max,np.iinfo(np.int64).min],
+                         [np.iinfo(np.int64).max,np.iinfo(np.int64).min]])
+        for cx,cy in Centers:
+            rx=np.arange(int(np.floor((cx-RadiusFace)/SpatialStep))-1,int(np.ceil((cx+RadiusFace)/SpatialStep))+2)
+            ry=np.arange(int(np.floor((cy-RadiusFace)/SpatialStep))-1,int(np.ceil((cy+RadiusFace)/SpatialStep))+2)
+            ypp,xpp=np.meshgrid(ry*SpatialStep,rx*SpatialStep)
+            IndXMap,IndYMap=np.nonzero(((xpp-cx)**2+(ypp-cy)**2)<=RadiusFace**2)
+            if len(IndXMap)==0:
+                continue
+            Extent[0,0]=np.min([Extent[0,0],rx[IndXMap.min()]])
+            Extent[0,1]=np.max([Extent[0,1],rx[IndXMap.max()]])
+            Extent[1,0]=np.min([Extent[1,0],ry[IndYMap.min()]])
+            Extent[1,1]=np.max([Extent[1,1],ry[IndYMap.max()]])
+        return Extent
+
+    def FitDomainToRayleighMap(self,SpatialStep):
+        '''
+        Calculate offsets and size of the domain so the incident Rayleigh field fits in between the PML layers.
+        Offsets (padding) and shrinks (cropping of the mask) are calculated directly from the extent of the incident beam relative to the focal spot
+        '''
+        PML=self._PMLThickness
+        self._FocalSpotLocationOrig=np.array(np.where(self._SkullMaskDataOrig==5.0)).flatten()
+        MaskShape=self._SkullMaskDataOrig.shape
+
+        #default offsets in Z
+        self._ZLOffset=PML+self._PaddingForRayleigh+self._PaddingForKArray
+        self._ZLOffset+=int(np.round(self._ZTxCorrecton/self._SpatialStep))
+        self._ZROffset=PML
+        self._ZShrink_L=0
+        self._ZShrink_R=0
+        FocalZ=self._FocalSpotLocationOrig[2]+self._ZLOffset
+        TopZ=PML*SpatialStep-FocalZ*SpatialStep+self._FocalLength
+
+        RadiusFace=self.ReturnRadiusFace(TopZ)
+        print('RadiusFace',RadiusFace)
+        print('self._ExtraAdjustX, self._ExtraAdjustY',self._ExtraAdjustX,self._ExtraAdjustY)
+        Extent=self.ReturnIncidentRegionExtent(RadiusFace,SpatialStep)
+
+        for n,var in enumerate(['X','Y']):
+            #first and last voxel of the incident beam in the mask coordinates
+            LowIndex=self._FocalSpotLocationOrig[n]+Extent[n,0]
+            UpIndex=self._FocalSpotLocationOrig[n]+Extent[n,1]
+            LOffset=PML+np.max([0,-LowIndex])
+            ROffset=PML+np.max([0,UpIndex+1-MaskShape[n]])
+            Shrink_L=0
+            Shrink_R=0
+            if self._bTightNarrowBeamDomain:
+                Shrink_L=np.max([0,LowIndex])
+                Shrink_R=np.max([0,MaskShape[n]-UpIndex-1])
+            setattr(self,'_'+var+'LOffset',int(LOffset))
+            setattr(self,'_'+var+'ROffset',int(ROffset))
+            setattr(self,'_'+var+'Shrink_L',int(Shrink_L))
+            setattr(self,'_'+var+'Shrink_R',int(Shrink_R))
+            print(var+'LOffset,'+var+'ROffset,'+var+'Shrink_L,'+var+'Shrink_R',LOffset,ROffset,Shrink_L,Shrink_R)
+
+        if self._bTightNarrowBeamDomain:
+            nStepsZReduction=int(self._zLengthBeyonFocalPointWhenNarrow/self._SpatialStep)
+            self._ZShrink_R=int(np.max([0,MaskShape[2]+self._ZLOffset+self._ZROffset-(FocalZ+nStepsZReduction)]))
+            print('ZShrink_R',self._ZShrink_R)
+
+        self.bMapFit=True
+        self._N1=MaskShape[0]+self._XLOffset+self._XROffset -self._XShrink_L-self._XShrink_R
+        self._N2=MaskShape[1]+self._YLOffset+self._YROffset -self._YShrink_L-self._YShrink_R
+        self._N3=MaskShape[2]+self._ZLOffset+self._ZROffset -self._ZShrink_L-self._ZShrink_R 
+
+        self._FocalSpotLocation=self._FocalSpotLocationOrig.copy()
+        self._FocalSpotLocation+=np.array([self._XLOffset,self._YLOffset,self._ZLOffset])
+        self._FocalSpotLocation-=np.array([self._XShrink_L,self._YShrink_L,self._ZShrink_L])
+        print('self._FocalSpotLocation',self._FocalSpotLocation)
+        
+        xfield = np.arange(self._N1)*SpatialStep
+        yfield = np.arange(self._N2)*SpatialStep
+        zfield = np.arange(self._N3)*SpatialStep
+        
+        xfield-=xfield[self._FocalSpotLocation[0]]
+        yfield-=yfield[self._FocalSpotLocation[1]]
+        zfield-=zfield[self._FocalSpotLocation[2]]
+        
+        zfield+=self._FocalLength
+
+        self._XDim=xfield
+        self._YDim=yfield
+        self._ZDim=zfield
+
+    def PlanConditions(self, SkullMaskNii,AlphaCFL=1.0,CaseContext=None):
+        '''
+        Calculate spatial and temporal steps, domain size and sensor settings, without allocating the 3D maps
         '''
         MatArray=self.ReturnArrayMaterial()
         SmallestSOS=np.sort(MatArray[:,1:3].flatten())
@@ -1088,120 +1437,17 @@ class SimulationConditionsBASE(object):
             print('Warning: voxel size in input Nifti and the expected size not identical',voxelS,SpatialStep)
             print('*'*40)
         
-        self._XLOffset=self._PMLThickness 
-        self._YLOffset=self._PMLThickness
-        
-
-        #default offsets , this can change if the Rayleigh field does not fit
-        self._ZLOffset=self._PMLThickness+self._PaddingForRayleigh+self._PaddingForKArray
-        self._ZLOffset+=int(np.round(self._ZTxCorrecton/self._SpatialStep))
-        self._XROffset=self._PMLThickness 
-        self._YROffset=self._PMLThickness
-        self._ZROffset=self._PMLThickness
-        
-        
-        #swe will adjust size of domain until be sure the incident Rayleigh field fits in
-        self._XShrink_L=0
-        self._XShrink_R=0
-        self._YShrink_L=0
-        self._YShrink_R=0
-        self._ZShrink_L=0
-        self._ZShrink_R=0
-        self.bMapFit=False
-        bCompleteForShrinking=False
-        self._nCountShrink=0
-        print('self._ExtraAdjustX, self._ExtraAdjustY',self._ExtraAdjustX,self._ExtraAdjustY)
-        while not self.bMapFit or not bCompleteForShrinking:
-            self.bMapFit=True
-            self._N1=self._SkullMaskDataOrig.shape[0]+self._XLOffset+self._XROffset -self._XShrink_L-self._XShrink_R
-            self._N2=self._SkullMaskDataOrig.shape[1]+self._YLOffset+self._YROffset -self._YShrink_L-self._YShrink_R
-            self._N3=self._SkullMaskDataOrig.shape[2]+self._ZLOffset+self._ZROffset -self._ZShrink_L-self._ZShrink_R 
-
-
-            self._FocalSpotLocationOrig=np.array(np.where(self._SkullMaskDataOrig==5.0)).flatten()
-            self._FocalSpotLocation=self._FocalSpotLocationOrig.copy()
-            self._FocalSpotLocation+=np.array([self._XLOffset,self._YLOffset,self._ZLOffset])
-            self._FocalSpotLocation-=np.array([self._XShrink_L,self._YShrink_L,self._ZShrink_L])
-            print('self._FocalSpotLocation',self._FocalSpotLocation)
-            
-            xfield = np.arange(self._N1)*SpatialStep
-            yfield = np.arange(self._N2)*SpatialStep
-            zfield = np.arange(self._N3)*SpatialStep
-            
-            
-            xfield-=xfield[self._FocalSpotLocation[0]]
-            yfield-=yfield[self._FocalSpotLocation[1]]
-            zfield-=zfield[self._FocalSpotLocation[2]]
-            
-            zfield+=self._FocalLength
-            TopZ=zfield[self._PMLThickness]
-            if self._FocalLength!=0:
-                DistanceToFocus=self._FocalLength-TopZ+self._TxMechanicalAdjustmentZ+self._ExtraDepthAdjust
-                Alpha=np.arcsin(self._Aperture/2/(self._FocalLength+self._ExtraDepthAdjust))
-                RadiusFace=DistanceToFocus*np.tan(Alpha)*1.10 # we make a bit larger to be sure of covering all incident beam
-            else:
-                RadiusFace=self._Aperture/2*1.10
-            
-            print('RadiusFace',RadiusFace)
-            print('yfield',yfield.min(),yfield.max())
-            
-            ypp,xpp=np.meshgrid(yfield,xfield)
-            
-            RegionMap=((xpp-self._TxMechanicalAdjustmentX)**2+(ypp-self._TxMechanicalAdjustmentY)**2)<=RadiusFace**2 #we select the circle on the incident field
-            for EX,EY in zip (self._ExtraAdjustX,self._ExtraAdjustY):
-                RegionMap=(RegionMap)|(((xpp-self._TxMechanicalAdjustmentX-EX)**2+(ypp-self._TxMechanicalAdjustmentY-EY)**2)<=RadiusFace**2)
-                IndXMap,IndYMap=np.nonzero(RegionMap)
-            print('RegionMap',np.sum(RegionMap))
-            
-            def fgen(var):
-                sn={'X':'1','Y':'2','Z':'3'}
-                pcode=\
-'''
-
-if np.any(Ind{0}Map<self._PMLThickness):
-    print('** Rayleigh map not fitting in the low part of N{1}, increasing it ...', self._{0}LOffset)
-    self._{0}LOffset+=self._PMLThickness-Ind{0}Map.min()
-    print('{0}LOffset',self._{0}LOffset)
-    self.bMapFit=False
-elif self._bTightNarrowBeamDomain:
-    if self._{0}LOffset==self._PMLThickness:
-        self._{0}Shrink_L+=Ind{0}Map.min()-self._{0}LOffset
-        print('{0}Shrink_L',self._{0}Shrink_L)
-    self._nCountShrink+=1
-if np.any(Ind{0}Map>=self._N{1}-self._PMLThickness):
-    print('** Rayleigh map not fitting in the upper part of N{1}, increasing it ...',self._{0}ROffset)
-    self._{0}ROffset+=Ind{0}Map.max()-(self._N{1}-self._PMLThickness)+1
-    print('{0}Offset',self._{0}ROffset)
-    self.bMapFit=False
-elif self._bTightNarrowBeamDomain:
-    if self._{0}ROffset==self._PMLThickness:
-        self._{0}Shrink_R+=self._N{1}-self._{0}ROffset-Ind{0}Map.max()-1
-        print('{0}Shrink_R',self._{0}Shrink_R)
-    self._nCountShrink+=1
-'''.format(var,sn[var])
-                return pcode
-            
-            
-            exec(fgen('X'))
-            exec(fgen('Y'))
-
-            if self._bTightNarrowBeamDomain:
-                nStepsZReduction=int(self._zLengthBeyonFocalPointWhenNarrow/self._SpatialStep)
-                self._ZShrink_R+=self._N3-(self._FocalSpotLocation[2]+nStepsZReduction)
-                if self._ZShrink_R<0:
-                    self._ZShrink_R=0
-                print('ZShrink_R',self._ZShrink_R,self._nCountShrink)
-                    
-            if self.bMapFit:
-                if self._bTightNarrowBeamDomain==False:
-                    bCompleteForShrinking=True
-                elif self._nCountShrink>=8:
-                    bCompleteForShrinking=True
-        
-        self._XDim=xfield
-        self._YDim=yfield
-        self._ZDim=zfield
-        
+        self._bDomainFromContext=False
+        if CaseContext is not None and 'Domain' in CaseContext and np.isclose(CaseContext['Domain']['_SpatialStep'],SpatialStep):
+            #the domain only depends on geometry, it is the same for skull and water only conditions
+            print('Reusing domain from case context')
+            for k,v in CaseContext['Domain'].items():
+                setattr(self,k,copy.deepcopy(v))
+            self._bDomainFromContext=True
+        else:
+            self.FitDomainToRayleighMap(SpatialStep)
+            if CaseContext is not None:
+                CaseContext['Domain']={k:copy.deepcopy(getattr(self,k)) for k in self._DomainAttributes}
         
         print('Domain size',self._N1,self._N2,self._N3)
         self._DimDomain=np.zeros((3))
@@ -1238,6 +1484,54 @@ elif self._bTightNarrowBeamDomain:
         nStepsBack=int(self._NumberCyclesToTrackAtEnd*self._PPP)
         self._SensorStart=int((TimeVector.shape[0]-nStepsBack)/self._SensorSubSampling)
 
+    def ReturnSimulationCost(self,bDoRefocusing=True,VoxelUpdatesPerSecond=2e9,BytesPerVoxel=84):
+        '''
+        Return a dictionary with domain size, time steps, sensor samples and estimates of device memory (bytes) and runtime (s) of the FDTD runs.
+        PlanConditions or UpdateConditions must have been called. VoxelUpdatesPerSecond depends on the GPU and BytesPerVoxel accounts
+        for the velocity, stress and memory variables, material map and peak maps in single precision
+        '''
+        ntSteps=int(np.round(self._TimeSimulation/self._TemporalStep))
+        NSensors=(self._N1-2*self._PMLThickness)*(self._N2-2*self._PMLThickness)*(self._N3-self._PMLThickness-self._ZSourceLocation-1)
+        NSensorSamples=int(np.floor(self._TimeSimulation/self._TemporalStep/self._SensorSubSampling)-self._SensorStart)
+        NVoxels=self._N1*self._N2*self._N3
+        nRuns=1
+        if bDoRefocusing:
+            nRuns=3 #forward, back-propagation and refocusing
+        Cost={'N1':self._N1,
+              'N2':self._N2,
+              'N3':self._N3,
+              'SpatialStep':self._SpatialStep,
+              'TemporalStep':self._TemporalStep,
+              'PPP':int(self._PPP),
+              'TimeSteps':ntSteps,
+              'SensorSubSampling':self._SensorSubSampling,
+              'NumberSensors':NSensors,
+              'SensorSamples':NSensorSamples,
+              'DeviceMemory':NVoxels*BytesPerVoxel+NSensors*NSensorSamples*4,
+              'Runtime':nRuns*NVoxels*ntSteps/VoxelUpdatesPerSecond}
+        return Cost
+
+    def UpdateConditions(self, SkullMaskNii,AlphaCFL=1.0,bWaterOnly=False,CaseContext=None):
+        '''
+        Update simulation conditions
+        '''
+        self.PlanConditions(SkullMaskNii,AlphaCFL=AlphaCFL,CaseContext=CaseContext)
+
+        MapKey='MaterialMapCT' if self._DensityCTMap is not None else 'MaterialMap'
+        if bWaterOnly==False and CaseContext is not None and MapKey in CaseContext and self._bDomainFromContext:
+            #the material maps are only read after this point, so the same arrays are shared by all runs of the case
+            print('Reusing material map from case context')
+            self.__dict__.update(CaseContext[MapKey])
+        else:
+            self.CreateMaterialMap(bWaterOnly)
+            if bWaterOnly==False and CaseContext is not None:
+                CaseContext[MapKey]={k:getattr(self,k) for k in ['_MaterialMap','_MaterialMapNoCT'] if hasattr(self,k)}
+        
+        print('PPP, Duration simulation',np.round(1/self._Frequency/self._TemporalStep),self._TimeSimulation*1e6)
+        
+        print('Number of steps sensor',np.floor(self._TimeSimulation/self._TemporalStep/self._SensorSubSampling)-self._SensorStart)
+
+    def CreateMaterialMap(self,bWaterOnly=False):
         self._MaterialMap=np.zeros((self._N1,self._N2,self._N3),np.uint32) # note the 32 bit size
         if bWaterOnly==False:
             if self._XShrink_R==0:
@@ -1280,20 +1574,169 @@ elif self._bTightNarrowBeamDomain:
 
             #We remove tissue layers
             self._MaterialMap[:,:,:self._ZSourceLocation+1] = 0 # we remove tissue layers by putting water
-        
-        print('PPP, Duration simulation',np.round(1/self._Frequency/TemporalStep),self._TimeSimulation*1e6)
-        
-        print('Number of steps sensor',np.floor(self._TimeSimulation/self._TemporalStep/self._SensorSubSampling)-self._SensorStart)
-        
 
     def CalculateRayleighFieldsForward(self,deviceName='6800'):
         raise NotImplementedError("Need to implement this")
+
+    def ReturnRayleighSource(self,cwvnb,center,ds,u0,deviceName='6800',ZDim=None):
+        '''
+        Return the description of a Tx source to be used with CalculateRayleighPlanes
+        '''
+        if ZDim is None:
+            ZDim=self._ZDim
+        return {'cwvnb':cwvnb,
+                'center':center.astype(np.float32),
+                'ds':ds.astype(np.float32),
+                'u0':u0,
+                'deviceName':deviceName,
+                'ZDim':ZDim}
+
+    def SetRayleighSource(self,cwvnb,center,ds,u0,deviceName='6800',ZDim=None):
+        '''
+        Store the description of the Tx used for the forward Rayleigh calculations, so the field can be evaluated later at any plane
+        '''
+        self._RayleighSource=self.ReturnRayleighSource(cwvnb,center,ds,u0,deviceName=deviceName,ZDim=ZDim)
+        self._u2RayleighFieldFull=None
+        self._u2RayleighSubVolume=None
+
+    def CalculateRayleighPlanes(self,zIndexes,XRange=None,YRange=None,RayleighSource=None):
+        '''
+        Calculate the Rayleigh field only at the planes in zIndexes, optionally over a subregion (XRange,YRange) of the domain.
+        Calculations are done in chunks of at most self._RayleighChunkSize points, and no 3D meshgrid is created.
+        If RayleighSource is None, the source stored with SetRayleighSource is used
+        '''
+        if RayleighSource is None:
+            RayleighSource=self._RayleighSource
+        assert(RayleighSource is not None)
+        Src=RayleighSource
+        zIndexes=np.atleast_1d(zIndexes)
+        XDim=self._XDim if XRange is None else self._XDim[XRange[0]:XRange[1]]
+        YDim=self._YDim if YRange is None else self._YDim[YRange[0]:YRange[1]]
+        ypp,xpp=np.meshgrid(YDim,XDim)
+        nPlane=xpp.size
+        u2=np.zeros((len(XDim),len(YDim),len(zIndexes)),np.complex64)
+        nPlanesPerChunk=int(np.max([1,self._RayleighChunkSize//nPlane]))
+        for n in range(0,len(zIndexes),nPlanesPerChunk):
+            SelZ=Src['ZDim'][zIndexes[n:n+nPlanesPerChunk]]
+            rf=np.zeros((nPlane*len(SelZ),3),np.float32)
+            rf[:,0]=np.tile(xpp.flatten(),len(SelZ))
+            rf[:,1]=np.tile(ypp.flatten(),len(SelZ))
+            rf[:,2]=np.repeat(SelZ,nPlane)
+            u2chunk=ForwardSimple(Src['cwvnb'],Src['center'],Src['ds'],Src['u0'],rf,deviceMetal=Src['deviceName'])
+            u2[:,:,n:n+len(SelZ)]=np.moveaxis(np.reshape(u2chunk,(len(SelZ),len(XDim),len(YDim))),0,2)
+        return u2
+
+    @property
+    def _u2RayleighField(self):
+        #full volume of the Rayleigh field, calculated only the first time it is requested
+        if self._u2RayleighFieldFull is None:
+            print('Calculating full Rayleigh field in water...')
+            self._u2RayleighFieldFull=self.CalculateRayleighPlanes(np.arange(self._N3))
+        return self._u2RayleighFieldFull
+
+    @_u2RayleighField.setter
+    def _u2RayleighField(self,value):
+        self._u2RayleighFieldFull=value
+        self._u2RayleighSubVolume=None
+
+    def ReturnRayleighFieldSubVolume(self):
+        '''
+        Return the Rayleigh field in water over the domain without PML and padding, with the layers up to the source plane set to zero.
+        The result is kept, so it can be calculated in advance in the thread owning the GPU device
+        '''
+        if self._u2RayleighSubVolume is not None:
+            return self._u2RayleighSubVolume
+        XRange=[self._XLOffset,self._N1-self._XROffset]
+        YRange=[self._YLOffset,self._N2-self._YROffset]
+        ZRange=[self._ZLOffset,self._N3-self._ZROffset]
+        if self._u2RayleighFieldFull is not None:
+            u2=self._u2RayleighFieldFull[XRange[0]:XRange[1],
+                                         YRange[0]:YRange[1],
+                                         ZRange[0]:ZRange[1]].copy()
+            u2[:,:,:np.max([0,self._ZSourceLocation+1-ZRange[0]])]=0.0
+        else:
+            u2=np.zeros((XRange[1]-XRange[0],YRange[1]-YRange[0],ZRange[1]-ZRange[0]),np.complex64)
+            zIndexes=np.arange(np.max([ZRange[0],self._ZSourceLocation+1]),ZRange[1])
+            if len(zIndexes)>0:
+                u2[:,:,zIndexes[0]-ZRange[0]:]=self.CalculateRayleighPlanes(zIndexes,XRange=XRange,YRange=YRange)
+        self._u2RayleighSubVolume=u2
+        return u2
            
     def ReturnArrayMaterial(self):
         return np.array(self._Materials)
 
+    def ReturnTimeVectorSource(self):
+        LengthSource=np.floor(self._TimeSimulation/(1.0/self._Frequency))*1/self._Frequency
+        return np.arange(0,LengthSource+self._TemporalStep,self._TemporalStep)
+
+    def ReturnRampSource(self,ramp_length=4):
+        #we do as in k-wave to create a ramped signal
+        ramp_length_points = int(np.round(ramp_length/self._Frequency/self._TemporalStep))
+        ramp_axis =np.arange(0,np.pi,np.pi/ramp_length_points)
+
+        # create ramp using a shifted cosine
+        ramp = (-np.cos(ramp_axis) + 1) * 0.5
+        return ramp.astype(np.float32)
+
+    def ReturnPulseSourceBlocks(self,SourceValues,TimeVectorSource,ramp_length=4,BlockSize=4096):
+        '''
+        Generator returning (first row, block of rows) of the ramped CW signals, one row per complex entry in SourceValues.
+        Amplitude and phase are recovered from each entry, A*sin(wt+phi) = Re(u0)*sin(wt) + Im(u0)*cos(wt)
+        '''
+        ramp=self.ReturnRampSource(ramp_length)
+        nRamp=np.min([len(ramp),len(TimeVectorSource)])
+        SinWt=np.sin(2*np.pi*self._Frequency*TimeVectorSource).astype(np.float32)
+        CosWt=np.cos(2*np.pi*self._Frequency*TimeVectorSource).astype(np.float32)
+        SinWt[:nRamp]*=ramp[:nRamp]
+        CosWt[:nRamp]*=ramp[:nRamp]
+        SourceValues=np.asarray(SourceValues).flatten()
+        for n in range(0,SourceValues.size,BlockSize):
+            u0=SourceValues[n:n+BlockSize]
+            Block=np.outer(u0.real.astype(np.float32),SinWt)
+            Block+=np.outer(u0.imag.astype(np.float32),CosWt)
+            yield n,Block
+
+    def BuildPulseSource(self,SourceValues,TimeVectorSource,ramp_length=4,BlockSize=4096):
+        '''
+        Return the float32 matrix (number of sources x time steps) of ramped CW signals, filled in blocks of BlockSize rows
+        '''
+        SourceValues=np.asarray(SourceValues).flatten()
+        PulseSource=np.zeros((SourceValues.size,TimeVectorSource.shape[0]),np.float32)
+        for n,Block in self.ReturnPulseSourceBlocks(SourceValues,TimeVectorSource,ramp_length=ramp_length,BlockSize=BlockSize):
+            PulseSource[n:n+Block.shape[0],:]=Block
+        return PulseSource
+
+    def ReturnSourcePlane(self):
+        #complex field at the source plane to be used to create the sources, Tx classes can overwrite if needed
+        return self._SourceMapRayleigh
+
     def CreateSources(self,ramp_length=4):
-        raise NotImplementedError("Need to implement this")
+        #we create the list of functions sources taken from the Rayliegh incident field
+        TimeVectorSource=self.ReturnTimeVectorSource()
+        SourcePlane=self.ReturnSourcePlane()
+
+        self._SourceMap=np.zeros((self._N1,self._N2,self._N3),np.uint32)
+        LocZ=self._ZSourceLocation
+
+        #sources are numbered following the same order as np.where
+        SourceMaskIND=np.where(np.abs(SourcePlane)>0)
+        SourceMask=np.zeros((self._N1,self._N2),np.uint32)
+        SourceMask[SourceMaskIND]=np.arange(1,len(SourceMaskIND[0])+1,dtype=np.uint32)
+        self._SourceMap[:,:,LocZ]=SourceMask
+
+        self._PulseSource=self.BuildPulseSource(SourcePlane[SourceMaskIND],TimeVectorSource,ramp_length=ramp_length)
+
+        if self._bDisplay:
+            plt.figure(figsize=(6,3))
+            for n in range(1,4):
+                plt.plot(TimeVectorSource*1e6,self._PulseSource[int(self._PulseSource.shape[0]/4)*n,:])
+                plt.title('CW signal, example %i' %(n))
+                
+            plt.xlim(0,50)
+                
+            plt.figure(figsize=(3,2))
+            plt.imshow(self._SourceMap[:,:,LocZ])
+            plt.title('source map - source ids')
  
     def CreateSensorMap(self):
         
@@ -1470,71 +1913,85 @@ elif self._bTightNarrowBeamDomain:
         freqs = np.fft.fftfreq(self._Sensor['time'].size, time_step)
         IndSpectrum=np.argmin(np.abs(freqs-self._Frequency)) # frequency entry closest to 500 kHz
         if bRefocused==False:
-            self._Sensor['Pressure']=np.ascontiguousarray(self._Sensor['Pressure'])
-            
             index=self._InputParam-1
-            nStep=100000
-            for n in range(0,self._Sensor['Pressure'].shape[0],nStep):
-                top=np.min([n+nStep,self._Sensor['Pressure'].shape[0]])
-                FSignal=fft.fft(self._Sensor['Pressure'][n:top,:],axis=1)
-                k=index[n:top]//(self._N1*self._N2)
-                j=index[n:top]%(self._N1*self._N2)
-                i=j%self._N1
-                j=j//self._N1
-                FSignal=FSignal[:,IndSpectrum]
-                pa= np.angle(FSignal)
-                pp=np.abs(FSignal)
-
-                self._PhaseMap[i,j,k]=pa
-                self._PressMapFourier[i,j,k]=FSignal
-                self._PressMapPeak[i,j,k]=self._Sensor['Pressure'][n:top,:].max(axis=1)
+            i,j,k=self.ReturnSensorIJK(index)
+            FSignal,Peak=self.SingleFrequencyProjection(self._Sensor['Pressure'],IndSpectrum)
+            self._PhaseMap[i,j,k]=np.angle(FSignal)
+            self._PressMapFourier[i,j,k]=FSignal
+            self._PressMapPeak[i,j,k]=Peak
             self._InPeakValue=self._DictPeakValue['Pressure']
             self._PressMapFourier*=2/self._Sensor['time'].size
             print('Elapsed time doing phase and amp extraction from Fourier (s)',time.time()-t0)
             
             if bDoRefocusing:
-                self._SensorBack['Pressure']=np.ascontiguousarray(self._SensorBack['Pressure'])
                 index=self._InputParamBack-1
-                for n in range(0,self._SensorBack['Pressure'].shape[0],nStep):
-                    top=np.min([n+nStep,self._SensorBack['Pressure'].shape[0]])
-                    FSignal=fft.fft(self._SensorBack['Pressure'][n:top,:],axis=1)
-                    k=index[n:top]//(self._N1*self._N2)
-                    j=index[n:top]%(self._N1*self._N2)
-                    i=j%self._N1
-                    j=j//self._N1
-                    FSignal=FSignal[:,IndSpectrum]
-                    assert(np.all(k==self._PMLThickness))
-                    self._PressMapFourierBack[i,j]=FSignal
+                i,j,k=self.ReturnSensorIJK(index)
+                assert(np.all(k==self._PMLThickness))
+                FSignal,_=self.SingleFrequencyProjection(self._SensorBack['Pressure'],IndSpectrum,bPeak=False)
+                self._PressMapFourierBack[i,j]=FSignal
                     
         else:
-            self._SensorRefocus['Pressure']=np.ascontiguousarray(self._SensorRefocus['Pressure'])
             index=self._InputParamRefocus-1
-            nStep=100000
-            for n in range(0,self._SensorRefocus['Pressure'].shape[0],nStep):
-                top=np.min([n+nStep,self._SensorRefocus['Pressure'].shape[0]])
-                FSignal=fft.fft(self._SensorRefocus['Pressure'][n:top,:],axis=1)
-                k=index[n:top]//(self._N1*self._N2)
-                j=index[n:top]%(self._N1*self._N2)
-                i=j%self._N1
-                j=j//self._N1
-                FSignal=FSignal[:,IndSpectrum]
-                pa= np.angle(FSignal)
-                pp=np.abs(FSignal)
-
-                self._PhaseMapRefocus[i,j,k]=pa
-                self._PressMapFourierRefocus[i,j,k]=FSignal
-                self._PressMapPeakRefocus[i,j,k]=self._SensorRefocus['Pressure'][n:top,:].max(axis=1)
+            i,j,k=self.ReturnSensorIJK(index)
+            FSignal,Peak=self.SingleFrequencyProjection(self._SensorRefocus['Pressure'],IndSpectrum)
+            self._PhaseMapRefocus[i,j,k]=np.angle(FSignal)
+            self._PressMapFourierRefocus[i,j,k]=FSignal
+            self._PressMapPeakRefocus[i,j,k]=Peak
             self._InPeakValueRefocus=self._DictPeakValueRefocus['Pressure']
             self._PressMapFourierRefocus*=2/self._SensorRefocus['time'].size
             print('Elapsed time doing phase and amp extraction from Fourier (s)',time.time()-t0)
-            
-        
+
+    def ReturnSensorIJK(self,index):
+        #sensor entries are stored in Fortran order
+        k=index//(self._N1*self._N2)
+        j=index%(self._N1*self._N2)
+        i=j%self._N1
+        j=j//self._N1
+        return i,j,k
+
+    def SingleFrequencyProjection(self,Pressure,IndSpectrum,bPeak=True,nStep=20000,nThreads=None):
+        '''
+        Return the DFT entry IndSpectrum (same as fft(Pressure,axis=1)[:,IndSpectrum]) and optionally the peak value of each sensor trace.
+        The projection is done with a precomputed [cos,-sin] kernel, in blocks of nStep rows processed in parallel threads,
+        so the full spectrum is never calculated. Cost is O(N*T) instead of O(N*T*log(T))
+        '''
+        Pressure=np.ascontiguousarray(Pressure)
+        nT=Pressure.shape[1]
+        KernelDtype = np.float32 if Pressure.dtype==np.float32 else np.float64
+        #phase is wrapped in integer arithmetic to keep precision for long traces
+        ang=2*np.pi*((IndSpectrum*np.arange(nT,dtype=np.int64))%nT)/nT
+        Kernel=np.ascontiguousarray(np.vstack((np.cos(ang),-np.sin(ang))).T.astype(KernelDtype))
+        FSignal=np.zeros(Pressure.shape[0],np.complex64)
+        Peak=np.zeros(Pressure.shape[0],np.float32) if bPeak else None
+
+        def ProcessBlock(n):
+            top=np.min([n+nStep,Pressure.shape[0]])
+            Block=Pressure[n:top,:]
+            Proj=Block@Kernel
+            FSignal[n:top]=Proj[:,0]+1j*Proj[:,1]
+            if bPeak:
+                Peak[n:top]=Block.max(axis=1)
+
+        if nThreads is None:
+            nThreads=np.min([os.cpu_count() or 1,8])
+        Blocks=range(0,Pressure.shape[0],nStep)
+        if nThreads<=1 or len(Blocks)<=1:
+            for n in Blocks:
+                ProcessBlock(n)
+        else:
+            with ThreadPoolExecutor(max_workers=nThreads) as executor:
+                list(executor.map(ProcessBlock,Blocks))
+        return FSignal,Peak
             
     def BackPropagationRayleigh(self,deviceName='6800'):
         raise NotImplementedError("Need to implement this") 
         
     def CreateSourcesRefocus(self,ramp_length=4):
-        raise NotImplementedError("Need to implement this")
+        #we create the list of functions sources taken from the refocused Rayliegh incident field, using the same source ids as in CreateSources
+        TimeVectorSource=self.ReturnTimeVectorSource()
+        SourceMaskIND=np.where(np.abs(self.ReturnSourcePlane())>0)
+        self._PulseSourceRefocus=self.BuildPulseSource(self._SourceMapRayleighRefocus[SourceMaskIND],
+                                                       TimeVectorSource,ramp_length=ramp_length)
         
     def PlotResultsPlanePartial(self):
   
@@ -1635,7 +2092,8 @@ elif self._bTightNarrowBeamDomain:
                      [0,np.max(LineInPeak)],':')
             ax.xaxis.set_major_locator(ticker.MultipleLocator(5))
         
-    def ReturnResults(self,bDoRefocusing=True,bUseRayleighForWater=False):
+    def ReturnMaskRegion(self):
+        #region of the mask covered by the domain without PML and padding
         if self._XShrink_R==0:
             upperXR=self._SkullMaskDataOrig.shape[0]
         else:
@@ -1648,111 +2106,92 @@ elif self._bTightNarrowBeamDomain:
             upperZR=self._SkullMaskDataOrig.shape[2]
         else:
             upperZR=-self._ZShrink_R
+        return (slice(self._XShrink_L,upperXR),slice(self._YShrink_L,upperYR),slice(self._ZShrink_L,upperZR))
 
-        self._u2RayleighField[:,:,:self._ZSourceLocation+1]=0.0
-        
-        #we return the region not including the PML and padding
-        RayleighWater=np.zeros(self._SkullMaskDataOrig.shape,np.complex64)
-        RayleighWater[self._XShrink_L:upperXR,
-                      self._YShrink_L:upperYR,
-                      self._ZShrink_L:upperZR]=\
-                      self._u2RayleighField[self._XLOffset:-self._XROffset,
-                                   self._YLOffset:-self._YROffset,
-                                   self._ZLOffset:-self._ZROffset]
-        
-        RayleighWater=np.flip(RayleighWater,axis=2)
-        RayleighWaterPhase=np.angle(RayleighWater)
-        RayleighWater=np.abs(RayleighWater)
-        
-        #this one creates an overlay of skull and brain tissue that helps to show it Slicer or other visualization tools
-        MaskSkull=np.flip(self._SkullMaskDataOrig.astype(np.float32),axis=2)
-        MaskCalcRegions=np.zeros(MaskSkull.shape,bool)
-        RayleighWaterOverlay=RayleighWater+MaskSkull*RayleighWater.max()/10
-        
-        
+    def ReturnDomainRegion(self):
+        #region of the domain without PML and padding
+        return (slice(self._XLOffset,-self._XROffset),slice(self._YLOffset,-self._YROffset),slice(self._ZLOffset,-self._ZROffset))
+
+    def ReturnCalcRegionBounds(self):
+        '''
+        Return the first and last indexes in X, Y and Z of the calculated region in the mask space, in the flipped orientation used for the results
+        '''
+        Shape=self._SkullMaskDataOrig.shape
+        mx=[self._XShrink_L,Shape[0]-self._XShrink_R-1]
+        my=[self._YShrink_L,Shape[1]-self._YShrink_R-1]
+        mz=[self._ZShrink_R,Shape[2]-self._ZShrink_L-1]
+        return mx,my,mz
+
+    def PrepareResults(self,bDoRefocusing=True):
+        #layers above the source plane are not part of the solution
         self._InPeakValue[:,:,:self._ZSourceLocation+1]=0.0
         self._PhaseMap[:,:,:self._ZSourceLocation+1]=0.0
         self._PressMapFourier[:,:,:self._ZSourceLocation+1]=0.0
-        
-        
-        FullSolutionPressure=np.zeros(self._SkullMaskDataOrig.shape,np.float32)
-        FullSolutionPressure[self._XShrink_L:upperXR,
-                      self._YShrink_L:upperYR,
-                      self._ZShrink_L:upperZR]=\
-                      self._InPeakValue[self._XLOffset:-self._XROffset,
-                                   self._YLOffset:-self._YROffset,
-                                   self._ZLOffset:-self._ZROffset]
-        FullSolutionPressure=np.flip(FullSolutionPressure,axis=2)
-
-        FullSolutionPhase=np.zeros(self._SkullMaskDataOrig.shape,np.float32)
-        FullSolutionPhase[self._XShrink_L:upperXR,
-                      self._YShrink_L:upperYR,
-                      self._ZShrink_L:upperZR]=\
-                      self._PhaseMap[self._XLOffset:-self._XROffset,
-                                   self._YLOffset:-self._YROffset,
-                                   self._ZLOffset:-self._ZROffset]
-        FullSolutionPhase=np.flip(FullSolutionPhase,axis=2)
-
-
-        MaskCalcRegions[self._XShrink_L:upperXR, self._YShrink_L:upperYR,self._ZShrink_L:upperZR ]=True
-        MaskCalcRegions=np.flip(MaskCalcRegions,axis=2)
-        FullSolutionPressureRefocus=np.zeros(self._SkullMaskDataOrig.shape,np.float32)
-        FullSolutionPhaseRefocus=np.zeros(self._SkullMaskDataOrig.shape,np.float32)
-        
         if bDoRefocusing:
             self._InPeakValueRefocus[:,:,:self._ZSourceLocation+1]=0.0
             self._PhaseMapRefocus[:,:,:self._ZSourceLocation+1]=0.0
             self._PressMapFourierRefocus[:,:,:self._ZSourceLocation+1]=0.0
-            FullSolutionPressureRefocus[self._XShrink_L:upperXR,
-                          self._YShrink_L:upperYR,
-                          self._ZShrink_L:upperZR]=\
-                          self._InPeakValueRefocus[self._XLOffset:-self._XROffset,
-                                       self._YLOffset:-self._YROffset,
-                                       self._ZLOffset:-self._ZROffset]
-            FullSolutionPressureRefocus=np.flip(FullSolutionPressureRefocus,axis=2)
-            FullSolutionPhaseRefocus[self._XShrink_L:upperXR,
-                          self._YShrink_L:upperYR,
-                          self._ZShrink_L:upperZR]=\
-                          self._PhaseMapRefocus[self._XLOffset:-self._XROffset,
-                                       self._YLOffset:-self._YROffset,
-                                       self._ZLOffset:-self._ZROffset]
-            FullSolutionPhaseRefocus=np.flip(FullSolutionPhaseRefocus,axis=2)
-        
+
+    def ReturnResultVolume(self,Name):
+        '''
+        Return (flipped in Z) a single result volume with the shape of the input mask. Valid names are
+        RayleighWater, RayleighWaterPhase, RayleighWaterOverlay, FullSolutionPressure, FullSolutionPhase,
+        FullSolutionPressureRefocus and FullSolutionPhaseRefocus.
+        Volumes are created one at a time so the caller can save and release each before requesting the next
+        '''
+        DomainRegion=self.ReturnDomainRegion()
+        if Name in ['RayleighWater','RayleighWaterOverlay']:
+            Sub=np.abs(self.ReturnRayleighFieldSubVolume())
+        elif Name=='RayleighWaterPhase':
+            Sub=np.angle(self.ReturnRayleighFieldSubVolume())
+        elif Name=='FullSolutionPressure':
+            Sub=self._InPeakValue[DomainRegion]
+        elif Name=='FullSolutionPhase':
+            Sub=self._PhaseMap[DomainRegion]
+        elif Name=='FullSolutionPressureRefocus':
+            Sub=self._InPeakValueRefocus[DomainRegion]
+        elif Name=='FullSolutionPhaseRefocus':
+            Sub=self._PhaseMapRefocus[DomainRegion]
+        else:
+            raise ValueError('Unknown result volume ' + Name)
+        Volume=np.zeros(self._SkullMaskDataOrig.shape,np.float32)
+        Volume[self.ReturnMaskRegion()]=Sub
+        del Sub
+        if Name=='RayleighWaterOverlay':
+            #this one creates an overlay of skull and brain tissue that helps to show it Slicer or other visualization tools
+            Scale=Volume.max()/10
+            for k in range(Volume.shape[2]):
+                Volume[:,:,k]+=self._SkullMaskDataOrig[:,:,k]*Scale
+        return np.flip(Volume,axis=2)
+
+    def ReturnDataForSim(self,bDoRefocusing=True,bUseRayleighForWater=False):
+        '''
+        Return the dictionary of results to be saved in the h5 file, entries are views of the simulation maps (flipped in Z)
+        '''
+        DomainRegion=self.ReturnDomainRegion()
         DataForSim ={}
-        DataForSim['p_amp']=self._InPeakValue[self._XLOffset:-self._XROffset,
-                                   self._YLOffset:-self._YROffset,
-                                   self._ZLOffset:-self._ZROffset].copy()
-        DataForSim['p_complex']=self._PressMapFourier[self._XLOffset:-self._XROffset,
-                                   self._YLOffset:-self._YROffset,
-                                   self._ZLOffset:-self._ZROffset].copy()
+        DataForSim['p_amp']=self._InPeakValue[DomainRegion]
+        DataForSim['p_complex']=self._PressMapFourier[DomainRegion]
         
         if bDoRefocusing:
-            DataForSim['p_amp_refocus']=self._InPeakValueRefocus[self._XLOffset:-self._XROffset,
-                                       self._YLOffset:-self._YROffset,
-                                       self._ZLOffset:-self._ZROffset].copy()
-            DataForSim['p_complex_refocus']=self._PressMapFourierRefocus[self._XLOffset:-self._XROffset,
-                                       self._YLOffset:-self._YROffset,
-                                       self._ZLOffset:-self._ZROffset].copy()
+            DataForSim['p_amp_refocus']=self._InPeakValueRefocus[DomainRegion]
+            DataForSim['p_complex_refocus']=self._PressMapFourierRefocus[DomainRegion]
         if self._DensityCTMap is not None:
-            MaterialMap=self._MaterialMapNoCT.copy()
-            DataForSim['MaterialMapCT']=self._MaterialMap[self._XLOffset:-self._XROffset,
-                                   self._YLOffset:-self._YROffset,
-                                   self._ZLOffset:-self._ZROffset].copy()
+            MaterialMap=self._MaterialMapNoCT
+            DataForSim['MaterialMapCT']=self._MaterialMap[DomainRegion]
         else:
-            MaterialMap=self._MaterialMap.copy()
-        MaterialMap[self._FocalSpotLocation[0],self._FocalSpotLocation[1],self._FocalSpotLocation[2]]=5.0
-        
-        DataForSim['MaterialMap']=MaterialMap[self._XLOffset:-self._XROffset,
-                                   self._YLOffset:-self._YROffset,
-                                   self._ZLOffset:-self._ZROffset].copy()
+            MaterialMap=self._MaterialMap
+        #only the sub volume is copied as the target location is marked in it
+        DataForSim['MaterialMap']=MaterialMap[DomainRegion].copy()
+        DataForSim['MaterialMap'][self._FocalSpotLocation[0]-self._XLOffset,
+                                  self._FocalSpotLocation[1]-self._YLOffset,
+                                  self._FocalSpotLocation[2]-self._ZLOffset]=5
         
-        TargetLocation=np.array(np.where(DataForSim['MaterialMap']==5.0)).flatten()
-        DataForSim['MaterialMap'][DataForSim['MaterialMap']==5.0]=4.0 #we switch it back to soft tissue
+        TargetLocation=np.array(np.where(DataForSim['MaterialMap']==5)).flatten()
+        DataForSim['MaterialMap'][DataForSim['MaterialMap']==5]=4 #we switch it back to soft tissue
         
         if bUseRayleighForWater:
-            DataForSim['p_complex_water']=self._u2RayleighField[self._XLOffset:-self._XROffset,
-                                   self._YLOffset:-self._YROffset,
-                                   self._ZLOffset:-self._ZROffset]
+            DataForSim['p_complex_water']=self.ReturnRayleighFieldSubVolume()
             DataForSim['p_amp_water']=np.abs(DataForSim['p_complex_water'])
         for k in DataForSim:
             DataForSim[k]=np.flip(DataForSim[k],axis=2)
@@ -1763,17 +2202,6 @@ elif self._bTightNarrowBeamDomain:
         DataForSim['SpatialStep']=self._SpatialStep
         DataForSim['TargetLocation']=TargetLocation
         DataForSim['zLengthBeyonFocalPoint']=self._zLengthBeyonFocalPointWhenNarrow
-        
-        
-        assert(np.all(np.array(RayleighWaterOverlay.shape)==np.array(FullSolutionPressure.shape)))
-        return  RayleighWater,\
-                RayleighWaterOverlay,\
-                FullSolutionPressure,\
-                FullSolutionPressureRefocus,\
-                DataForSim,\
-                MaskCalcRegions,\
-                FullSolutionPhase,\
-                FullSolutionPhaseRefocus,\
-                RayleighWaterPhase
+        return DataForSim
                 
         
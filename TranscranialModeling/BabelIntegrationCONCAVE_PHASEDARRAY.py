@@ -21,6 +21,7 @@ import matplotlib.pyplot as plt
 from BabelViscoFDTD.tools.RayleighAndBHTE import ForwardSimple
 from .H317 import GenerateH317Tx
 import nibabel
+import copy
 from multiprocessing import Process,Queue
     
 def CreateCircularCoverage(DiameterFocalBeam=1.5e-3,DiameterCoverage=10e-3):
@@ -61,6 +62,9 @@ def CreateSpreadFocus(DiameterFocalBeam=1.5e-3):
 
 
 class RUN_SIM(RUN_SIM_BASE):
+    #points of a MultiPoint pattern share mask, domain, material map and Tx geometry
+    CaseContextSharedSettings=('_XSteering','_YSteering')
+
     def CreateSimObject(self,**kargs):
         return BabelFTD_Simulations(XSteering=self._XSteering,
                                     YSteering=self._YSteering,
@@ -95,18 +99,18 @@ class RUN_SIM(RUN_SIM_BASE):
             for entry in MultiPoint:
                 ExtraAdjustX.append(entry['X']+XSteering)
                 ExtraAdjustY.append(entry['Y']+YSteering)
-            fnames=[]
+            #all points run in a single call, so they share the case setup and the CPU stages of a point
+            #overlap with the simulations of other points when nCaseWorkers>0
+            CaseVariants=[]
             for entry in MultiPoint:
-                newextrasufffix="_Steer_X_%2.1f_Y_%2.1f_Z_%2.1f_" % (entry['X']*1e3,entry['Y']*1e3,entry['Z']*1e3)
-                self._XSteering=entry['X']+XSteering
-                self._YSteering=entry['Y']+YSteering
-                self._ZSteering=entry['Z']+ZSteering
-                fnames+=super().RunCases(extrasuffix=newextrasufffix,
-                                         ExtraAdjustX=ExtraAdjustX,
-                                         ExtraAdjustY=ExtraAdjustY,
-                                         **kargs)     
-            
-        return fnames
+                CaseVariants.append({'extrasuffix':"_Steer_X_%2.1f_Y_%2.1f_Z_%2.1f_" % (entry['X']*1e3,entry['Y']*1e3,entry['Z']*1e3),
+                                     'TxSettings':{'_XSteering':entry['X']+XSteering,
+                                                   '_YSteering':entry['Y']+YSteering,
+                                                   '_ZSteering':entry['Z']+ZSteering}})
+            return super().RunCases(CaseVariants=CaseVariants,
+                                    ExtraAdjustX=ExtraAdjustX,
+                                    ExtraAdjustY=ExtraAdjustY,
+                                    **kargs)
 
 ##########################################
 
@@ -197,6 +201,19 @@ class BabelFTD_Simulations(BabelFTD_Simulations_BASE):
         Cone.export(bdir+os.sep+prefix+'_Cone.stl')
         
 
+    def ReturnRayleighForwardContextKey(self):
+        #the phases of the elements depend on the steering
+        return ('RayleighForward',self._XSteering,self._YSteering,self._ZSteering)
+
+    def Step2_CalculateRayleighFieldsForward(self,**kargs):
+        if self._CaseContext is not None and 'TxGeometry' in self._CaseContext and self._SIM_SETTINGS._bDomainFromContext:
+            #the elements are already positioned for this mask and domain, only the phases are calculated
+            self._SIM_SETTINGS.__dict__.update(copy.deepcopy(self._CaseContext['TxGeometry']))
+        super().Step2_CalculateRayleighFieldsForward(**kargs)
+        if self._CaseContext is not None and 'TxGeometry' not in self._CaseContext:
+            self._CaseContext['TxGeometry']=copy.deepcopy({'_Tx':self._SIM_SETTINGS._Tx,
+                                                           '_TxOrig':self._SIM_SETTINGS._TxOrig})
+
     def AddSaveDataSim(self,DataForSim):
         DataForSim['XSteering']=self._XSteering
         DataForSim['YSteering']=self._YSteering
@@ -211,6 +228,7 @@ class SimulationConditions(SimulationConditionsBASE):
     '''
     Class implementing the low level interface to prepare the details of the simulation conditions and execute the simulation
     '''
+    RayleighForwardAttributes=SimulationConditionsBASE.RayleighForwardAttributes+('_SourceMapRayleigh','BasePhasedArrayProgramming','BasePhasedArrayProgrammingRefocusing')
     def __init__(self,FactorEnlarge = 1.0, #putting a Tx with same F# but just bigger helps to create a more coherent input field for FDTD
                       Aperture=0.16, # m, aperture of the Tx, used tof calculated cross section area entering the domain
                       FocalLength=135e-3,
@@ -231,13 +249,13 @@ class SimulationConditions(SimulationConditionsBASE):
         self._ZSteering=ZSteering
         self._DistanceConeToFocus=DistanceConeToFocus
         self._RotationZ=RotationZ
+        self._Tx=None
 
     def GenTransducerGeom(self):
         self._Tx=GenerateH317Tx(Frequency=self._Frequency,RotationZ=self._RotationZ,FactorEnlarge=self._FactorEnlarge)
         self._TxOrig=GenerateH317Tx(Frequency=self._Frequency,RotationZ=self._RotationZ)
         
-    def CalculateRayleighFieldsForward(self,deviceName='6800'):
-        print("Precalculating Rayleigh-based field as input for FDTD...")
+    def PositionTransducer(self):
         #first we generate the high res source of the tx elements
         self.GenTransducerGeom()
         #We replicate as in the GUI as need to account for water pixels there in calculations where to truly put the Tx
@@ -282,6 +300,13 @@ class SimulationConditions(SimulationConditionsBASE):
             print("np.max(self._Tx['center'][:,2]),self._ZDim[self._ZSourceLocation]",np.max(self._Tx['center'][:,2]),self._ZDim[self._ZSourceLocation])
             raise RuntimeError("The Tx limit in Z is below the location of the layer for source location for forward propagation.")
       
+
+    def CalculateRayleighFieldsForward(self,deviceName='6800'):
+        print("Precalculating Rayleigh-based field as input for FDTD...")
+        if self._Tx is None:
+            self.PositionTransducer()
+        else:
+            print('Using Tx geometry from case context')
         #we apply an homogeneous pressure 
        
         
@@ -316,18 +341,13 @@ class SimulationConditions(SimulationConditionsBASE):
                 nBase+=self._Tx['elemdims']
         else:
              u0=(np.ones((self._Tx['center'].shape[0],1),np.float32)+ 1j*np.zeros((self._Tx['center'].shape[0],1),np.float32))*self._SourceAmpPa
-        nxf=len(self._XDim)
-        nyf=len(self._YDim)
-        nzf=len(self._ZDim)
-        yp,xp,zp=np.meshgrid(self._YDim,self._XDim,self._ZDim)
-        
-        rf=np.hstack((np.reshape(xp,(nxf*nyf*nzf,1)),np.reshape(yp,(nxf*nyf*nzf,1)), np.reshape(zp,(nxf*nyf*nzf,1)))).astype(np.float32)
-        
-        u2=ForwardSimple(cwvnb_extlay,self._Tx['center'].astype(np.float32),self._Tx['ds'].astype(np.float32),u0,rf,deviceMetal=deviceName)
-        u2=np.reshape(u2,xp.shape)
-        
-        self._u2RayleighField=u2
-        self._SourceMapRayleigh=u2[:,:,self._ZSourceLocation].copy()
+        self.SetRayleighSource(cwvnb_extlay,self._Tx['center'],self._Tx['ds'],u0,deviceName=deviceName)
+        if self._bRayleighSourcePlaneOnly:
+            #FDTD only needs the source plane, the full field is calculated on demand when saving results
+            u2Plane=self.CalculateRayleighPlanes(self._ZSourceLocation)[:,:,0]
+        else:
+            u2Plane=self._u2RayleighField[:,:,self._ZSourceLocation]
+        self._SourceMapRayleigh=u2Plane.copy()
         self._SourceMapRayleigh[:self._PMLThickness,:]=0
         self._SourceMapRayleigh[-self._PMLThickness:,:]=0
         self._SourceMapRayleigh[:,:self._PMLThickness]=0
@@ -343,9 +363,9 @@ class SimulationConditions(SimulationConditionsBASE):
 
             plt.subplot(1,2,2)
         
-            plt.imshow((np.abs(u2[self._FocalSpotLocation[0],:,:]).T+
+            plt.imshow((np.abs(self._u2RayleighField[self._FocalSpotLocation[0],:,:]).T+
                                     ((self._MaterialMap[self._FocalSpotLocation[0],:,:].T>=3).astype(float))*
-                                    np.abs(u2[self._FocalSpotLocation[0],:,:]).max()/10)/1e6,
+                                    np.abs(self._u2RayleighField[self._FocalSpotLocation[0],:,:]).max()/10)/1e6,
                                     extent=[self._YDim.min(),self._YDim.max(),self._ZDim.max(),self._ZDim.min()],
                                     cmap=plt.cm.jet)
             plt.colorbar()
@@ -354,40 +374,9 @@ class SimulationConditions(SimulationConditionsBASE):
           
         
     def CreateSources(self,ramp_length=4):
-        #we create the list of functions sources taken from the Rayliegh incident field
-        LengthSource=np.floor(self._TimeSimulation/(1.0/self._Frequency))*1/self._Frequency
-        TimeVectorSource=np.arange(0,LengthSource+self._TemporalStep,self._TemporalStep)
-        #we do as in k-wave to create a ramped signal
-        
-        ramp_length_points = int(np.round(ramp_length/self._Frequency/self._TemporalStep))
-        ramp_axis =np.arange(0,np.pi,np.pi/ramp_length_points)
+        super().CreateSources(ramp_length=ramp_length)
+        TimeVectorSource=self.ReturnTimeVectorSource()
 
-        # create ramp using a shifted cosine
-        ramp = (-np.cos(ramp_axis) + 1) * 0.5
-        ramp_length_points=len(ramp)
-        
-        self._SourceMap=np.zeros((self._N1,self._N2,self._N3),np.uint32)
-        LocZ=self._ZSourceLocation
-        
-        SourceMaskIND=np.where(np.abs(self._SourceMapRayleigh)>0)
-        SourceMask=np.zeros((self._N1,self._N2),np.uint32)
-        
-        RefI= int((SourceMaskIND[0].max()-SourceMaskIND[0].min())/2)+SourceMaskIND[0].min()
-        RefJ= int((SourceMaskIND[1].max()-SourceMaskIND[1].min())/2)+SourceMaskIND[1].min()
-        AngRef=np.angle(self._SourceMapRayleigh[RefI,RefJ])
-        PulseSource = np.zeros((np.sum(np.abs(self._SourceMapRayleigh)>0),TimeVectorSource.shape[0]))
-        nSource=1                       
-        for i,j in zip(SourceMaskIND[0],SourceMaskIND[1]):
-            SourceMask[i,j]=nSource
-            u0=self._SourceMapRayleigh[i,j]
-            #we recover amplitude and phase from Rayleigh field
-            PulseSource[nSource-1,:] = np.abs(u0) *np.sin(2*np.pi*self._Frequency*TimeVectorSource+np.angle(u0))
-            PulseSource[nSource-1,:int(ramp_length_points)]*=ramp
-            nSource+=1
-        self._SourceMap[:,:,LocZ]=SourceMask 
-            
-        self._PulseSource=PulseSource
-        
         ## Now we create the sources for back propagation
         
         self._PunctualSource=np.sin(2*np.pi*self._Frequency*TimeVectorSource).reshape(1,len(TimeVectorSource))
@@ -397,20 +386,6 @@ class SimulationConditions(SimulationConditionsBASE):
         LocForRefocusing[1]+=int(np.round(self._YSteering/self._SpatialStep))
         LocForRefocusing[2]+=int(np.round(self._ZSteering/self._SpatialStep))
         self._SourceMapPunctual[LocForRefocusing[0],LocForRefocusing[1],LocForRefocusing[2]]=1
-        
-
-        if self._bDisplay:
-            plt.figure(figsize=(12,4))
-            for n in range(1,4):
-                plt.plot(TimeVectorSource*1e6,PulseSource[int(PulseSource.shape[0]/4)*n,:])
-                plt.title('CW signal, example %i' %(n))
-                
-            plt.xlim(0,50)
-                
-            plt.figure(figsize=(5,4))
-            plt.imshow(self._SourceMap[:,:,LocZ])
-            plt.title('source map - source ids')
-
 
     def BackPropagationRayleigh(self,deviceName='6800'):
         assert(np.all(np.array(self._SourceMapRayleigh.shape)==np.array(self._PressMapFourierBack.shape)))
@@ -442,53 +417,11 @@ class SimulationConditions(SimulationConditionsBASE):
             u0[nBase:nBase+self._Tx['elemdims']]=(self._SourceAmpPa*np.exp(1j*phi)).astype(np.complex64)
             nBase+=self._Tx['elemdims']
 
-        nxf=len(self._XDim)
-        nyf=len(self._YDim)
-        nzf=len(self._ZDim)
-        yp,xp,zp=np.meshgrid(self._YDim,self._XDim,self._ZDim)
-        
-        rf=np.hstack((np.reshape(xp,(nxf*nyf*nzf,1)),np.reshape(yp,(nxf*nyf*nzf,1)), np.reshape(zp,(nxf*nyf*nzf,1)))).astype(np.float32)
-        
-        u2=ForwardSimple(cwvnb_extlay,self._Tx['center'].astype(np.float32),self._Tx['ds'].astype(np.float32),u0,rf,deviceMetal=deviceName)
-        u2=np.reshape(u2,xp.shape)
-        self._SourceMapRayleighRefocus=u2[:,:,self._ZSourceLocation].copy()
+        #only the source plane is needed for the refocusing FDTD run
+        RefocusSource=self.ReturnRayleighSource(cwvnb_extlay,self._Tx['center'],self._Tx['ds'],u0,deviceName=deviceName)
+        u2Plane=self.CalculateRayleighPlanes(self._ZSourceLocation,RayleighSource=RefocusSource)[:,:,0]
+        self._SourceMapRayleighRefocus=u2Plane.copy()
         self._SourceMapRayleighRefocus[:self._PMLThickness,:]=0
         self._SourceMapRayleighRefocus[-self._PMLThickness:,:]=0
         self._SourceMapRayleighRefocus[:,:self._PMLThickness]=0
         self._SourceMapRayleighRefocus[:,-self._PMLThickness:]=0
-        
-        
-    def CreateSourcesRefocus(self,ramp_length=4):
-        #we create the list of functions sources taken from the Rayliegh incident field
-        LengthSource=np.floor(self._TimeSimulation/(1.0/self._Frequency))*1/self._Frequency
-        TimeVectorSource=np.arange(0,LengthSource+self._TemporalStep,self._TemporalStep)
-        #we do as in k-wave to create a ramped signal
-        
-        ramp_length_points = int(np.round(ramp_length/self._Frequency/self._TemporalStep))
-        ramp_axis =np.arange(0,np.pi,np.pi/ramp_length_points)
-
-        # create ramp using a shifted cosine
-        ramp = (-np.cos(ramp_axis) + 1) * 0.5
-        ramp_length_points=len(ramp)
-        
-        LocZ=self._ZSourceLocation
-        
-        SourceMaskIND=np.where(np.abs(self._SourceMapRayleigh)>0)
-           
-        RefI= int((SourceMaskIND[0].max()-SourceMaskIND[0].min())/2)+SourceMaskIND[0].min()
-        RefJ= int((SourceMaskIND[1].max()-SourceMaskIND[1].min())/2)+SourceMaskIND[1].min()
-        AngRef=np.angle(self._SourceMapRayleighRefocus[RefI,RefJ])
-        PulseSource = np.zeros((np.sum(np.abs(self._SourceMapRayleighRefocus)>0),TimeVectorSource.shape[0]))
-        nSource=1                       
-        for i,j in zip(SourceMaskIND[0],SourceMaskIND[1]):
-            u0=self._SourceMapRayleighRefocus[i,j]
-            #we recover amplitude and phase from Rayleigh field
-            PulseSource[nSource-1,:] = np.abs(u0) *np.sin(2*np.pi*self._Frequency*TimeVectorSource+np.angle(u0))
-            PulseSource[nSource-1,:int(ramp_length_points)]*=ramp
-            nSource+=1
-            
-        self._PulseSourceRefocus=PulseSource
-         
-        
-                
-        
@@ -243,6 +243,7 @@ class SimulationConditions(SimulationConditionsBASE):
     '''
     Class implementing the low level interface to prepare the details of the simulation conditions and execute the simulation
     '''
+    RayleighForwardAttributes=SimulationConditionsBASE.RayleighForwardAttributes+('_SourceMapRayleigh','_TxRC','_TxRCOrig','BasePhasedArrayProgramming')
     def __init__(self,FactorEnlarge = 1.0, #putting a Tx with same F# but just bigger helps to create a more coherent input field for FDTD
                       Aperture=64e-3, # m, aperture of the Tx, used to calculated cross section area entering the domain
                       FocalLength=63.2e-3,
@@ -387,19 +388,14 @@ class SimulationConditions(SimulationConditionsBASE):
             u0[nBase:nBase+self._TxRC['elemdims'][n][0]]=(self._SourceAmpPa*np.exp(1j*AllPhi[n])).astype(np.complex64)
             nBase+=self._TxRC['elemdims'][n][0]
         
-        nxf=len(self._XDim)
-        nyf=len(self._YDim)
-        nzf=len(self._ZDim)
-        yp,xp,zp=np.meshgrid(self._YDim,self._XDim,self._ZDim)
-        
-        rf=np.hstack((np.reshape(xp,(nxf*nyf*nzf,1)),np.reshape(yp,(nxf*nyf*nzf,1)), np.reshape(zp,(nxf*nyf*nzf,1)))).astype(np.float32)
-        
-        u2=ForwardSimple(cwvnb_extlay,self._TxRC['center'].astype(np.float32),self._TxRC['ds'].astype(np.float32),u0,rf,deviceMetal=deviceName)
-        u2=np.reshape(u2,xp.shape)
-        
-        self._u2RayleighField=u2
+        self.SetRayleighSource(cwvnb_extlay,self._TxRC['center'],self._TxRC['ds'],u0,deviceName=deviceName)
+        if self._bRayleighSourcePlaneOnly:
+            #FDTD only needs the source plane, the full field is calculated on demand when saving results
+            u2Plane=self.CalculateRayleighPlanes(self._ZSourceLocation)[:,:,0]
+        else:
+            u2Plane=self._u2RayleighField[:,:,self._ZSourceLocation]
         
-        self._SourceMapRayleigh=u2[:,:,self._ZSourceLocation].copy()
+        self._SourceMapRayleigh=u2Plane.copy()
         self._SourceMapRayleigh[:self._PMLThickness,:]=0
         self._SourceMapRayleigh[-self._PMLThickness:,:]=0
         self._SourceMapRayleigh[:,:self._PMLThickness]=0
@@ -415,58 +411,10 @@ class SimulationConditions(SimulationConditionsBASE):
 
             plt.subplot(1,2,2)
             
-            plt.imshow((np.abs(u2[:,self._FocalSpotLocation[1],:]).T+
+            plt.imshow((np.abs(self._u2RayleighField[:,self._FocalSpotLocation[1],:]).T+
                                        self._MaterialMap[self._FocalSpotLocation[0],:,:].T*
-                                       np.abs(u2[self._FocalSpotLocation[0],:,:]).max()/10)/1e6,
+                                       np.abs(self._u2RayleighField[self._FocalSpotLocation[0],:,:]).max()/10)/1e6,
                                        extent=[self._YDim.min(),self._YDim.max(),self._ZDim.max(),self._ZDim.min()],
                                        cmap=plt.cm.jet)
             plt.colorbar()
             plt.title('Acoustic field with Rayleigh with skull and brain (MPa)')
-        
-    def CreateSources(self,ramp_length=4):
-        #we create the list of functions sources taken from the Rayliegh incident field
-        LengthSource=np.floor(self._TimeSimulation/(1.0/self._Frequency))*1/self._Frequency
-        TimeVectorSource=np.arange(0,LengthSource+self._TemporalStep,self._TemporalStep)
-        #we do as in k-wave to create a ramped signal
-        
-        ramp_length_points = int(np.round(ramp_length/self._Frequency/self._TemporalStep))
-        ramp_axis =np.arange(0,np.pi,np.pi/ramp_length_points)
-
-        # create ramp using a shifted cosine
-        ramp = (-np.cos(ramp_axis) + 1) * 0.5
-        ramp_length_points=len(ramp)
-        
-        self._SourceMap=np.zeros((self._N1,self._N2,self._N3),np.uint32)
-        LocZ=self._ZSourceLocation
-        
-        SourceMaskIND=np.where(np.abs(self._SourceMapRayleigh)>0)
-        SourceMask=np.zeros((self._N1,self._N2),np.uint32)
-        
-        RefI= int((SourceMaskIND[0].max()-SourceMaskIND[0].min())/2)+SourceMaskIND[0].min()
-        RefJ= int((SourceMaskIND[1].max()-SourceMaskIND[1].min())/2)+SourceMaskIND[1].min()
-        AngRef=np.angle(self._SourceMapRayleigh[RefI,RefJ])
-        PulseSource = np.zeros((np.sum(np.abs(self._SourceMapRayleigh)>0),TimeVectorSource.shape[0]))
-        nSource=1                       
-        for i,j in zip(SourceMaskIND[0],SourceMaskIND[1]):
-            SourceMask[i,j]=nSource
-            u0=self._SourceMapRayleigh[i,j]
-            #we recover amplitude and phase from Rayleigh field
-            PulseSource[nSource-1,:] = np.abs(u0) *np.sin(2*np.pi*self._Frequency*TimeVectorSource+np.angle(u0))
-            PulseSource[nSource-1,:int(ramp_length_points)]*=ramp
-            nSource+=1
-        self._SourceMap[:,:,LocZ]=SourceMask 
-            
-        self._PulseSource=PulseSource
-        
-       
-        if self._bDisplay:
-            plt.figure(figsize=(6,3))
-            for n in range(1,4):
-                plt.plot(TimeVectorSource*1e6,PulseSource[int(PulseSource.shape[0]/4)*n,:])
-                plt.title('CW signal, example %i' %(n))
-                
-            plt.xlim(0,50)
-                
-            plt.figure(figsize=(3,2))
-            plt.imshow(self._SourceMap[:,:,LocZ])
-            plt.title('source map - source ids')
\ No newline at end of file
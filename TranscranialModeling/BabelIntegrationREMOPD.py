@@ -260,6 +260,7 @@ class SimulationConditions(SimulationConditionsBASE):
     '''
     Class implementing the low level interface to prepare the details of the simulation conditions and execute the simulation
     '''
+    RayleighForwardAttributes=SimulationConditionsBASE.RayleighForwardAttributes+('_SourceMapRayleigh','_TxREMOPD','BasePhasedArrayProgramming','BasePhasedArrayProgrammingRefocusing')
     def __init__(self,Aperture=APERTURE, # m, aperture of the Tx, used tof calculated cross section area entering the domain
                       FocalLength=0.0,
                       XSteering=0.0, #lateral steering
@@ -355,22 +356,14 @@ class SimulationConditions(SimulationConditionsBASE):
         else:
              u0=(np.ones((self._TxREMOPD['center'].shape[0],1),np.float32)+ 1j*np.zeros((self._TxREMOPD['center'].shape[0],1),np.float32))*self._SourceAmpPa
              
-        nxf=len(self._XDim)
-        nyf=len(self._YDim)
-        nzf=len(self._ZDim)
-        xp,yp,zp=np.meshgrid(self._XDim,self._YDim,self._ZDim,indexing='ij')
-
-        print('ZDim[self._ZSourceLocation]',self._ZDim[self._ZSourceLocation])
-        
-        rf=np.hstack((np.reshape(xp,(nxf*nyf*nzf,1)),np.reshape(yp,(nxf*nyf*nzf,1)), np.reshape(zp,(nxf*nyf*nzf,1)))).astype(np.float32)
-        
-        u2=ForwardSimple(cwvnb_extlay,self._TxREMOPD['center'].astype(np.float32),
-                         self._TxREMOPD['ds'].astype(np.float32),u0,rf,deviceMetal=deviceName)
-        u2=np.reshape(u2,xp.shape)
-        
-        self._u2RayleighField=u2
+        self.SetRayleighSource(cwvnb_extlay,self._TxREMOPD['center'],self._TxREMOPD['ds'],u0,deviceName=deviceName)
+        if self._bRayleighSourcePlaneOnly:
+            #FDTD only needs the source plane, the full field is calculated on demand when saving results
+            u2Plane=self.CalculateRayleighPlanes(self._ZSourceLocation)[:,:,0]
+        else:
+            u2Plane=self._u2RayleighField[:,:,self._ZSourceLocation]
 
-        self._SourceMapRayleigh=u2[:,:,self._ZSourceLocation].copy()
+        self._SourceMapRayleigh=u2Plane.copy()
 
         self._SourceMapRayleigh[:self._PMLThickness,:]=0
         self._SourceMapRayleigh[-self._PMLThickness:,:]=0
@@ -380,40 +373,9 @@ class SimulationConditions(SimulationConditionsBASE):
           
         
     def CreateSources(self,ramp_length=4):
-        #we create the list of functions sources taken from the Rayliegh incident field
-        LengthSource=np.floor(self._TimeSimulation/(1.0/self._Frequency))*1/self._Frequency
-        TimeVectorSource=np.arange(0,LengthSource+self._TemporalStep,self._TemporalStep)
-        #we do as in k-wave to create a ramped signal
-        
-        ramp_length_points = int(np.round(ramp_length/self._Frequency/self._TemporalStep))
-        ramp_axis =np.arange(0,np.pi,np.pi/ramp_length_points)
+        super().CreateSources(ramp_length=ramp_length)
+        TimeVectorSource=self.ReturnTimeVectorSource()
 
-        # create ramp using a shifted cosine
-        ramp = (-np.cos(ramp_axis) + 1) * 0.5
-        ramp_length_points=len(ramp)
-        
-        self._SourceMap=np.zeros((self._N1,self._N2,self._N3),np.uint32)
-        LocZ=self._ZSourceLocation
-        
-        SourceMaskIND=np.where(np.abs(self._SourceMapRayleigh)>0)
-        SourceMask=np.zeros((self._N1,self._N2),np.uint32)
-        
-        RefI= int((SourceMaskIND[0].max()-SourceMaskIND[0].min())/2)+SourceMaskIND[0].min()
-        RefJ= int((SourceMaskIND[1].max()-SourceMaskIND[1].min())/2)+SourceMaskIND[1].min()
-        AngRef=np.angle(self._SourceMapRayleigh[RefI,RefJ])
-        PulseSource = np.zeros((np.sum(np.abs(self._SourceMapRayleigh)>0),TimeVectorSource.shape[0]))
-        nSource=1                       
-        for i,j in zip(SourceMaskIND[0],SourceMaskIND[1]):
-            SourceMask[i,j]=nSource
-            u0=self._SourceMapRayleigh[i,j]
-            #we recover amplitude and phase from Rayleigh field
-            PulseSource[nSource-1,:] = np.abs(u0) *np.sin(2*np.pi*self._Frequency*TimeVectorSource+np.angle(u0))
-            PulseSource[nSource-1,:int(ramp_length_points)]*=ramp
-            nSource+=1
-        self._SourceMap[:,:,LocZ]=SourceMask 
-            
-        self._PulseSource=PulseSource
-        
         ## Now we create the sources for back propagation
         
         self._PunctualSource=np.sin(2*np.pi*self._Frequency*TimeVectorSource).reshape(1,len(TimeVectorSource))
@@ -424,20 +386,6 @@ class SimulationConditions(SimulationConditionsBASE):
         LocForRefocusing[1]+=int(np.round(self._YSteering/self._SpatialStep))
         LocForRefocusing[2]+=int(np.round(self._ZSteering/self._SpatialStep))
         self._SourceMapPunctual[LocForRefocusing[0],LocForRefocusing[1],LocForRefocusing[2]]=1
-        
-
-        if self._bDisplay:
-            plt.figure(figsize=(12,4))
-            for n in range(1,4):
-                plt.plot(TimeVectorSource*1e6,PulseSource[int(PulseSource.shape[0]/4)*n,:])
-                plt.title('CW signal, example %i' %(n))
-                
-            plt.xlim(0,50)
-                
-            plt.figure(figsize=(5,4))
-            plt.imshow(self._SourceMap[:,:,LocZ])
-            plt.title('source map - source ids')
-
 
     def BackPropagationRayleigh(self,deviceName='6800'):
         assert(np.all(np.array(self._SourceMapRayleigh.shape)==np.array(self._PressMapFourierBack.shape)))
@@ -471,51 +419,12 @@ class SimulationConditions(SimulationConditionsBASE):
             u0[nBase:nBase+self._TxREMOPD['elemdims']]=(self._SourceAmpPa*np.exp(1j*phi)).astype(np.complex64)
             nBase+=self._TxREMOPD['elemdims']
 
-        nxf=len(self._XDim)
-        nyf=len(self._YDim)
-        nzf=len(self._ZDim)
         ZDim=self._ZDim-self._ZDim[self._ZSourceLocation]+self._TxMechanicalAdjustmentZ
-        
-        xp,yp,zp=np.meshgrid(self._XDim,self._YDim,ZDim,indexing='ij')
-        
-        rf=np.hstack((np.reshape(xp,(nxf*nyf*nzf,1)),np.reshape(yp,(nxf*nyf*nzf,1)), np.reshape(zp,(nxf*nyf*nzf,1)))).astype(np.float32)
-        
-        u2=ForwardSimple(cwvnb_extlay,self._TxREMOPD['center'].astype(np.float32),self._TxREMOPD['ds'].astype(np.float32),u0,rf,deviceMetal=deviceName)
-        u2=np.reshape(u2,xp.shape)
-        self._SourceMapRayleighRefocus=u2[:,:,self._ZSourceLocation].copy()
+        #only the source plane is needed for the refocusing FDTD run
+        RefocusSource=self.ReturnRayleighSource(cwvnb_extlay,self._TxREMOPD['center'],self._TxREMOPD['ds'],u0,deviceName=deviceName,ZDim=ZDim)
+        u2Plane=self.CalculateRayleighPlanes(self._ZSourceLocation,RayleighSource=RefocusSource)[:,:,0]
+        self._SourceMapRayleighRefocus=u2Plane.copy()
         self._SourceMapRayleighRefocus[:self._PMLThickness,:]=0
         self._SourceMapRayleighRefocus[-self._PMLThickness:,:]=0
         self._SourceMapRayleighRefocus[:,:self._PMLThickness]=0
         self._SourceMapRayleighRefocus[:,-self._PMLThickness:]=0
-        
-        
-    def CreateSourcesRefocus(self,ramp_length=4):
-        #we create the list of functions sources taken from the Rayliegh incident field
-        LengthSource=np.floor(self._TimeSimulation/(1.0/self._Frequency))*1/self._Frequency
-        TimeVectorSource=np.arange(0,LengthSource+self._TemporalStep,self._TemporalStep)
-        #we do as in k-wave to create a ramped signal
-        
-        ramp_length_points = int(np.round(ramp_length/self._Frequency/self._TemporalStep))
-        ramp_axis =np.arange(0,np.pi,np.pi/ramp_length_points)
-
-        # create ramp using a shifted cosine
-        ramp = (-np.cos(ramp_axis) + 1) * 0.5
-        ramp_length_points=len(ramp)
-        
-        LocZ=self._ZSourceLocation
-        
-        SourceMaskIND=np.where(np.abs(self._SourceMapRayleigh)>0)
-           
-        RefI= int((SourceMaskIND[0].max()-SourceMaskIND[0].min())/2)+SourceMaskIND[0].min()
-        RefJ= int((SourceMaskIND[1].max()-SourceMaskIND[1].min())/2)+SourceMaskIND[1].min()
-        AngRef=np.angle(self._SourceMapRayleighRefocus[RefI,RefJ])
-        PulseSource = np.zeros((np.sum(np.abs(self._SourceMapRayleighRefocus)>0),TimeVectorSource.shape[0]))
-        nSource=1                       
-        for i,j in zip(SourceMaskIND[0],SourceMaskIND[1]):
-            u0=self._SourceMapRayleighRefocus[i,j]
-            #we recover amplitude and phase from Rayleigh field
-            PulseSource[nSource-1,:] = np.abs(u0) *np.sin(2*np.pi*self._Frequency*TimeVectorSource+np.angle(u0))
-            PulseSource[nSource-1,:int(ramp_length_points)]*=ramp
-            nSource+=1
-            
-        self._PulseSourceRefocus=PulseSource
\ No newline at end of file
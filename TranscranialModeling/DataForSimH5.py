@@ -0,0 +1,110 @@
+'''
+On-disk layout of the DataForSim.h5 files
+
+Volumes (arrays with 3 or more dimensions) are stored chunked along z (axis 2) and compressed losslessly with
+Blosc-zstd, so a plane can be read with h5py without decompressing the whole volume. Other entries are saved with
+SaveToH5py, so files remain readable with ReadFromH5py. The format version is stored in the root attribute 'DataForSimFormat'.
+
+ReadDataForSim returns a dict-like object that loads each volume only when it is accessed, membership tests
+('MaterialMapCT' in Data) do not load anything. ReadSlice (e.g. Data.ReadSlice('p_amp',np.s_[:,:,z])) reads only the
+chunks covering the selection of a volume that was not loaded yet.
+'''
+import numpy as np
+import h5py
+import hdf5plugin
+from collections.abc import MutableMapping
+from BabelViscoFDTD.H5pySimple import ReadFromH5py,SaveToH5py
+
+DATAFORSIM_FORMAT_VERSION=1
+
+def ReturnZChunks(shape,itemsize,ChunkBytes=1<<20):
+    '''
+    Chunk shape covering full xy planes and as many z planes as fit in ChunkBytes
+    '''
+    PlaneBytes=int(np.prod(shape[:2]))*itemsize
+    nz=int(min(shape[2],max(1,ChunkBytes//max(1,PlaneBytes))))
+    return tuple(shape[:2])+(nz,)+tuple(shape[3:])
+
+def SaveDataForSim(DataForSim,fname,complevel=1,ChunkBytes=1<<20):
+    Small={}
+    with h5py.File(fname,'w') as f:
+        f.attrs['DataForSimFormat']=DATAFORSIM_FORMAT_VERSION
+        for k,v in DataForSim.items():
+            if type(v) is np.ndarray and v.ndim>=3:
+                ds=f.create_dataset(k,data=np.ascontiguousarray(v),
+                                    chunks=ReturnZChunks(v.shape,v.itemsize,ChunkBytes),
+                                    **hdf5plugin.Blosc(cname='zstd',clevel=complevel,shuffle=hdf5plugin.Blosc.SHUFFLE))
+                ds.attrs["type"]="ndarray"
+            else:
+                Small[k]=v
+        SaveToH5py(Small,f)
+
+class _GroupItems(object):
+    #minimal group-like object so ReadFromH5py decodes only a subset of the entries of a file
+    def __init__(self,items):
+        self._items=items
+    def items(self):
+        return self._items
+
+class DataForSimFile(MutableMapping):
+    '''
+    Dict-like reader of DataForSim.h5 files, volumes are read from disk on first access.
+    Assigned entries are kept in memory only. The file is opened only while reading, so it can be overwritten
+    by a new simulation while the reader is alive.
+    '''
+    def __init__(self,fname):
+        self._fname=fname
+        self._Lazy={} # name: shape
+        with h5py.File(fname,'r') as f:
+            self.FormatVersion=int(f.attrs.get('DataForSimFormat',0)) # 0 for files saved with SaveToH5py
+            Others=[]
+            for k,val in f.items():
+                if isinstance(val,h5py.Dataset) and val.attrs.get("type")=="ndarray" and val.ndim>=3:
+                    self._Lazy[k]=val.shape
+                else:
+                    Others.append((k,val))
+            self._Data=ReadFromH5py(f,_GroupItems(Others))
+            self._Keys=list(f.keys())
+
+    def __getitem__(self,k):
+        if k not in self._Data:
+            if k not in self._Lazy:
+                raise KeyError(k)
+            with h5py.File(self._fname,'r') as f:
+                self._Data[k]=f[k][()]
+        return self._Data[k]
+
+    def ReadSlice(self,k,sel):
+        '''
+        Return Data[k][sel], entries already in memory are sliced, volumes not loaded yet are read partially from disk
+        '''
+        if k in self._Data:
+            return self._Data[k][sel]
+        if k not in self._Lazy:
+            raise KeyError(k)
+        with h5py.File(self._fname,'r') as f:
+            return f[k][sel]
+
+    def __setitem__(self,k,v):
+        self._Data[k]=v
+        if k not in self._Keys:
+            self._Keys.append(k)
+
+    def __delitem__(self,k):
+        if k not in self._Keys:
+            raise KeyError(k)
+        self._Keys.remove(k)
+        self._Data.pop(k,None)
+        self._Lazy.pop(k,None)
+
+    def __contains__(self,k):
+        return k in self._Keys
+
+    def __iter__(self):
+        return iter(list(self._Keys))
+
+    def __len__(self):
+        return len(self._Keys)
+
+def ReadDataForSim(fname):
+    return DataForSimFile(fname)